@@ -0,0 +1,255 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+from config.settings import Config
+from embedding_providers import get_embedding_provider
+from embedding_store import aembed_texts
+from metrics import record_cache_event, record_usage, stage_timer
+from retrieval import VectorRetriever, build_enhanced_query, get_retriever
+from single_flight import AsyncSingleFlight
+from openai_gateway import OpenAIGateway, as_gateway
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+logger = logging.getLogger("aiagent_log")
+
+
+class AsyncVectorRetriever:
+    """
+    基于 asyncio 的检索器
+    - OpenAI 请求经过共享网关的 AsyncOpenAI 客户端（连接池、限流、重试）
+    - 集合和索引的加载、BM25 检索、类别路由和 Chroma 查询都放到线程池中执行，不阻塞事件循环
+    - 与同步检索器共享 Chroma 集合、结果缓存和嵌入缓存
+    """
+
+    def __init__(self,
+                 retriever: Optional[VectorRetriever] = None,
+                 max_workers: int = Config.ASYNC_CHROMA_WORKERS,
+                 client: Optional["AsyncOpenAI"] = None):
+        self.retriever = retriever if retriever is not None else get_retriever()
+        # 未注入客户端时使用共享的 OpenAI 网关（与同步检索器共用限流配额）
+        self._client = client
+        self._gateway = None
+        self._embedding_provider = None
+        self._client_lock = threading.RLock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="chroma")
+        # 合并并发的相同调用（与同步检索器的 single_flight 相互独立）
+        self.single_flight = AsyncSingleFlight()
+
+    @property
+    def gateway(self) -> OpenAIGateway:
+        if self._gateway is None:
+            with self._client_lock:
+                if self._gateway is None:
+                    self._gateway = as_gateway(self._client)
+        return self._gateway
+
+    @property
+    def client(self) -> "AsyncOpenAI":
+        return self.gateway.async_client
+
+    @property
+    def embedding_provider(self):
+        if self._embedding_provider is None:
+            with self._client_lock:
+                if self._embedding_provider is None:
+                    self._embedding_provider = get_embedding_provider(self.gateway)
+        return self._embedding_provider
+
+    async def _run_in_executor(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    async def recommend_agent(self, user_prompt: str) -> Dict:
+        """
+        根据用户的Prompt推荐合适的agent类型（异步）
+        Args:
+            user_prompt: 用户的输入prompt
+        Returns:
+            Dict: 包含推荐的agent类型和描述的字典
+        """
+        return await self.single_flight.do(("recommend_agent", user_prompt), self._recommend_agent, user_prompt)
+
+    async def _recommend_agent(self, user_prompt: str) -> Dict:
+        cache = self.retriever.recommendation_cache
+        recommendation = cache.get(user_prompt)
+        prompt_embedding = None
+        if recommendation is None and cache.semantic_distance is not None:
+            prompt_embedding = await self.get_embedding(user_prompt)
+            recommendation = cache.get_similar(prompt_embedding)
+        record_cache_event("recommendation", recommendation is not None)
+        if recommendation is None:
+            cache.record_miss()
+            request = self.retriever._build_recommend_request(user_prompt)
+            with stage_timer("recommend_agent"):
+                response = await self.gateway.achat(request)
+            record_usage(request["model"], getattr(response, "usage", None))
+            recommendation = response.choices[0].message.content
+            cache.set(user_prompt, recommendation, prompt_embedding)
+        return {
+            "user_prompt": user_prompt,
+            "agent_recommendation": recommendation
+        }
+
+    async def get_embedding(self, text: str) -> list:
+        return await self.single_flight.do(("get_embedding", text), self._get_embedding, text)
+
+    async def _get_embedding(self, text: str) -> list:
+        with stage_timer("get_embedding"):
+            embeddings = await aembed_texts(
+                self.gateway,
+                [text],
+                store=self.retriever.embedding_store,
+                provider=self.embedding_provider
+            )
+        return embeddings[0]
+
+    async def search(self,
+                     query: str,
+                     top_k: int = 3,
+                     filters: Optional[Dict] = None,
+                     min_score: float = 0.4,
+                     mode: Optional[str] = None) -> List[Dict]:
+        """
+        带缓存的异步检索，参数与 VectorRetriever.search 相同
+        """
+        retriever = self.retriever
+        mode = mode or Config.SEARCH_MODE
+        cache_key = retriever._generate_cache_key(query, top_k, filters, min_score, mode)
+        cached_results = retriever._get_from_cache(cache_key)
+        if cached_results is not None:
+            return cached_results
+        return await self.single_flight.do(
+            ("search", cache_key), self._search, query, top_k, filters, min_score, mode, cache_key
+        )
+
+    async def _search(self, query: str, top_k: int, filters: Optional[Dict], min_score: float, mode: str,
+                      cache_key: str) -> List[Dict]:
+        retriever = self.retriever
+        # 首次使用或集合版本变化后，BM25 检索需要先从集合构建索引，同样放到线程池中执行
+        lexical_hits, final_results = await self._run_in_executor(
+            retriever._lexical_first, query, top_k, filters, min_score, mode
+        )
+        if final_results is None:
+            query_embedding = await self.get_embedding(query)
+            with stage_timer("collection_query"):
+                final_results = await self._run_in_executor(
+                    self._vector_search, query_embedding, lexical_hits, top_k, filters, min_score, mode
+                )
+        retriever._save_to_cache(cache_key, final_results)
+        return final_results
+
+    def _vector_search(self, query_embedding: list, lexical_hits, top_k: int, filters: Optional[Dict],
+                       min_score: float, mode: str) -> List[Dict]:
+        """
+        在线程池中执行的向量检索：打开集合和检索后端、类别路由（可能重新加载质心）、查询和重排序
+        都可能访问磁盘或占用较多 CPU，不能在事件循环中执行
+        """
+        retriever = self.retriever
+        results = retriever.backend.query(**retriever._build_query_params([query_embedding], top_k, filters))
+        return retriever._finish_vector_results(results, lexical_hits, top_k, min_score, mode)
+
+    async def load_documents(self, results: List[Dict]) -> List[Optional[str]]:
+        """在线程池中一次性加载检索结果的文档，之后访问 result["document"] 不再查询集合"""
+        return await self._run_in_executor(
+            self.retriever.document_store.get_many, [result["id"] for result in results]
+        )
+
+    async def enhanced_search(self,
+                              user_prompt: str,
+                              top_k: int = 3,
+                              filters: Optional[Dict] = None,
+                              min_score: float = 0.4,
+                              mode: Optional[str] = None) -> Dict:
+        """
+        增强版异步检索：agent推荐请求进行的同时，先用原始问题做一次推测性检索；
+        推荐返回后用增强查询重新检索，并用推测结果补足不足 top_k 的部分
+        Args:
+            user_prompt: 用户的原始问题
+            top_k: 返回结果数量
+            filters: 元数据过滤条件
+            min_score: 最小相似度阈值
+            mode: 检索模式，同 VectorRetriever.search
+        Returns:
+            Dict: 包含agent推荐和检索结果的字典
+        """
+        with stage_timer("enhanced_search"):
+            return await self._enhanced_search(user_prompt, top_k, filters, min_score, mode)
+
+    async def _enhanced_search(self,
+                               user_prompt: str,
+                               top_k: int,
+                               filters: Optional[Dict],
+                               min_score: float,
+                               mode: Optional[str]) -> Dict:
+        recommend_task = asyncio.create_task(self.recommend_agent(user_prompt))
+        speculative_task = asyncio.create_task(
+            self.search(query=user_prompt, top_k=top_k, filters=filters, min_score=min_score, mode=mode)
+        )
+
+        try:
+            agent_recommendation = await recommend_task
+        except Exception as e:
+            # 推荐失败时退回到推测性检索结果
+            logger.warning(f"agent推荐失败，使用原始问题的检索结果: {str(e)}")
+            return {
+                "original_prompt": user_prompt,
+                "agent_recommendation": "",
+                "search_results": await speculative_task
+            }
+
+        enhanced_query = build_enhanced_query(user_prompt, agent_recommendation['agent_recommendation'])
+        search_results = await self.search(
+            query=enhanced_query,
+            top_k=top_k,
+            filters=filters,
+            min_score=min_score,
+            mode=mode
+        )
+
+        try:
+            speculative_results = await speculative_task
+        except Exception as e:
+            logger.warning(f"推测性检索失败: {str(e)}")
+            speculative_results = []
+
+        return {
+            "original_prompt": user_prompt,
+            "agent_recommendation": agent_recommendation['agent_recommendation'],
+            "search_results": _merge_results(search_results, speculative_results, top_k)
+        }
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+def _merge_results(primary: List[Dict], secondary: List[Dict], top_k: int) -> List[Dict]:
+    """以增强查询结果为主，用推测性检索结果补足 top_k，按 id 去重"""
+    merged = list(primary[:top_k])
+    seen_ids = {result["id"] for result in merged}
+    for result in secondary:
+        if len(merged) >= top_k:
+            break
+        if result["id"] not in seen_ids:
+            merged.append(result)
+            seen_ids.add(result["id"])
+    return merged
+
+
+_shared_async_retriever: Optional[AsyncVectorRetriever] = None
+_shared_async_retriever_lock = threading.Lock()
+
+
+def get_async_retriever() -> AsyncVectorRetriever:
+    """获取进程内共享的异步检索器（与 get_retriever 共享底层检索器）"""
+    global _shared_async_retriever
+    if _shared_async_retriever is None:
+        with _shared_async_retriever_lock:
+            if _shared_async_retriever is None:
+                _shared_async_retriever = AsyncVectorRetriever()
+    return _shared_async_retriever
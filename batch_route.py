@@ -0,0 +1,416 @@
+"""
+离线批量路由：把大规模提示词日志（JSONL）逐行路由到 agent，用于统计分析
+
+- 输入按行惰性读取，内存占用与文件大小无关
+- 每批提示词先去重（包括与之前批次重复的提示词），recommend_agent 在有界线程池中并发执行，
+  增强查询再通过 search_many 合并为一次（分块的）嵌入请求和批量 Chroma 查询
+- 结果逐批写入 JSONL 或 Parquet，每批写完后原子地更新检查点；中断后使用 --resume 从检查点继续，
+  已完成的行不会重复请求，检查点之后写出的不完整结果会被截掉
+- 已路由提示词的结果保存在输出旁的 SQLite（<输出>.routed.sqlite3）中，恢复后重复出现的提示词同样直接复用
+
+用法：
+    python batch_route.py prompts.jsonl routed.jsonl --concurrency 8 --resume
+    python batch_route.py prompts.jsonl routed.parquet --prompt-field query
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from config.settings import Config
+from retrieval import VectorRetriever, build_enhanced_query, get_retriever
+
+logger = logging.getLogger("aiagent_log")
+
+
+def iter_prompts(path: str, field: str = "prompt", skip: int = 0) -> Iterator[Tuple[int, Optional[str]]]:
+    """
+    逐行读取输入文件，产出 (行号, 提示词)；行号从 0 开始，跳过前 skip 行
+    每行可以是 JSON 对象（取 field 字段）或 JSON 字符串；空行、无法解析或缺少字段的行产出 None，仍占用行号
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(islice(f, skip, None), start=skip):
+            if not line.strip():
+                # 空行（如文件末尾多余的换行）直接跳过，不记警告
+                yield line_no, None
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning(f"第 {line_no + 1} 行不是合法的 JSON，已跳过")
+                yield line_no, None
+                continue
+            prompt = record.get(field) if isinstance(record, dict) else record
+            yield line_no, prompt if isinstance(prompt, str) and prompt.strip() else None
+
+
+class Checkpoint:
+    """批量路由的进度：已处理的输入行数和输出文件的状态，写入时先写临时文件再替换"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> Optional[Dict]:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save(self, state: Dict):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+
+class JsonlResultWriter:
+    """逐行追加 JSON 结果；commit 时刷盘并返回文件长度，恢复时截掉检查点之后的内容"""
+
+    def __init__(self, path: str, state: Optional[Dict] = None):
+        self.path = path
+        self._file = open(path, "r+b" if state is not None and os.path.exists(path) else "wb")
+        if state is not None:
+            self._file.truncate(state["bytes"])
+            self._file.seek(state["bytes"])
+
+    def write(self, rows: List[Dict]):
+        self._file.write("".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows).encode("utf-8"))
+
+    def commit(self) -> Dict:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        return {"bytes": self._file.tell()}
+
+    def close(self):
+        self._file.close()
+
+
+_PART_PATTERN = re.compile(r"part-(\d+)\.parquet(?:\.tmp)?")
+
+
+def _part_number(name: str) -> Optional[int]:
+    """分片文件名（part-00012.parquet 或写到一半的 .tmp）中的序号，不是分片文件时返回 None"""
+    match = _PART_PATTERN.fullmatch(name)
+    return int(match.group(1)) if match else None
+
+
+class ParquetResultWriter:
+    """
+    Parquet 结果写成目录下的分片文件（part-00000.parquet ...），每次 commit 写出一个分片，
+    整个目录可以作为一个数据集读取；恢复时删除检查点之后写出的分片
+    检索结果拆成 result_ids / result_scores / result_metadata（JSON 字符串）三列，避免元数据字段不一致导致模式冲突
+    """
+
+    def __init__(self, path: str, state: Optional[Dict] = None):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("输出 Parquet 需要安装 pyarrow: pip install pyarrow")
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.path = path
+        self.parts = state["parts"] if state is not None else 0
+        self._rows: List[Dict] = []
+        os.makedirs(path, exist_ok=True)
+        for name in os.listdir(path):
+            # 上次运行在检查点之后写出的分片（以及全新运行时的旧分片），目录中的其他文件不动
+            number = _part_number(name)
+            if number is not None and (number >= self.parts or name.endswith(".tmp")):
+                os.remove(os.path.join(path, name))
+
+    def write(self, rows: List[Dict]):
+        for row in rows:
+            results = row.get("results") or []
+            self._rows.append({
+                "line": row["line"],
+                "prompt": row["prompt"],
+                "agent_recommendation": row.get("agent_recommendation"),
+                "result_ids": [hit["id"] for hit in results],
+                "result_scores": [hit["score"] for hit in results],
+                "result_metadata": [json.dumps(hit["metadata"], ensure_ascii=False) for hit in results],
+                "error": row.get("error")
+            })
+
+    def commit(self) -> Dict:
+        if self._rows:
+            table = self.pa.Table.from_pylist(self._rows)
+            part_path = os.path.join(self.path, f"part-{self.parts:05d}.parquet")
+            self.pq.write_table(table, f"{part_path}.tmp")
+            os.replace(f"{part_path}.tmp", part_path)
+            self.parts += 1
+            self._rows = []
+        return {"parts": self.parts}
+
+    def close(self):
+        pass
+
+
+def create_writer(path: str, output_format: Optional[str] = None, state: Optional[Dict] = None):
+    """按 output_format（或输出路径的扩展名）创建结果写入器：jsonl 或 parquet"""
+    output_format = output_format or ("parquet" if path.endswith(".parquet") else "jsonl")
+    if output_format == "jsonl":
+        return JsonlResultWriter(path, state)
+    if output_format == "parquet":
+        return ParquetResultWriter(path, state)
+    raise ValueError(f"未知的输出格式: {output_format}")
+
+
+class RoutedStore:
+    """
+    已路由提示词的结果：提示词 sha256 -> 路由结果（不含行号）
+    - 内存中保留有界的 LRU；指定 path 时成功的结果同时写入 SQLite，LRU 未命中时从 SQLite 读取
+    - SQLite 的写入在 commit 时提交，run 在推进检查点之前提交，恢复运行时重做的批次和之后重复的提示词都不会再请求上游
+    - 失败的结果只保留在内存中，恢复运行时会重新请求
+    """
+
+    def __init__(self, path: Optional[str] = None, memory_entries: int = Config.BATCH_ROUTE_DEDUP_ENTRIES):
+        self.path = path
+        self.memory_entries = memory_entries
+        self._memory: "OrderedDict[str, Dict]" = OrderedDict()
+        self._conn = None
+        if path is not None:
+            self._conn = sqlite3.connect(path)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS routed (key TEXT PRIMARY KEY, result TEXT NOT NULL)")
+            self._conn.commit()
+
+    def _remember(self, key: str, routed: Dict):
+        self._memory[key] = routed
+        self._memory.move_to_end(key)
+        if len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key: str) -> Optional[Dict]:
+        routed = self._memory.get(key)
+        if routed is not None:
+            self._memory.move_to_end(key)
+            return routed
+        if self._conn is None:
+            return None
+        row = self._conn.execute("SELECT result FROM routed WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        routed = json.loads(row[0])
+        self._remember(key, routed)
+        return routed
+
+    def put(self, key: str, routed: Dict):
+        self._remember(key, routed)
+        if self._conn is not None and "error" not in routed:
+            self._conn.execute("INSERT OR REPLACE INTO routed (key, result) VALUES (?, ?)",
+                               (key, json.dumps(routed, ensure_ascii=False)))
+
+    def commit(self):
+        if self._conn is not None:
+            self._conn.commit()
+
+    def clear(self):
+        self._memory.clear()
+        if self._conn is not None:
+            self._conn.execute("DELETE FROM routed")
+            self._conn.commit()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class BatchRouter:
+    """
+    批量路由：对一批提示词去重后并发获取 agent 推荐，再用增强查询做一次批量检索
+    已经路由过的提示词保存在 RoutedStore 中，重复出现时直接复用结果，不再请求上游
+    """
+
+    def __init__(self, retriever: Optional[VectorRetriever] = None,
+                 concurrency: int = Config.BATCH_ROUTE_CONCURRENCY,
+                 top_k: int = 3,
+                 min_score: float = 0.4,
+                 filters: Optional[Dict] = None,
+                 dedup_entries: int = Config.BATCH_ROUTE_DEDUP_ENTRIES):
+        self.retriever = retriever if retriever is not None else get_retriever()
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch-route")
+        self.top_k = top_k
+        self.min_score = min_score
+        self.filters = filters
+        self.dedup_entries = dedup_entries
+        # 默认只在内存中去重；run 会换成保存在输出旁的 SQLite，使去重跨越中断和恢复
+        self.routed = RoutedStore(memory_entries=dedup_entries)
+        self.stats = {"lines": 0, "skipped": 0, "unique": 0, "reused": 0, "errors": 0}
+
+    @staticmethod
+    def _key(prompt: str) -> str:
+        return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+    def _recommend(self, prompt: str) -> Dict:
+        try:
+            return {"agent_recommendation": self.retriever.recommend_agent(prompt)["agent_recommendation"]}
+        except Exception as e:
+            # 单条失败（网关重试后仍失败）记录在结果中，不中断整个任务
+            logger.warning(f"agent推荐失败: {type(e).__name__}: {e}")
+            return {"error": f"{type(e).__name__}: {e}"}
+
+    def _route_unique(self, prompts: List[str]) -> List[Dict]:
+        recommendations = list(self.executor.map(self._recommend, prompts))
+        routed = [dict(recommendation) for recommendation in recommendations]
+        searchable = [i for i, recommendation in enumerate(recommendations) if "error" not in recommendation]
+        if searchable:
+            queries = [
+                build_enhanced_query(prompts[i], recommendations[i]["agent_recommendation"]) for i in searchable
+            ]
+            try:
+                search_results = self.retriever.search_many(
+                    queries, top_k=self.top_k, filters=self.filters, min_score=self.min_score
+                )
+            except Exception as e:
+                logger.warning(f"批量检索失败: {type(e).__name__}: {e}")
+                search_results = [None] * len(searchable)
+                for i in searchable:
+                    routed[i]["error"] = f"{type(e).__name__}: {e}"
+            for i, hits in zip(searchable, search_results):
+                if hits is not None:
+                    routed[i]["results"] = [
+                        {"id": hit.id, "score": round(hit.score, 6), "metadata": hit.metadata} for hit in hits
+                    ]
+        return routed
+
+    def route_batch(self, batch: List[Tuple[int, Optional[str]]]) -> List[Dict]:
+        """路由一批 (行号, 提示词)，返回与有效行一一对应的结果行"""
+        pending: "OrderedDict[str, str]" = OrderedDict()
+        # 本批用到的路由结果，不受 LRU 淘汰影响
+        batch_routed: Dict[str, Dict] = {}
+        for _, prompt in batch:
+            if prompt is not None:
+                key = self._key(prompt)
+                if key in batch_routed or key in pending:
+                    continue
+                routed = self.routed.get(key)
+                if routed is None:
+                    pending[key] = prompt
+                else:
+                    batch_routed[key] = routed
+        if pending:
+            for key, routed in zip(pending, self._route_unique(list(pending.values()))):
+                batch_routed[key] = routed
+                self.routed.put(key, routed)
+        self.stats["unique"] += len(pending)
+
+        rows = []
+        for line_no, prompt in batch:
+            self.stats["lines"] += 1
+            if prompt is None:
+                self.stats["skipped"] += 1
+                continue
+            key = self._key(prompt)
+            routed = batch_routed[key]
+            if key not in pending:
+                self.stats["reused"] += 1
+            pending.pop(key, None)
+            if "error" in routed:
+                self.stats["errors"] += 1
+            rows.append({"line": line_no, "prompt": prompt, **routed})
+        return rows
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.routed.close()
+
+
+def run(input_path: str, output_path: str,
+        output_format: Optional[str] = None,
+        prompt_field: str = "prompt",
+        batch_size: int = Config.BATCH_ROUTE_BATCH_SIZE,
+        resume: bool = False,
+        router: Optional[BatchRouter] = None,
+        checkpoint_path: Optional[str] = None) -> Dict:
+    """
+    批量路由 input_path 中的提示词，结果写入 output_path
+    Args:
+        resume: 从检查点继续；检查点不存在或对应其他输入文件时从头开始
+        checkpoint_path: 检查点文件，默认为 output_path + ".checkpoint.json"
+            （已路由提示词的结果保存在 output_path + ".routed.sqlite3"）
+    Returns:
+        运行统计（行数、去重后请求数、复用数、失败数、耗时）
+    """
+    checkpoint = Checkpoint(checkpoint_path or f"{output_path.rstrip(os.sep)}.checkpoint.json")
+    state = checkpoint.load() if resume else None
+    if state is not None and state.get("input") != os.path.abspath(input_path):
+        logger.warning(f"检查点对应的输入文件是 {state.get('input')}，从头开始")
+        state = None
+    if state is not None and not os.path.exists(output_path):
+        logger.warning(f"检查点存在但输出 {output_path} 不存在，从头开始")
+        state = None
+    lines_done = state["lines"] if state is not None else 0
+    if lines_done:
+        logger.info(f"从检查点继续：跳过已完成的 {lines_done} 行")
+
+    router = router if router is not None else BatchRouter()
+    router.routed.close()
+    router.routed = RoutedStore(f"{output_path.rstrip(os.sep)}.routed.sqlite3", router.dedup_entries)
+    if state is None:
+        # 从头开始时丢弃上次运行留下的结果
+        router.routed.clear()
+    writer = create_writer(output_path, output_format, state["writer"] if state is not None else None)
+    start = time.perf_counter()
+    prompts = iter_prompts(input_path, prompt_field, skip=lines_done)
+    try:
+        while True:
+            batch = list(islice(prompts, batch_size))
+            if not batch:
+                break
+            writer.write(router.route_batch(batch))
+            lines_done = batch[-1][0] + 1
+            # 先把结果和已路由提示词刷盘，再推进检查点：中断时最多重做最后一批，且重做时不再请求上游
+            writer_state = writer.commit()
+            router.routed.commit()
+            checkpoint.save({
+                "input": os.path.abspath(input_path),
+                "lines": lines_done,
+                "writer": writer_state
+            })
+            logger.info(f"已处理 {lines_done} 行（去重后请求 {router.stats['unique']} 条，复用 {router.stats['reused']} 条）")
+    finally:
+        writer.close()
+    return {**router.stats, "lines_done": lines_done, "seconds": round(time.perf_counter() - start, 3)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="离线批量路由：把 JSONL 提示词日志路由到 agent")
+    parser.add_argument("input", help="输入 JSONL 文件，每行一个 JSON 对象（或 JSON 字符串）")
+    parser.add_argument("output", help="输出路径：.jsonl 文件，或 .parquet 分片目录")
+    parser.add_argument("--format", choices=["jsonl", "parquet"], help="输出格式，默认按扩展名判断")
+    parser.add_argument("--prompt-field", default="prompt", help="提示词所在的字段")
+    parser.add_argument("--batch-size", type=int, default=Config.BATCH_ROUTE_BATCH_SIZE, help="每批行数（也是检查点间隔）")
+    parser.add_argument("--concurrency", type=int, default=Config.BATCH_ROUTE_CONCURRENCY, help="并发 agent 推荐请求数")
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--min-score", type=float, default=0.4)
+    parser.add_argument("--filters", type=json.loads, default=None, help="元数据过滤条件（JSON）")
+    parser.add_argument("--resume", action="store_true", help="从检查点继续上次中断的任务")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    router = BatchRouter(concurrency=args.concurrency, top_k=args.top_k, min_score=args.min_score,
+                         filters=args.filters)
+    try:
+        stats = run(args.input, args.output, output_format=args.format, prompt_field=args.prompt_field,
+                    batch_size=args.batch_size, resume=args.resume, router=router)
+    finally:
+        router.close()
+    print(json.dumps(stats, ensure_ascii=False))
+    return stats
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+量化检索的召回率 / 内存 / 延迟基准测试
+
+在合成的 Chroma 集合上（向量围绕若干类别中心分布，接近真实嵌入的聚类结构），
+以 NumpyBackend 的 float32 精确检索为基线，对比 int8 / 二值量化在不同重打分倍数下的
+recall@k、常驻内存、磁盘占用和 p50/p95/p99 延迟，结果以 JSON 输出。
+
+用法：
+    python -m benchmarks.bench_quantization --sizes 10000 100000 --dimensions 1536 --output quantization.json
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import chromadb  # noqa: E402
+
+from benchmarks.bench_retrieval import summarize  # noqa: E402
+from config.settings import Config  # noqa: E402
+
+
+def seed_collection(size: int, dimensions: int, categories: int, seed: int = 0):
+    """创建 size 个合成agent：每个类别一个随机中心，agent向量 = 中心 + 噪声"""
+    db_client = chromadb.PersistentClient(path=Config.PERSIST_DIR)
+    collection = db_client.create_collection(name=f"quantization_{size}")
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((categories, dimensions)).astype(np.float32)
+    batch_size = db_client.get_max_batch_size()
+    for start in range(0, size, batch_size):
+        count = min(batch_size, size - start)
+        labels = np.arange(start, start + count) % categories
+        vectors = centers[labels] + rng.standard_normal((count, dimensions)).astype(np.float32)
+        collection.add(
+            ids=[f"agent_{i:07d}" for i in range(start, start + count)],
+            embeddings=vectors / np.linalg.norm(vectors, axis=1, keepdims=True),
+            metadatas=[{"category": f"category_{label}"} for label in labels]
+        )
+    return collection, centers
+
+
+def make_queries(centers: np.ndarray, count: int, seed: int = 1) -> np.ndarray:
+    """查询向量：随机类别中心 + 噪声，与agent向量同分布"""
+    rng = np.random.default_rng(seed)
+    queries = centers[rng.integers(0, len(centers), count)] + rng.standard_normal((count, centers.shape[1]))
+    return (queries / np.linalg.norm(queries, axis=1, keepdims=True)).astype(np.float32)
+
+
+def run_queries(backend, queries: np.ndarray, top_k: int):
+    ids, latencies = [], []
+    start = time.perf_counter()
+    for query in queries:
+        call_start = time.perf_counter()
+        result = backend.query([query.tolist()], n_results=top_k)
+        latencies.append(time.perf_counter() - call_start)
+        ids.append(result["ids"][0])
+    return ids, summarize(latencies, time.perf_counter() - start)
+
+
+def recall(expected: List[List[str]], actual: List[List[str]]) -> float:
+    hits = [len(set(e) & set(a)) / max(len(e), 1) for e, a in zip(expected, actual)]
+    return round(float(np.mean(hits)), 4)
+
+
+def bench_size(size: int, args) -> List[Dict]:
+    from quantized_index import QuantizedIndex
+    from vector_backends import NumpyBackend, QuantizedBackend
+
+    start = time.perf_counter()
+    collection, centers = seed_collection(size, args.dimensions, args.categories)
+    seed_seconds = time.perf_counter() - start
+    queries = make_queries(centers, args.queries)
+
+    baseline = NumpyBackend(collection, reload_interval=0)
+    expected, stats = run_queries(baseline, queries, args.top_k)
+    snapshot = baseline._snapshot
+    results = [{
+        "size": size, "method": "float32", "rescore_factor": None, f"recall@{args.top_k}": 1.0,
+        "resident_mb": round((snapshot.matrix.nbytes + snapshot.norms.nbytes) / 1024 / 1024, 2),
+        "disk_mb": None, **stats
+    }]
+    for method in args.methods:
+        # 每种量化方式只构建一次索引（包含从集合读取全部向量），不同重打分倍数共用
+        start = time.perf_counter()
+        backend = QuantizedBackend(collection, method=method, reload_interval=0)
+        build_seconds = time.perf_counter() - start
+        index: QuantizedIndex = backend._snapshot.index
+        disk = sum(os.path.getsize(index._path(suffix)) for suffix in ("codes.npy", "vectors.npy", "meta.npz"))
+        for factor in args.rescore_factors:
+            backend.rescore_factor = factor
+            actual, stats = run_queries(backend, queries, args.top_k)
+            results.append({
+                "size": size, "method": method, "rescore_factor": factor,
+                f"recall@{args.top_k}": recall(expected, actual),
+                "resident_mb": round(index.nbytes / 1024 / 1024, 2),
+                "disk_mb": round(disk / 1024 / 1024, 2),
+                "build_seconds": round(build_seconds, 3),
+                **stats
+            })
+    for item in results:
+        item["seed_seconds"] = round(seed_seconds, 3)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="量化检索召回率 / 内存 / 延迟基准测试")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000], help="合成集合的agent数量")
+    parser.add_argument("--dimensions", type=int, default=1536, help="合成向量维度（ada-002 为 1536）")
+    parser.add_argument("--categories", type=int, default=50, help="合成类别（聚类中心）数")
+    parser.add_argument("--queries", type=int, default=200, help="查询数")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--methods", nargs="+", default=["int8", "binary"], help="量化方式")
+    parser.add_argument("--rescore-factors", type=int, nargs="+", default=[1, 4, 10], help="重打分候选倍数")
+    parser.add_argument("--output", help="JSON 结果输出路径，默认打印到标准输出")
+    args = parser.parse_args(argv)
+
+    report = {
+        "benchmark": "quantization",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "params": vars(args),
+        "results": []
+    }
+    with tempfile.TemporaryDirectory(prefix="bench_quantization_") as workdir:
+        Config.PERSIST_DIR = os.path.join(workdir, "chroma")
+        for size in args.sizes:
+            report["results"].extend(bench_size(size, args))
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""
+检索热路径的离线基准测试
+
+使用确定性的 OpenAI 替身（可配置模拟延迟）和合成的 Chroma 集合，
+分别统计 search / enhanced_search / 批量写入在冷缓存和热缓存下的 p50/p95/p99 延迟与 QPS，
+结果以 JSON 输出，便于做回归对比。
+
+用法：
+    python -m benchmarks.bench_retrieval --sizes 100 10000 --output bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, Iterable, List
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import chromadb  # noqa: E402
+
+from benchmarks.fake_openai import FakeOpenAI  # noqa: E402
+from config.settings import Config  # noqa: E402
+
+CATEGORIES = ["finance", "law", "medical", "technology", "education", "career", "fashion", "travel",
+              "politics", "entertainment", "mental health"]
+
+
+def summarize(latencies: List[float], total_seconds: float) -> Dict:
+    """把单次调用耗时（秒）汇总为延迟分位数（毫秒）和 QPS"""
+    values = np.asarray(latencies, dtype=np.float64) * 1000
+    return {
+        "n": len(latencies),
+        "mean_ms": round(float(values.mean()), 4),
+        "p50_ms": round(float(np.percentile(values, 50)), 4),
+        "p95_ms": round(float(np.percentile(values, 95)), 4),
+        "p99_ms": round(float(np.percentile(values, 99)), 4),
+        "qps": round(len(latencies) / total_seconds, 2) if total_seconds > 0 else None
+    }
+
+
+def measure(func: Callable, items: Iterable) -> Dict:
+    latencies = []
+    start = time.perf_counter()
+    for item in items:
+        call_start = time.perf_counter()
+        func(item)
+        latencies.append(time.perf_counter() - call_start)
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def configure(workdir: str, size: int, dimensions: int):
+    """把 Config 指向临时目录，避免影响真实数据"""
+    Config.PERSIST_DIR = os.path.join(workdir, f"chroma_{size}")
+    Config.EMBEDDING_CACHE_PATH = os.path.join(workdir, f"embedding_cache_{size}.sqlite3")
+    Config.EMBEDDING_DIMENSIONS = dimensions
+    # OpenAI 替身不受真实配额限制，关闭网关限流，避免令牌桶等待计入延迟
+    Config.OPENAI_REQUESTS_PER_MINUTE = {}
+    Config.OPENAI_DEFAULT_REQUESTS_PER_MINUTE = None
+
+
+def seed_collection(size: int, dimensions: int, seed: int = 0):
+    """创建包含 size 个合成agent的集合，向量随机生成并归一化"""
+    from embedding_schema import current_schema
+
+    db_client = chromadb.PersistentClient(path=Config.PERSIST_DIR)
+    collection = db_client.create_collection(
+        name=Config.COLLECTION_NAME,
+        metadata={"description": "AI Agents benchmark", **current_schema()}
+    )
+    rng = np.random.default_rng(seed)
+    batch_size = db_client.get_max_batch_size()
+    for start in range(0, size, batch_size):
+        count = min(batch_size, size - start)
+        vectors = rng.standard_normal((count, dimensions)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        ids = [f"agent_{i:07d}" for i in range(start, start + count)]
+        collection.add(
+            ids=ids,
+            embeddings=vectors,
+            documents=[f"你是一名{CATEGORIES[i % len(CATEGORIES)]}领域的专业AI助手，编号 {i}。" for i in range(start, start + count)],
+            metadatas=[{"category": CATEGORIES[i % len(CATEGORIES)]} for i in range(start, start + count)]
+        )
+    return collection
+
+
+def bench_size(size: int, args) -> List[Dict]:
+    from init_data import ingest_agents
+    from retrieval import VectorRetriever
+
+    results = []
+
+    def record(operation: str, cache: str, stats: Dict):
+        results.append({"size": size, "operation": operation, "cache": cache, **stats})
+
+    start = time.perf_counter()
+    seed_collection(size, args.dimensions)
+    seed_seconds = time.perf_counter() - start
+
+    client = FakeOpenAI(
+        dimensions=args.dimensions,
+        embedding_latency=args.embedding_latency_ms / 1000,
+        chat_latency=args.chat_latency_ms / 1000
+    )
+    retriever = VectorRetriever(client=client)
+
+    queries = [f"基准查询 {size} {i}：我需要{CATEGORIES[i % len(CATEGORIES)]}方面的帮助" for i in range(args.queries)]
+    search = lambda query: retriever.search(query, top_k=args.top_k, min_score=args.min_score)
+    # 第一轮：结果缓存和嵌入缓存都为空；第二轮：相同查询命中缓存
+    record("search", "cold", measure(search, queries))
+    record("search", "warm", measure(search, queries))
+
+    prompts = [f"基准问题 {size} {i}：帮我规划{CATEGORIES[i % len(CATEGORIES)]}相关的事务" for i in range(args.queries)]
+    enhanced = lambda prompt: retriever.enhanced_search(prompt, top_k=args.top_k, min_score=args.min_score)
+    record("enhanced_search", "cold", measure(enhanced, prompts))
+    record("enhanced_search", "warm", measure(enhanced, prompts))
+
+    # 批量写入：新文档（需要嵌入和 upsert）与重复写入（全部按内容摘要跳过）
+    agents = [
+        {"id": f"ingest_{size}_{i:07d}", "system_prompt": f"批量写入测试agent {size}-{i}",
+         "category": CATEGORIES[i % len(CATEGORIES)]}
+        for i in range(args.ingest_count)
+    ]
+    batches = [agents[i:i + args.ingest_batch_size] for i in range(0, len(agents), args.ingest_batch_size)]
+    ingest = lambda batch: ingest_agents(batch, client, retriever.collection, batch_size=args.ingest_batch_size)
+    for cache in ("cold", "warm"):
+        stats = measure(ingest, batches)
+        stats["docs_per_second"] = round(len(agents) / (stats["n"] / stats["qps"]), 2) if stats["qps"] else None
+        record("ingest", cache, stats)
+
+    for item in results:
+        item["seed_seconds"] = round(seed_seconds, 3)
+    results.append({"size": size, "operation": "client_calls", **client.stats.as_dict()})
+    retriever.cache.close()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="检索热路径离线基准测试")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 10000, 100000], help="合成集合的agent数量")
+    parser.add_argument("--dimensions", type=int, default=256, help="合成向量维度")
+    parser.add_argument("--queries", type=int, default=200, help="每个场景的查询数")
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--min-score", type=float, default=-10.0, help="相似度阈值（随机向量下取较小值以保留结果）")
+    parser.add_argument("--embedding-latency-ms", type=float, default=0.0, help="模拟的嵌入请求延迟")
+    parser.add_argument("--chat-latency-ms", type=float, default=0.0, help="模拟的对话请求延迟")
+    parser.add_argument("--ingest-count", type=int, default=1000, help="批量写入测试的文档数")
+    parser.add_argument("--ingest-batch-size", type=int, default=100)
+    parser.add_argument("--output", help="JSON 结果输出路径，默认打印到标准输出")
+    args = parser.parse_args(argv)
+
+    report = {
+        "benchmark": "retrieval",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "backend": Config.VECTOR_BACKEND,
+        "params": vars(args),
+        "results": []
+    }
+    with tempfile.TemporaryDirectory(prefix="bench_retrieval_") as workdir:
+        for size in args.sizes:
+            configure(workdir, size, args.dimensions)
+            report["results"].extend(bench_size(size, args))
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+    return report
+
+
+if __name__ == "__main__":
+    main()
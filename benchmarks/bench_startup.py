@@ -0,0 +1,137 @@
+"""
+启动耗时基准测试
+
+每个入口模块在全新的子进程中导入若干次，统计导入耗时（以及构造 VectorRetriever 的耗时），
+并检查只导入检索模块时没有加载 gradio，openai / chromadb 也保持延迟状态。
+结果以 JSON 输出；任何检查未通过或超过 --max-import-ms 时以非零状态码退出，可用于 CI。
+
+用法：
+    python -m benchmarks.bench_startup --runs 5 --output startup.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ("gradio", "openai", "chromadb")
+
+# 导入后不允许真正加载的模块（延迟导入的模块在首次使用时才加载）
+EXPECTED_UNLOADED = {
+    "retrieval": HEAVY_MODULES,
+    "async_retrieval": HEAVY_MODULES,
+    "init_data": HEAVY_MODULES,
+    "main": HEAVY_MODULES
+}
+
+_PROBE = """
+import json, sys, time
+sys.path.insert(0, {root!r})
+start = time.perf_counter()
+import {module}
+result = {{"import_ms": (time.perf_counter() - start) * 1000}}
+from lazy_imports import is_loaded
+result["loaded"] = {{name: is_loaded(name) for name in {heavy!r}}}
+if {construct!r}:
+    from config.settings import Config
+    Config.PERSIST_DIR = {workdir!r}
+    Config.EMBEDDING_CACHE_PATH = {workdir!r} + "/embedding_cache.sqlite3"
+    Config.SHARED_CACHE_PATH = {workdir!r} + "/result_cache.sqlite3"
+    start = time.perf_counter()
+    retriever = {module}.VectorRetriever()
+    result["construct_ms"] = (time.perf_counter() - start) * 1000
+    result["loaded_after_construct"] = {{name: is_loaded(name) for name in {heavy!r}}}
+    retriever.cache.close()
+print(json.dumps(result))
+"""
+
+
+def probe(module: str, workdir: str, construct: bool = False) -> Dict:
+    """在全新的 Python 进程中导入 module，返回耗时和重量级依赖的加载情况"""
+    code = _PROBE.format(root=ROOT, module=module, heavy=HEAVY_MODULES, construct=construct, workdir=workdir)
+    start = time.perf_counter()
+    completed = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, cwd=ROOT, check=True)
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    result["process_ms"] = (time.perf_counter() - start) * 1000
+    return result
+
+
+def summarize(values: List[float]) -> Dict:
+    values = np.asarray(values, dtype=np.float64)
+    return {
+        "min_ms": round(float(values.min()), 2),
+        "p50_ms": round(float(np.percentile(values, 50)), 2),
+        "max_ms": round(float(values.max()), 2)
+    }
+
+
+def bench_module(module: str, args, workdir: str) -> Dict:
+    construct = module == "retrieval"
+    runs = [probe(module, workdir, construct) for _ in range(args.runs)]
+    report = {
+        "module": module,
+        "import": summarize([run["import_ms"] for run in runs]),
+        "process": summarize([run["process_ms"] for run in runs]),
+        "loaded": runs[-1]["loaded"]
+    }
+    if construct:
+        report["construct"] = summarize([run["construct_ms"] for run in runs])
+        report["loaded_after_construct"] = runs[-1]["loaded_after_construct"]
+
+    failures = [
+        f"导入 {module} 时加载了 {name}"
+        for name in EXPECTED_UNLOADED.get(module, ()) if report["loaded"].get(name)
+    ]
+    if construct:
+        failures += [
+            f"构造 VectorRetriever 时加载了 {name}"
+            for name, loaded in report["loaded_after_construct"].items() if loaded
+        ]
+    if args.max_import_ms is not None and report["import"]["p50_ms"] > args.max_import_ms:
+        failures.append(f"导入 {module} 的 p50 耗时 {report['import']['p50_ms']} ms 超过 {args.max_import_ms} ms")
+    report["failures"] = failures
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="启动耗时基准测试")
+    parser.add_argument("--modules", nargs="+", default=list(EXPECTED_UNLOADED), help="要测量的入口模块")
+    parser.add_argument("--runs", type=int, default=5, help="每个模块的子进程次数")
+    parser.add_argument("--max-import-ms", type=float, default=None, help="导入耗时 p50 的上限（毫秒）")
+    parser.add_argument("--output", help="JSON 结果输出路径，默认打印到标准输出")
+    args = parser.parse_args(argv)
+
+    report = {
+        "benchmark": "startup",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "params": vars(args),
+        "results": []
+    }
+    with tempfile.TemporaryDirectory(prefix="bench_startup_") as workdir:
+        for module in args.modules:
+            report["results"].append(bench_module(module, args, workdir))
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+    failures = [failure for result in report["results"] for failure in result["failures"]]
+    if failures:
+        print("\n".join(failures), file=sys.stderr)
+        sys.exit(1)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+离线基准测试使用的 OpenAI 替身
+- 嵌入：根据文本哈希生成确定性的单位向量
+- 对话：返回固定内容，支持 stream=True 和 JSON 模式（agent 生成）
+- 可配置模拟延迟，接口与 openai.OpenAI / openai.AsyncOpenAI 的用法保持一致
+"""
+import asyncio
+import hashlib
+import json
+import re
+import threading
+import time
+from types import SimpleNamespace
+from typing import List, Optional
+
+import numpy as np
+
+DEFAULT_RECOMMENDATION = "推荐Agent类型：金融分析师。从行业角度看，该领域涉及投资分析、风险评估和资产配置。"
+
+
+def fake_embedding(text: str, dimensions: int) -> List[float]:
+    """根据文本生成确定性的单位向量（同一文本总是得到同一向量）"""
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dimensions).astype(np.float32)
+    vector /= np.linalg.norm(vector)
+    return vector.tolist()
+
+
+def _chat_content(messages: list, response_format: Optional[dict]) -> str:
+    if response_format and response_format.get("type") == "json_object":
+        # agent 生成请求：按提示中的类别列表返回 JSON
+        match = re.search(r"类别列表: (\[.*?\])", messages[-1]["content"])
+        categories = json.loads(match.group(1).replace("'", '"')) if match else []
+        agents = [
+            {
+                "id": f"{category}_001",
+                "system_prompt": f"你是一名{category}领域的专业AI助手，能够解答该领域的各类问题。",
+                "category": category
+            }
+            for category in categories
+        ]
+        return json.dumps({"agents": agents}, ensure_ascii=False)
+    return DEFAULT_RECOMMENDATION
+
+
+def _stream_chunks(content: str, chunk_chars: int = 4):
+    for start in range(0, len(content), chunk_chars):
+        yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content[start:start + chunk_chars]))])
+
+
+class _Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.embedding_calls = 0
+        self.embedding_inputs = 0
+        self.chat_calls = 0
+
+    def as_dict(self) -> dict:
+        with self.lock:
+            return {
+                "embedding_calls": self.embedding_calls,
+                "embedding_inputs": self.embedding_inputs,
+                "chat_calls": self.chat_calls
+            }
+
+
+class FakeOpenAI:
+    """
+    同步 OpenAI 客户端替身
+    Args:
+        dimensions: 未在请求中指定 dimensions 时的向量维度
+        embedding_latency: 每次嵌入请求的模拟延迟（秒）
+        chat_latency: 每次对话请求的模拟延迟（秒）
+    """
+
+    def __init__(self, dimensions: int = 256, embedding_latency: float = 0.0, chat_latency: float = 0.0):
+        self.dimensions = dimensions
+        self.embedding_latency = embedding_latency
+        self.chat_latency = chat_latency
+        self.stats = _Stats()
+        self.embeddings = SimpleNamespace(create=self._create_embeddings)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create_chat))
+
+    def _embedding_response(self, input, dimensions: Optional[int]):
+        texts = [input] if isinstance(input, str) else list(input)
+        with self.stats.lock:
+            self.stats.embedding_calls += 1
+            self.stats.embedding_inputs += len(texts)
+        dims = dimensions or self.dimensions
+        return SimpleNamespace(data=[
+            SimpleNamespace(index=i, embedding=fake_embedding(text, dims)) for i, text in enumerate(texts)
+        ])
+
+    def _chat_response(self, messages, response_format, stream):
+        with self.stats.lock:
+            self.stats.chat_calls += 1
+        content = _chat_content(messages, response_format)
+        if stream:
+            return _stream_chunks(content)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+    def _create_embeddings(self, input, model: str = None, dimensions: Optional[int] = None, **kwargs):
+        time.sleep(self.embedding_latency)
+        return self._embedding_response(input, dimensions)
+
+    def _create_chat(self, messages, model: str = None, response_format: Optional[dict] = None,
+                     stream: bool = False, **kwargs):
+        time.sleep(self.chat_latency)
+        return self._chat_response(messages, response_format, stream)
+
+
+class _AsyncStream:
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._chunks)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class FakeAsyncOpenAI(FakeOpenAI):
+    """异步 OpenAI 客户端替身，延迟使用 asyncio.sleep 模拟"""
+
+    async def _create_embeddings(self, input, model: str = None, dimensions: Optional[int] = None, **kwargs):
+        await asyncio.sleep(self.embedding_latency)
+        return self._embedding_response(input, dimensions)
+
+    async def _create_chat(self, messages, model: str = None, response_format: Optional[dict] = None,
+                           stream: bool = False, **kwargs):
+        await asyncio.sleep(self.chat_latency)
+        response = self._chat_response(messages, response_format, stream)
+        return _AsyncStream(response) if stream else response
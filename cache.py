@@ -0,0 +1,602 @@
+import json
+import os
+import sqlite3
+import struct
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional
+
+import numpy as np
+
+
+def _approx_sizeof(obj: Any, _seen: Optional[set] = None) -> int:
+    """
+    粗略估算对象占用的内存字节数（递归统计容器内的元素）
+    """
+    if _seen is None:
+        _seen = set()
+    obj_id = id(obj)
+    if obj_id in _seen:
+        return 0
+    _seen.add(obj_id)
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += _approx_sizeof(key, _seen) + _approx_sizeof(value, _seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += _approx_sizeof(item, _seen)
+    elif hasattr(type(obj), "__slots__"):
+        # __slots__ 对象（如 SearchHit）：统计公开字段，下划线字段视为共享引用不计入
+        for name in type(obj).__slots__:
+            if not name.startswith("_"):
+                size += _approx_sizeof(getattr(obj, name, None), _seen)
+    return size
+
+
+class ResultCache:
+    """
+    有界的 LRU + TTL 缓存
+    - 同时限制条目数量和近似内存字节数，超出时淘汰最久未使用的条目
+    - 后台线程定期清理过期条目
+    - 统计命中/未命中/淘汰/过期次数，便于调整缓存大小
+    """
+
+    def __init__(self,
+                 ttl: float = 3600,
+                 max_entries: int = 1024,
+                 max_bytes: int = 64 * 1024 * 1024,
+                 sweep_interval: Optional[float] = 60):
+        """
+        Args:
+            ttl: 缓存过期时间（秒）
+            max_entries: 最大条目数
+            max_bytes: 近似最大内存占用（字节）
+            sweep_interval: 后台清理间隔（秒），为 None 或 0 时不启动后台线程
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # key -> (value, expire_at, size)
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        self._stop_event = threading.Event()
+        self._sweeper = None
+        if sweep_interval:
+            self._sweeper = threading.Thread(
+                target=self._sweep_loop,
+                args=(sweep_interval,),
+                name="ResultCacheSweeper",
+                daemon=True
+            )
+            self._sweeper.start()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """获取缓存值，未命中或已过期时返回 None"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expire_at, _ = entry
+            if time.monotonic() >= expire_at:
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        """写入缓存，必要时按 LRU 顺序淘汰旧条目"""
+        size = _approx_sizeof(value)
+        if size > self.max_bytes:
+            # 单个条目超过总容量，不缓存
+            return
+        expire_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, expire_at, size)
+            self._bytes += size
+            while len(self._data) > self.max_entries or self._bytes > self.max_bytes:
+                oldest_key = next(iter(self._data))
+                self._remove(oldest_key)
+                self.evictions += 1
+
+    def delete(self, key: Hashable):
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def purge_expired(self) -> int:
+        """清理所有过期条目，返回清理的数量"""
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, (_, expire_at, _) in self._data.items() if now >= expire_at]
+            for key in expired:
+                self._remove(key)
+            self.expirations += len(expired)
+        return len(expired)
+
+    def stats(self) -> Dict[str, Any]:
+        """返回缓存统计信息"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations
+            }
+
+    def close(self):
+        """停止后台清理线程"""
+        self._stop_event.set()
+        if self._sweeper is not None:
+            self._sweeper.join(timeout=1)
+            self._sweeper = None
+
+    def _remove(self, key: Hashable):
+        # 调用方需持有锁
+        _, _, size = self._data.pop(key)
+        self._bytes -= size
+
+    def _sweep_loop(self, interval: float):
+        while not self._stop_event.wait(interval):
+            self.purge_expired()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            entry = self._data.get(key)
+            return entry is not None and time.monotonic() < entry[1]
+
+
+def normalize_prompt(prompt: str) -> str:
+    """规范化用户输入：去除首尾空白、合并连续空白、统一小写"""
+    return " ".join(prompt.split()).lower()
+
+
+class RecommendationCache:
+    """
+    agent推荐结果缓存
+    - 精确层：以规范化后的prompt为键
+    - 语义层：新prompt的嵌入与已缓存prompt的余弦距离小于阈值时复用推荐结果
+    - 支持 TTL 和条目数上限（LRU 淘汰），并统计各层命中率
+    """
+
+    def __init__(self,
+                 ttl: float = 3600,
+                 max_entries: int = 1024,
+                 semantic_distance: Optional[float] = 0.05):
+        """
+        Args:
+            ttl: 缓存过期时间（秒）
+            max_entries: 最大条目数，为 0 时不缓存
+            semantic_distance: 语义层的最大余弦距离，为 None 时关闭语义层
+        """
+        if max_entries < 0:
+            raise ValueError(f"max_entries 不能为负数: {max_entries}")
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.semantic_distance = semantic_distance
+        # key -> (recommendation, expire_at, slot)
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        # 语义层：预分配的单位向量矩阵，每个条目占用一行（slot）
+        self._matrix = None
+        self._slot_keys: list = [None] * max_entries
+        self._free_slots = list(range(max_entries - 1, -1, -1))
+
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, prompt: str) -> Optional[str]:
+        """精确层查找，未命中时不计入 misses（调用方可能继续查语义层）"""
+        key = normalize_prompt(prompt)
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            recommendation, expire_at, _ = entry
+            if time.monotonic() >= expire_at:
+                self._remove(key)
+                return None
+            self._data.move_to_end(key)
+            self.exact_hits += 1
+            return recommendation
+
+    def get_similar(self, embedding) -> Optional[str]:
+        """语义层查找：返回余弦距离最近且在阈值内的已缓存推荐"""
+        if self.semantic_distance is None:
+            return None
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        with self._lock:
+            if self._matrix is None or norm == 0 or not self._data:
+                return None
+            similarities = self._matrix @ (vector / norm)
+            now = time.monotonic()
+            for slot in np.argsort(-similarities):
+                if 1 - similarities[slot] > self.semantic_distance:
+                    break
+                key = self._slot_keys[slot]
+                if key is None:
+                    continue
+                recommendation, expire_at, _ = self._data[key]
+                if now >= expire_at:
+                    self._remove(key)
+                    continue
+                self._data.move_to_end(key)
+                self.semantic_hits += 1
+                return recommendation
+            return None
+
+    def record_miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def set(self, prompt: str, recommendation: str, embedding=None):
+        """写入推荐结果；提供 embedding 时同时加入语义层"""
+        if self.max_entries == 0:
+            return
+        key = normalize_prompt(prompt)
+        expire_at = time.monotonic() + self.ttl
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            while len(self._data) >= self.max_entries:
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+            slot = None
+            if embedding is not None and self.semantic_distance is not None:
+                slot = self._store_vector(key, embedding)
+            self._data[key] = (recommendation, expire_at, slot)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.exact_hits + self.semantic_hits + self.misses
+            return {
+                "entries": len(self._data),
+                "max_entries": self.max_entries,
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "hit_rate": (self.exact_hits + self.semantic_hits) / total if total else 0.0,
+                "evictions": self.evictions
+            }
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._data):
+                self._remove(key)
+
+    def _store_vector(self, key: str, embedding) -> Optional[int]:
+        # 调用方需持有锁
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if norm == 0 or not self._free_slots:
+            return None
+        if self._matrix is None:
+            self._matrix = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+        slot = self._free_slots.pop()
+        self._matrix[slot] = vector / norm
+        self._slot_keys[slot] = key
+        return slot
+
+    def _remove(self, key: str):
+        # 调用方需持有锁
+        _, _, slot = self._data.pop(key)
+        if slot is not None:
+            # 空闲行清零，避免被语义查找命中
+            self._matrix[slot] = 0
+            self._slot_keys[slot] = None
+            self._free_slots.append(slot)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+# ---------------- 跨进程共享缓存 ----------------
+
+_RESULTS_FORMAT_VERSION = 1
+_HEADER = struct.Struct("<BI")  # 格式版本, 结果数
+_ITEM = struct.Struct("<HdII")  # id 长度, score, document 长度, 其余字段 JSON 长度
+_CORE_FIELDS = ("id", "score", "document")
+
+
+def encode_results(results: List[Dict]) -> bytes:
+    """
+    把检索结果列表序列化为紧凑的二进制格式
+    id / score / document 按定长头 + UTF-8 字节存储，metadata 等其余字段存为紧凑 JSON
+    """
+    parts = [_HEADER.pack(_RESULTS_FORMAT_VERSION, len(results))]
+    for result in results:
+        id_bytes = result["id"].encode("utf-8")
+        document_bytes = (result.get("document") or "").encode("utf-8")
+        extra = {key: value for key, value in result.items() if key not in _CORE_FIELDS}
+        extra_bytes = json.dumps(extra, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        parts.append(_ITEM.pack(len(id_bytes), float(result["score"]), len(document_bytes), len(extra_bytes)))
+        parts.extend((id_bytes, document_bytes, extra_bytes))
+    return b"".join(parts)
+
+
+def decode_results(data: bytes) -> List[Dict]:
+    """encode_results 的逆操作"""
+    view = memoryview(data)
+    format_version, count = _HEADER.unpack_from(view, 0)
+    if format_version != _RESULTS_FORMAT_VERSION:
+        raise ValueError(f"不支持的检索结果序列化版本: {format_version}")
+    offset = _HEADER.size
+    results = []
+    for _ in range(count):
+        id_length, score, document_length, extra_length = _ITEM.unpack_from(view, offset)
+        offset += _ITEM.size
+        doc_id = bytes(view[offset:offset + id_length]).decode("utf-8")
+        offset += id_length
+        document = bytes(view[offset:offset + document_length]).decode("utf-8")
+        offset += document_length
+        extra = json.loads(bytes(view[offset:offset + extra_length]).decode("utf-8"))
+        offset += extra_length
+        results.append({"id": doc_id, "score": score, "document": document, **extra})
+    return results
+
+
+class SQLiteSharedCache:
+    """
+    本机多进程共享的字节缓存，基于 SQLite WAL（并发读不阻塞，写入串行化）
+    - 条目带过期时间，读取时忽略已过期的条目
+    - 每写入 trim_every 次清理一次过期条目，并把条目数限制在 max_entries 以内（先写入的先淘汰）
+    """
+
+    def __init__(self, path: str, ttl: float = 3600, max_entries: int = 100000, trim_every: int = 256):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.trim_every = trim_every
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._writes = 0
+        # timeout：其他进程持有写锁时的最长等待时间
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                expire_at REAL NOT NULL
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_expire_at ON cache (expire_at)")
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM cache WHERE key = ? AND expire_at > ?", (key, time.time())
+            ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None):
+        expire_at = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expire_at) VALUES (?, ?, ?)",
+                (key, sqlite3.Binary(value), expire_at)
+            )
+            self._writes += 1
+            if self._writes % self.trim_every == 0:
+                self._trim()
+            self._conn.commit()
+
+    def _trim(self):
+        # 调用方需持有锁
+        self._conn.execute("DELETE FROM cache WHERE expire_at <= ?", (time.time(),))
+        overflow = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0] - self.max_entries
+        if overflow > 0:
+            self._conn.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY expire_at LIMIT ?)",
+                (overflow,)
+            )
+
+    def delete(self, key: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM cache")
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM cache WHERE expire_at > ?", (time.time(),)
+            ).fetchone()[0]
+
+
+class RedisSharedCache:
+    """
+    Redis 兼容服务上的字节缓存，过期由服务端的 EX 参数处理
+    client 只需提供 get / set(key, value, ex=...) / delete / scan_iter，
+    可以是 redis.Redis，也可以是任何实现了 Redis 协议的本地服务的客户端
+    """
+
+    def __init__(self, client, ttl: float = 3600, prefix: str = "aiagent:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url: str, **kwargs) -> "RedisSharedCache":
+        try:
+            import redis
+        except ImportError:
+            raise ImportError("使用 Redis 共享缓存需要安装 redis: pip install redis")
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.client.get(self.prefix + key)
+
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None):
+        self.client.set(self.prefix + key, value, ex=max(1, int(self.ttl if ttl is None else ttl)))
+
+    def delete(self, key: str):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self.prefix + "*"))
+        if keys:
+            self.client.delete(*keys)
+
+    def close(self):
+        close = getattr(self.client, "close", None)
+        if close is not None:
+            close()
+
+
+class TieredCache:
+    """
+    两级检索结果缓存：进程内 ResultCache（L1）+ 跨进程共享的字节缓存（L2）
+    - L1 未命中时读 L2，命中后解码并回填 L1
+    - 写入时同时写 L1 和 L2（L2 中存储 encode 的二进制格式，默认 encode_results）
+    - clear() 只清空 L1：L2 的键包含集合版本号，旧版本条目不会被命中，由 TTL 和容量上限淘汰；
+      需要清空 L2 时调用 clear_shared()
+    接口与 ResultCache 相同
+    """
+
+    def __init__(self, local: ResultCache, shared,
+                 encode: Callable[[Any], bytes] = encode_results,
+                 decode: Callable[[bytes], Any] = decode_results):
+        self.local = local
+        self.shared = shared
+        self.encode = encode
+        self.decode = decode
+        self.ttl = local.ttl
+        self._lock = threading.Lock()
+        self.shared_hits = 0
+        self.shared_misses = 0
+        self.shared_errors = 0
+
+    def get(self, key: str) -> Optional[List[Dict]]:
+        value = self.local.get(key)
+        if value is not None:
+            return value
+        try:
+            data = self.shared.get(key)
+            value = self.decode(data) if data is not None else None
+        except Exception:
+            # 共享缓存不可用时退化为只用进程内缓存
+            with self._lock:
+                self.shared_errors += 1
+            return None
+        with self._lock:
+            if value is None:
+                self.shared_misses += 1
+            else:
+                self.shared_hits += 1
+        if value is not None:
+            self.local.set(key, value)
+        return value
+
+    def set(self, key: str, value: List[Dict], ttl: Optional[float] = None):
+        self.local.set(key, value, ttl)
+        try:
+            self.shared.set(key, self.encode(value), ttl)
+        except Exception:
+            with self._lock:
+                self.shared_errors += 1
+
+    def delete(self, key: str):
+        self.local.delete(key)
+        self.shared.delete(key)
+
+    def clear(self):
+        self.local.clear()
+
+    def clear_shared(self):
+        self.local.clear()
+        self.shared.clear()
+
+    def purge_expired(self) -> int:
+        return self.local.purge_expired()
+
+    def stats(self) -> Dict[str, Any]:
+        stats = self.local.stats()
+        with self._lock:
+            stats.update({
+                "shared_hits": self.shared_hits,
+                "shared_misses": self.shared_misses,
+                "shared_errors": self.shared_errors
+            })
+        return stats
+
+    def close(self):
+        self.local.close()
+        self.shared.close()
+
+    def __len__(self) -> int:
+        return len(self.local)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.local
+
+
+def create_result_cache(backend: str = "memory",
+                        ttl: float = 3600,
+                        max_entries: int = 1024,
+                        max_bytes: int = 64 * 1024 * 1024,
+                        sweep_interval: Optional[float] = 60,
+                        shared_path: Optional[str] = None,
+                        shared_url: Optional[str] = None,
+                        shared_max_entries: int = 100000,
+                        encode: Callable[[Any], bytes] = encode_results,
+                        decode: Callable[[bytes], Any] = decode_results):
+    """
+    创建检索结果缓存
+    - "memory"：只用进程内 ResultCache
+    - "sqlite"：ResultCache + 本机 SQLite 共享缓存（shared_path）
+    - "redis"：ResultCache + Redis 兼容服务（shared_url）
+    encode / decode 为共享层使用的序列化函数
+    """
+    local = ResultCache(ttl=ttl, max_entries=max_entries, max_bytes=max_bytes, sweep_interval=sweep_interval)
+    if backend == "memory":
+        return local
+    if backend == "sqlite":
+        shared = SQLiteSharedCache(shared_path, ttl=ttl, max_entries=shared_max_entries)
+        return TieredCache(local, shared, encode, decode)
+    if backend == "redis":
+        return TieredCache(local, RedisSharedCache.from_url(shared_url, ttl=ttl), encode, decode)
+    raise ValueError(f"未知的共享缓存后端: {backend}")
@@ -0,0 +1,252 @@
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from config.settings import Config
+
+logger = logging.getLogger("aiagent_log")
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1), 1e-12)[:, None]
+
+
+class CategoryCentroids:
+    """
+    各类别的质心向量：保存类别下所有agent归一化嵌入之和与数量，质心 = 和 / 数量
+    - 另外记录没有类别字段的agent数（旧数据或绕过 init_data 的写入），路由时这些agent始终保留在候选中
+    - 保存在 PERSIST_DIR/category_centroids.npz，写入/删除agent时增量维护（init_data）
+    - 文件不存在或与集合不一致时可以从集合重新构建
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or os.path.join(Config.PERSIST_DIR, "category_centroids.npz")
+        self._lock = threading.Lock()
+        self._index: Dict[str, int] = {}
+        self.categories: List[str] = []
+        self.sums = np.zeros((0, 0), dtype=np.float64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.uncategorized = 0
+        # 每次变化递增，路由器据此判断是否需要重新计算质心矩阵
+        self.generation = 0
+        self._mtime = None
+        self.load()
+
+    def load(self) -> bool:
+        """从文件加载（文件未变化时跳过），文件不存在时返回 False"""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return False
+        with self._lock:
+            if mtime == self._mtime:
+                return True
+            with np.load(self.path, allow_pickle=False) as data:
+                categories = [str(category) for category in data["categories"]]
+                sums = data["sums"].astype(np.float64)
+                counts = data["counts"].astype(np.int64)
+                # 旧版本的文件没有记录，按 0 处理（与集合条目数不一致时路由器会重新构建）
+                uncategorized = int(data["uncategorized"]) if "uncategorized" in data.files else 0
+            self._set(categories, sums, counts, uncategorized)
+            self._mtime = mtime
+        return True
+
+    def save(self):
+        """原子地写入文件（先写临时文件再替换）"""
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self._lock:
+            tmp_path = f"{self.path}.{os.getpid()}.tmp.npz"
+            np.savez(tmp_path, categories=np.asarray(self.categories, dtype=str), sums=self.sums, counts=self.counts,
+                     uncategorized=np.asarray(self.uncategorized))
+            os.replace(tmp_path, self.path)
+            self._mtime = os.stat(self.path).st_mtime_ns
+
+    def _set(self, categories: List[str], sums: np.ndarray, counts: np.ndarray, uncategorized: int = 0):
+        # 调用方需持有锁
+        self.categories = categories
+        self._index = {category: i for i, category in enumerate(categories)}
+        self.sums = sums
+        self.counts = counts
+        self.uncategorized = uncategorized
+        self.generation += 1
+
+    def update(self, categories: Sequence[str], embeddings: Sequence,
+               old_categories: Sequence[str] = (), old_embeddings: Sequence = ()):
+        """
+        增量更新：加入新写入的 (类别, 嵌入)，减去被覆盖或删除的旧 (类别, 嵌入)
+        """
+        with self._lock:
+            for sign, batch_categories, batch_embeddings in ((-1, old_categories, old_embeddings),
+                                                             (1, categories, embeddings)):
+                if len(batch_categories) == 0:
+                    continue
+                vectors = _normalize(np.asarray(batch_embeddings, dtype=np.float64))
+                if self.sums.shape[1] != vectors.shape[1]:
+                    if self.sums.shape[1] != 0:
+                        # 嵌入维度变化（更换了嵌入模型），旧质心作废
+                        logger.warning("嵌入维度变化，类别质心已重置")
+                    self._set([], np.zeros((0, vectors.shape[1])), np.zeros(0, dtype=np.int64))
+                for category, vector in zip(batch_categories, vectors):
+                    if category is None:
+                        self.uncategorized = max(self.uncategorized + sign, 0)
+                        continue
+                    row = self._index.get(category)
+                    if row is None:
+                        if sign < 0:
+                            continue
+                        row = len(self.categories)
+                        self.categories.append(category)
+                        self._index[category] = row
+                        self.sums = np.vstack([self.sums, np.zeros(vectors.shape[1])])
+                        self.counts = np.append(self.counts, 0)
+                    self.sums[row] += sign * vector
+                    self.counts[row] = max(self.counts[row] + sign, 0)
+            self.generation += 1
+
+    def rebuild(self, collection):
+        """从集合的全部向量重新计算质心"""
+        start = time.perf_counter()
+        data = collection.get(include=["embeddings", "metadatas"])
+        with self._lock:
+            self._set([], np.zeros((0, 0)), np.zeros(0, dtype=np.int64))
+        if len(data["ids"]):
+            self.update([(metadata or {}).get("category") for metadata in data["metadatas"]], data["embeddings"])
+        logger.info(f"类别质心重新构建完成：{len(self)} 个类别，耗时 {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    def centroids(self):
+        """返回 (类别列表, 行归一化的质心矩阵)，不包含已没有agent的类别"""
+        with self._lock:
+            kept = np.flatnonzero(self.counts > 0)
+            return [self.categories[i] for i in kept], _normalize(self.sums[kept])
+
+    def total(self) -> int:
+        """质心覆盖的agent总数（只统计有类别的agent）"""
+        return int(self.counts.sum())
+
+    def size(self) -> int:
+        """记录的agent总数（包括没有类别的agent），应与集合条目数一致"""
+        return self.total() + self.uncategorized
+
+    def __len__(self) -> int:
+        return int(np.count_nonzero(self.counts))
+
+
+_centroids: Dict[str, CategoryCentroids] = {}
+_centroids_lock = threading.Lock()
+
+
+def get_category_centroids(path: Optional[str] = None) -> CategoryCentroids:
+    """获取进程内共享的类别质心（同一路径只加载一次），默认保存在 Config.PERSIST_DIR 下"""
+    path = path or os.path.join(Config.PERSIST_DIR, "category_centroids.npz")
+    key = os.path.abspath(path)
+    with _centroids_lock:
+        centroids = _centroids.get(key)
+        if centroids is None:
+            centroids = CategoryCentroids(path)
+            _centroids[key] = centroids
+        return centroids
+
+
+class CategoryRouter:
+    """
+    两阶段检索的第一阶段：查询向量与类别质心做一次矩阵乘法，选出最相近的 top_n 个类别，
+    向量检索只在这些类别中进行（where category $in ...）
+    - top_n 越大召回越高、候选集越大；类别总数不超过 min_categories 时不做路由
+    - 集合中有没有类别字段的agent时，路由条件同时保留这些agent（category 不属于任何已知类别）
+    - 质心由 init_data 在写入/删除时增量维护；集合版本号变化时只重新加载质心文件，
+      并用记录的agent总数与 collection.count() 比较，不一致（有写入绕过了 init_data）时才从集合重新构建
+    """
+
+    def __init__(self, collection, centroids: Optional[CategoryCentroids] = None, version=None,
+                 top_n: int = Config.CATEGORY_ROUTING_TOP_N,
+                 min_categories: int = Config.CATEGORY_ROUTING_MIN_CATEGORIES):
+        self.collection = collection
+        self.centroids = centroids if centroids is not None else get_category_centroids()
+        # 集合版本号（collection_version.CollectionVersion），为 None 时只在构造时检查一次
+        self.version = version
+        self.top_n = top_n
+        self.min_categories = min_categories
+        self._loaded_version = None
+        self._matrix_generation = None
+        self._categories: List[str] = []
+        self._matrix = np.zeros((0, 0))
+        self._lock = threading.Lock()
+        if self.top_n:
+            self._sync()
+
+    def _sync(self):
+        """加载最新的质心文件，并在质心与集合不一致时重新构建"""
+        self._loaded_version = self.version.get(self.collection.name) if self.version is not None else None
+        self.centroids.load()
+        # 条目数不一致说明质心文件缺失，或有写入绕过了 init_data；只比较条目数，不扫描集合元数据
+        if self.centroids.size() != self.collection.count():
+            self.centroids.rebuild(self.collection)
+            self.centroids.save()
+
+    def _maybe_reload(self):
+        if self.version is not None and self.version.get(self.collection.name) != self._loaded_version:
+            with self._lock:
+                if self.version.get(self.collection.name) != self._loaded_version:
+                    self._sync()
+
+    def _current_matrix(self):
+        if self._matrix_generation != self.centroids.generation:
+            with self._lock:
+                generation = self.centroids.generation
+                self._categories, self._matrix = self.centroids.centroids()
+                self._matrix_generation = generation
+        return self._categories, self._matrix
+
+    def route_each(self, query_embeddings: Sequence) -> Optional[List[List[str]]]:
+        """
+        为每个查询向量分别选出最相近的 top_n 个类别（按质心顺序排列，便于合并相同的路由结果）
+        Returns:
+            与查询一一对应的类别列表；不需要路由（类别太少或未配置）时返回 None
+        """
+        if not self.top_n:
+            return None
+        self._maybe_reload()
+        categories, matrix = self._current_matrix()
+        if len(categories) <= max(self.min_categories, self.top_n):
+            return None
+        queries = np.asarray(query_embeddings, dtype=np.float64).reshape(-1, matrix.shape[1])
+        similarities = queries @ matrix.T  # (m, 类别数)，质心已归一化，查询向量的模长不影响排序
+        top = np.sort(np.argpartition(-similarities, self.top_n - 1, axis=1)[:, :self.top_n], axis=1)
+        return [[categories[i] for i in row] for row in top]
+
+    def route(self, query_embeddings: Sequence) -> Optional[List[str]]:
+        """为一个或多个查询向量选出最相近的类别；多个查询时返回各自结果的并集"""
+        routed = self.route_each(query_embeddings)
+        if routed is None:
+            return None
+        return list(dict.fromkeys(category for row in routed for category in row))
+
+    def _merge(self, filters: Optional[Dict], categories: Optional[List[str]]) -> Optional[Dict]:
+        if categories is None:
+            return filters
+        routed = {"category": {"$in": categories}}
+        if self.centroids.uncategorized:
+            # $nin 同时匹配没有 category 字段的agent，避免它们在路由后永远检索不到
+            routed = {"$or": [routed, {"category": {"$nin": self._categories}}]}
+        return {"$and": [filters, routed]} if filters else routed
+
+    def apply(self, query_embeddings: Sequence, filters: Optional[Dict]) -> Optional[Dict]:
+        """
+        把路由结果与调用方的过滤条件合并为 where；调用方已经按类别过滤时不做路由
+        """
+        if filters and "category" in filters:
+            return filters
+        return self._merge(filters, self.route(query_embeddings))
+
+    def apply_each(self, query_embeddings: Sequence, filters: Optional[Dict]) -> List[Optional[Dict]]:
+        """同 apply，但每个查询只在自己的 top_n 类别中检索，返回与查询一一对应的 where"""
+        if filters and "category" in filters:
+            return [filters] * len(query_embeddings)
+        routed = self.route_each(query_embeddings)
+        if routed is None:
+            return [filters] * len(query_embeddings)
+        return [self._merge(filters, categories) for categories in routed]
@@ -0,0 +1,100 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+from config.settings import Config
+
+
+class CollectionVersion:
+    """
+    集合版本号：每次 add/upsert/delete 后递增
+    版本号保存在 PERSIST_DIR 下的 SQLite 文件中，多个进程共享同一份数据时都能看到变化
+    读取结果在进程内缓存 check_interval 秒，避免每次检索都访问 SQLite
+    """
+
+    def __init__(self, path: Optional[str] = None,
+                 check_interval: float = Config.COLLECTION_VERSION_CHECK_INTERVAL):
+        path = path or os.path.join(Config.PERSIST_DIR, "collection_version.sqlite3")
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._open_lock = threading.Lock()
+        # collection -> (版本号, 读取时间)
+        self._cached: Dict[str, tuple] = {}
+        self._connection: Optional[sqlite3.Connection] = None
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        """首次读写时才创建目录并打开 SQLite，创建实例本身不访问磁盘"""
+        if self._connection is None:
+            with self._open_lock:
+                if self._connection is None:
+                    os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                    conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    conn.execute(
+                        """CREATE TABLE IF NOT EXISTS collection_versions (
+                            collection TEXT PRIMARY KEY,
+                            version INTEGER NOT NULL
+                        )"""
+                    )
+                    self._connection = conn
+        return self._connection
+
+    def _read(self, collection: str) -> int:
+        row = self._conn.execute(
+            "SELECT version FROM collection_versions WHERE collection = ?", (collection,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def get(self, collection: str) -> int:
+        """读取集合当前版本号，从未写入过的集合为 0"""
+        now = time.monotonic()
+        with self._lock:
+            cached = self._cached.get(collection)
+            if cached is not None and now - cached[1] < self.check_interval:
+                return cached[0]
+            version = self._read(collection)
+            self._cached[collection] = (version, now)
+            return version
+
+    def bump(self, collection: str) -> int:
+        """集合数据变化后调用，原子地递增版本号并返回新版本号"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "INSERT INTO collection_versions (collection, version) VALUES (?, 1) "
+                    "ON CONFLICT(collection) DO UPDATE SET version = version + 1",
+                    (collection,)
+                )
+                version = self._read(collection)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._cached[collection] = (version, time.monotonic())
+            return version
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+
+
+_versions: Dict[str, CollectionVersion] = {}
+_versions_lock = threading.Lock()
+
+
+def get_collection_version(path: Optional[str] = None) -> CollectionVersion:
+    """获取进程内共享的版本号实例（同一路径只打开一次），默认保存在 Config.PERSIST_DIR 下"""
+    path = path or os.path.join(Config.PERSIST_DIR, "collection_version.sqlite3")
+    key = os.path.abspath(path)
+    with _versions_lock:
+        version = _versions.get(key)
+        if version is None:
+            version = CollectionVersion(path)
+            _versions[key] = version
+        return version
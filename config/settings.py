@@ -5,8 +5,132 @@ load_dotenv()
 
 class Config:
     OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+    # 嵌入提供方："openai" 调用 OpenAI 嵌入接口；"local" 使用本地 CPU 模型，查询不依赖网络
+    EMBEDDING_PROVIDER = "openai"
     EMBEDDING_MODEL = "text-embedding-3-small"
+    # 降维后的嵌入维度（仅 text-embedding-3 系列支持），None 表示使用模型原生维度
+    EMBEDDING_DIMENSIONS = None
+    LOCAL_EMBEDDING_MODEL = "all-MiniLM-L6-v2"  # 本地嵌入模型（Chroma 自带的 ONNX 版本，384 维）
+    LOCAL_EMBEDDING_BATCH_SIZE = 32  # 本地模型单次推理的文本数
+    LOCAL_EMBEDDING_WORKERS = 4  # 本地模型并行推理的线程数
     
     # ChromaDB配置
     COLLECTION_NAME = "ai_agents"
     PERSIST_DIR = "./chroma_db"
+    # 持久化嵌入缓存（SQLite），放在向量数据库目录下（首次读写时才创建）
+    EMBEDDING_CACHE_PATH = os.path.join(PERSIST_DIR, "embedding_cache.sqlite3")
+    EMBEDDING_BATCH_SIZE = 512  # 单次嵌入请求的最大文本数
+    EMBEDDING_MEMORY_CACHE_ENTRIES = 4096  # 嵌入缓存的进程内 LRU 条目数（SQLite 之前的一级缓存），0 表示关闭
+    # 集合版本号保存在 PERSIST_DIR/collection_version.sqlite3，写入时递增，结果缓存据此失效
+    COLLECTION_VERSION_CHECK_INTERVAL = 1.0  # 读取版本号的进程内缓存时间（秒），即其他进程写入后最长的感知延迟
+
+    # agent写入配置
+    INGEST_BATCH_SIZE = 100  # 每批 upsert 的文档数
+
+    # agent生成配置
+    GENERATION_CHUNK_SIZE = 10  # 每次 gpt-4o 调用生成的类别数
+    GENERATION_MAX_WORKERS = 4  # 并发生成的最大线程数
+    GENERATION_MAX_RETRIES = 5  # 限流等可重试错误的最大重试次数
+    GENERATION_RETRY_BASE_DELAY = 1.0  # 指数退避的初始等待时间（秒）
+
+    # OpenAI 网关：所有对话、流式对话和嵌入请求共用连接池、限流和重试（openai_gateway.py）
+    OPENAI_MAX_CONNECTIONS = 100  # 连接池最大连接数
+    OPENAI_MAX_KEEPALIVE_CONNECTIONS = 20  # 保持 keep-alive 的空闲连接数
+    OPENAI_TIMEOUT = 60.0  # 单次请求超时（秒）
+    OPENAI_CONNECT_TIMEOUT = 5.0  # 建立连接超时（秒）
+    OPENAI_MAX_RETRIES = 3  # 可重试错误的默认重试次数（agent生成使用 GENERATION_MAX_RETRIES）
+    OPENAI_RETRY_BASE_DELAY = 0.5  # 指数退避的初始等待时间（秒）
+    # 每个模型每分钟的请求数上限（令牌桶），未列出的模型使用默认值
+    OPENAI_REQUESTS_PER_MINUTE = {
+        "gpt-4o": 500,
+        "text-embedding-3-small": 3000,
+        "text-embedding-3-large": 3000,
+        "text-embedding-ada-002": 3000
+    }
+    OPENAI_DEFAULT_REQUESTS_PER_MINUTE = 500  # 为 None 时未列出的模型不限流
+    OPENAI_RATE_LIMIT_BURST_SECONDS = 2  # 令牌桶容量 = 每秒请求数 * 该秒数，允许的突发请求量
+    # 嵌入对冲请求：超过最近耗时的分位数仍未返回时再发一个相同请求，取先返回的结果
+    OPENAI_HEDGE_EMBEDDINGS = True
+    OPENAI_HEDGE_PERCENTILE = 95
+    OPENAI_HEDGE_DELAY_MS = 1000  # 耗时样本不足时的对冲等待时间（毫秒）
+    OPENAI_HEDGE_MIN_DELAY_MS = 100  # 对冲等待时间的下限（毫秒）
+    OPENAI_HEDGE_WORKERS = 16  # 同步嵌入对冲请求的线程池大小，没有空闲线程时不做对冲
+
+    # 检索结果缓存配置
+    CACHE_TTL = 3600  # 缓存过期时间（秒）
+    CACHE_MAX_ENTRIES = 1024  # 最大缓存条目数
+    CACHE_MAX_BYTES = 64 * 1024 * 1024  # 近似最大内存占用（字节）
+    CACHE_SWEEP_INTERVAL = 60  # 后台清理过期条目的间隔（秒）
+    # 多 worker 部署的共享结果缓存："memory" 只用进程内缓存；"sqlite" 本机 SQLite（WAL）；"redis" Redis 兼容服务
+    SHARED_CACHE_BACKEND = "memory"
+    SHARED_CACHE_PATH = os.path.join(PERSIST_DIR, "result_cache.sqlite3")
+    SHARED_CACHE_URL = "redis://127.0.0.1:6379/0"
+    SHARED_CACHE_MAX_ENTRIES = 100000  # SQLite 共享缓存的最大条目数
+    # 检索结果只缓存 id / 分数 / 元数据，agent文档（system prompt）按需加载并单独缓存
+    DOCUMENT_CACHE_MAX_ENTRIES = 1024  # 进程内文档缓存的最大条目数
+
+    # agent推荐缓存配置
+    RECOMMEND_CACHE_TTL = 3600  # 推荐结果缓存过期时间（秒）
+    RECOMMEND_CACHE_MAX_ENTRIES = 2048  # 推荐结果缓存最大条目数
+    RECOMMEND_CACHE_SEMANTIC_DISTANCE = 0.05  # 语义复用的最大余弦距离，为 None 时只做精确匹配
+    # 为 True 时推荐调用使用确定性生成参数（temperature=0 + 固定 seed），便于缓存复用；
+    # 默认保持原有的采样温度，开启后同一 prompt 的推荐结果不再随机变化
+    RECOMMEND_DETERMINISTIC = False
+    RECOMMEND_TEMPERATURE = 0.7  # 非确定性模式下的采样温度
+    RECOMMEND_SEED = 42
+
+    # 检索后端配置："chroma" 使用 HNSW 索引，"numpy" 使用内存精确检索（适合小规模集合），"quantized" 见下方量化配置
+    VECTOR_BACKEND = "chroma"
+    NUMPY_BACKEND_RELOAD_INTERVAL = 30  # NumPy 后端检查集合是否变化的间隔（秒），为 0 时只在调用 reload() 时重新加载
+    # "quantized" 量化检索：只扫描 int8 / 二值编码，全精度向量保存在内存映射文件中，只读取候选行做重打分
+    # 索引文件保存在 PERSIST_DIR/quantized/，集合版本号变化时重新构建
+    QUANTIZED_METHOD = "int8"  # "int8" 每维 1 字节（float32 的 1/4）；"binary" 每维 1 位（1/32），召回更依赖重打分
+    QUANTIZED_RESCORE_FACTOR = 10  # 按量化分数保留 n_results * 该倍数个候选，再用全精度向量重新打分
+    QUANTIZED_SCAN_CHUNK = 4096  # 编码分块参与计算的行数，限制扫描时的临时内存
+
+    # 混合检索配置
+    # "vector" 纯向量检索；"hybrid" BM25 与向量结果做倒数排名融合；"lexical" 只用本地 BM25 索引（不调用嵌入接口）
+    SEARCH_MODE = "vector"
+    LEXICAL_RELOAD_INTERVAL = 30  # BM25 索引检查集合是否变化的间隔（秒），为 0 时只在写入和调用 reload() 时更新
+    BM25_K1 = 1.5
+    BM25_B = 0.75
+    HYBRID_RRF_K = 60  # 倒数排名融合的平滑常数
+    # 关键词快速路径：hybrid 模式下 BM25 归一化分数达到阈值、且明显领先第二名时直接返回，不调用嵌入接口
+    LEXICAL_FAST_PATH_MIN_SCORE = 0.6  # 为 None 时关闭快速路径
+    LEXICAL_FAST_PATH_MARGIN = 1.5  # 第一名与第二名 BM25 分数之比的下限
+
+    # 类别路由：先用类别质心（PERSIST_DIR/category_centroids.npz）选出最相近的类别，再只在这些类别中做向量检索
+    CATEGORY_ROUTING_TOP_N = 3  # 每个查询保留的类别数，越大召回越高、越慢；0 表示关闭路由
+    CATEGORY_ROUTING_MIN_CATEGORIES = 12  # 类别总数不超过该值时不做路由（小集合全量检索已经足够快）
+    # 启用路由的检索后端：numpy / quantized 后端只对候选行计算距离；Chroma 的元数据预过滤有固定开销，数千条规模下比全量 HNSW 更慢
+    CATEGORY_ROUTING_BACKENDS = ("numpy", "quantized")
+
+    # 重排序配置：检索多取的候选（top_k * 2）依次经过以下阶段后截取 top_k
+    # "priority" 按元数据优先级加权；"mmr" 最大边际相关性，避免返回几乎相同的agent；"category_dedup" 同类别去重
+    # "mmr" 需要向量库随检索结果一并返回候选向量，默认不开启，按需加入
+    RERANK_STAGES = ("priority",)
+    RERANK_PRIORITY_FIELD = "priority"
+    RERANK_PRIORITY_WEIGHT = 0.1  # 排序分数 = 相似度 + 权重 * 优先级
+    RERANK_MMR_LAMBDA = 0.7  # 相关性的权重，1 表示不考虑多样性
+    RERANK_CATEGORY_FIELD = "category"
+    RERANK_MAX_PER_CATEGORY = 1  # category_dedup 阶段同一类别最多保留的结果数
+
+    # 离线批量路由配置（batch_route.py）
+    BATCH_ROUTE_BATCH_SIZE = 64  # 每批处理的输入行数，每批写完后更新一次检查点
+    BATCH_ROUTE_CONCURRENCY = 8  # 并发的 agent 推荐请求数（同时受 OpenAI 网关限流约束）
+    BATCH_ROUTE_DEDUP_ENTRIES = 100000  # 内存中保留的已路由提示词数（LRU），其余从输出旁的 SQLite 读取
+
+    # 异步检索配置
+    ASYNC_CHROMA_WORKERS = 8  # 执行 Chroma 查询的线程池大小
+
+    # 流式回答配置
+    STREAM_FLUSH_INTERVAL_MS = 50  # 流式回答刷新到界面的最小间隔（毫秒）
+
+    # 指标与性能分析配置
+    METRICS_ENABLED = True
+    METRICS_HOST = "127.0.0.1"
+    METRICS_PORT = 9464  # Prometheus 抓取 /metrics 的端口
+    PROFILE_SLOW_REQUEST_MS = None  # 慢请求采样分析阈值（毫秒），None 表示关闭
+    PROFILE_SAMPLE_INTERVAL_MS = 5  # 调用栈采样间隔（毫秒）
+    PROFILE_STACK_DEPTH = 12  # 每个采样保留的栈深度
+    PROFILE_TOP_STACKS = 5  # 慢请求日志中输出的热点调用栈数量
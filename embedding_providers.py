@@ -0,0 +1,157 @@
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+from config.settings import Config
+from embedding_schema import embedding_store_key
+from metrics import record_usage
+from openai_gateway import as_gateway
+
+logger = logging.getLogger("aiagent_log")
+
+
+class OpenAIEmbeddingProvider:
+    """
+    OpenAI 嵌入接口，请求经过 OpenAI 网关（连接池、限流、重试和对冲请求）
+    client 可以是网关、OpenAI（使用 embed）或 AsyncOpenAI（使用 aembed），为 None 时使用共享网关
+    """
+
+    name = "openai"
+
+    def __init__(self, client=None, model: Optional[str] = None, dimensions: Optional[int] = None):
+        self.gateway = as_gateway(client)
+        self.model = model or Config.EMBEDDING_MODEL
+        self.dimensions = Config.EMBEDDING_DIMENSIONS if dimensions is None else dimensions
+
+    @property
+    def store_key(self) -> str:
+        return embedding_store_key(self.model, self.dimensions)
+
+    def _params(self) -> dict:
+        # 只有指定了降维维度时才传 dimensions
+        params = {"model": self.model}
+        if self.dimensions:
+            params["dimensions"] = self.dimensions
+        return params
+
+    def embed(self, texts: Sequence[str]) -> List[np.ndarray]:
+        # 按批次请求，避免单次请求超过接口的输入数量限制
+        embeddings = []
+        for start in range(0, len(texts), Config.EMBEDDING_BATCH_SIZE):
+            response = self.gateway.embed({
+                "input": list(texts[start:start + Config.EMBEDDING_BATCH_SIZE]),
+                **self._params()
+            })
+            embeddings.extend(np.asarray(data.embedding, dtype=np.float32) for data in response.data)
+            record_usage(self.model, getattr(response, "usage", None))
+        return embeddings
+
+    async def aembed(self, texts: Sequence[str]) -> List[np.ndarray]:
+        embeddings = []
+        for start in range(0, len(texts), Config.EMBEDDING_BATCH_SIZE):
+            response = await self.gateway.aembed({
+                "input": list(texts[start:start + Config.EMBEDDING_BATCH_SIZE]),
+                **self._params()
+            })
+            embeddings.extend(np.asarray(data.embedding, dtype=np.float32) for data in response.data)
+            record_usage(self.model, getattr(response, "usage", None))
+        return embeddings
+
+
+class LocalEmbeddingProvider:
+    """
+    本地 CPU 嵌入模型（默认使用 Chroma 自带的 ONNX all-MiniLM-L6-v2），查询路径不再依赖网络
+    - 创建时加载模型并做一次推理预热
+    - 文本按批次切分，在线程池中并行推理（onnxruntime 推理期间释放 GIL）
+    Args:
+        model: 模型名称，默认 Config.LOCAL_EMBEDDING_MODEL
+        embedding_function: 可调用对象，输入文本列表返回向量列表；默认按模型名称创建 ONNXMiniLM_L6_V2
+    """
+
+    name = "local"
+
+    def __init__(self,
+                 model: Optional[str] = None,
+                 embedding_function=None,
+                 batch_size: int = Config.LOCAL_EMBEDDING_BATCH_SIZE,
+                 max_workers: int = Config.LOCAL_EMBEDDING_WORKERS):
+        self.model = model or Config.LOCAL_EMBEDDING_MODEL
+        self.batch_size = batch_size
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="local-embed")
+        self._embedding_function = embedding_function if embedding_function is not None else self._load_model()
+        self.warm_up()
+
+    def _load_model(self):
+        if self.model != "all-MiniLM-L6-v2":
+            raise ValueError(f"不支持的本地嵌入模型: {self.model}")
+        from chromadb.utils.embedding_functions import ONNXMiniLM_L6_V2
+        return ONNXMiniLM_L6_V2(preferred_providers=["CPUExecutionProvider"])
+
+    def warm_up(self):
+        """加载模型权重和分词器，避免首个查询承担初始化开销"""
+        start = time.perf_counter()
+        self._embedding_function(["warm up"])
+        logger.info(f"本地嵌入模型 {self.model} 加载完成，耗时 {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    @property
+    def store_key(self) -> str:
+        return embedding_store_key(self.model, None)
+
+    def _embed_batch(self, batch: List[str]) -> List[np.ndarray]:
+        return [np.asarray(vector, dtype=np.float32) for vector in self._embedding_function(batch)]
+
+    def _batches(self, texts: Sequence[str]) -> List[List[str]]:
+        texts = list(texts)
+        return [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+
+    def embed(self, texts: Sequence[str]) -> List[np.ndarray]:
+        batches = self._batches(texts)
+        if len(batches) == 1:
+            # 单个批次（如查询向量）直接在调用线程推理，省去线程切换
+            return self._embed_batch(batches[0])
+        embeddings = []
+        for batch_embeddings in self.executor.map(self._embed_batch, batches):
+            embeddings.extend(batch_embeddings)
+        return embeddings
+
+    async def aembed(self, texts: Sequence[str]) -> List[np.ndarray]:
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(*(
+            loop.run_in_executor(self.executor, self._embed_batch, batch) for batch in self._batches(texts)
+        ))
+        return [vector for batch_embeddings in results for vector in batch_embeddings]
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+_local_provider: Optional[LocalEmbeddingProvider] = None
+_local_provider_lock = threading.Lock()
+
+
+def get_local_provider() -> LocalEmbeddingProvider:
+    """获取进程内共享的本地嵌入模型（只加载一次）"""
+    global _local_provider
+    if _local_provider is None:
+        with _local_provider_lock:
+            if _local_provider is None:
+                _local_provider = LocalEmbeddingProvider()
+    return _local_provider
+
+
+def get_embedding_provider(client=None, model: Optional[str] = None, dimensions: Optional[int] = None):
+    """
+    根据 Config.EMBEDDING_PROVIDER 返回嵌入提供方
+    - "openai"：经过 OpenAI 网关调用嵌入接口（client 为 None 时使用共享网关）
+    - "local"：进程内共享的本地模型，忽略 client
+    """
+    if Config.EMBEDDING_PROVIDER == "local":
+        return get_local_provider()
+    if Config.EMBEDDING_PROVIDER == "openai":
+        return OpenAIEmbeddingProvider(client, model, dimensions)
+    raise ValueError(f"未知的嵌入提供方: {Config.EMBEDDING_PROVIDER}")
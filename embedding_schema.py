@@ -0,0 +1,117 @@
+import logging
+from typing import Dict, Optional
+
+from config.settings import Config
+
+logger = logging.getLogger("aiagent_log")
+
+# 各嵌入模型的原生维度
+NATIVE_DIMENSIONS = {
+    "text-embedding-ada-002": 1536,
+    "text-embedding-3-small": 1536,
+    "text-embedding-3-large": 3072,
+    "all-MiniLM-L6-v2": 384
+}
+
+# 在引入模型记录之前建库时硬编码使用的嵌入模型
+LEGACY_SCHEMA = {
+    "embedding_provider": "openai",
+    "embedding_model": "text-embedding-ada-002",
+    "embedding_dimensions": 1536,
+    "embedding_normalized": True
+}
+
+SCHEMA_KEYS = tuple(LEGACY_SCHEMA)
+
+
+class EmbeddingSchemaError(Exception):
+    """集合记录的嵌入模型/维度与当前配置不一致"""
+    pass
+
+
+def current_schema() -> Dict:
+    """根据当前配置生成嵌入模式（提供方、模型名、维度、是否归一化）"""
+    if Config.EMBEDDING_PROVIDER == "local":
+        model = Config.LOCAL_EMBEDDING_MODEL
+        dimensions = NATIVE_DIMENSIONS.get(model)
+    else:
+        model = Config.EMBEDDING_MODEL
+        dimensions = Config.EMBEDDING_DIMENSIONS or NATIVE_DIMENSIONS.get(model)
+    return {
+        "embedding_provider": Config.EMBEDDING_PROVIDER,
+        "embedding_model": model,
+        "embedding_dimensions": dimensions,
+        "embedding_normalized": True
+    }
+
+
+def embedding_store_key(model: str = None, dimensions: Optional[int] = None) -> str:
+    """嵌入缓存中区分模型和降维配置的键，如 text-embedding-3-small@256"""
+    model = model or Config.EMBEDDING_MODEL
+    if dimensions is None:
+        dimensions = Config.EMBEDDING_DIMENSIONS
+    return f"{model}@{dimensions}" if dimensions else model
+
+
+def read_schema(collection) -> Optional[Dict]:
+    """读取集合元数据中记录的嵌入模式，未记录时返回 None"""
+    metadata = collection.metadata or {}
+    if "embedding_model" not in metadata:
+        return None
+    schema = {key: metadata.get(key) for key in SCHEMA_KEYS}
+    # 记录提供方之前建的集合都使用 OpenAI 嵌入
+    schema["embedding_provider"] = schema["embedding_provider"] or LEGACY_SCHEMA["embedding_provider"]
+    return schema
+
+
+def _check(schema: Dict, expected: Dict):
+    mismatched = [
+        key for key in ("embedding_provider", "embedding_model", "embedding_dimensions")
+        if schema.get(key) != expected.get(key)
+    ]
+    if mismatched:
+        raise EmbeddingSchemaError(
+            f"集合 {Config.COLLECTION_NAME} 使用 {schema['embedding_provider']}/{schema['embedding_model']} "
+            f"({schema['embedding_dimensions']} 维) 构建，当前配置为 {expected['embedding_provider']}/"
+            f"{expected['embedding_model']} ({expected['embedding_dimensions']} 维)。请调整 "
+            f"Config.EMBEDDING_PROVIDER / Config.EMBEDDING_MODEL / Config.EMBEDDING_DIMENSIONS，或重新初始化集合"
+        )
+
+
+def validate_collection_schema(collection) -> Dict:
+    """
+    检索启动时校验集合的嵌入模式与当前配置一致
+    未记录模式的非空旧集合按 LEGACY_SCHEMA（ada-002）处理
+    Returns:
+        集合的嵌入模式
+    Raises:
+        EmbeddingSchemaError: 模型或维度不一致
+    """
+    expected = current_schema()
+    schema = read_schema(collection)
+    if schema is None:
+        if collection.count() == 0:
+            return expected
+        logger.warning(f"集合 {Config.COLLECTION_NAME} 未记录嵌入模型，按旧版 {LEGACY_SCHEMA['embedding_model']} 处理")
+        schema = LEGACY_SCHEMA
+    _check(schema, expected)
+    return schema
+
+
+def ensure_collection_schema(collection) -> Dict:
+    """
+    写入数据前调用：校验嵌入模式，集合尚未记录时把当前模式写入集合元数据
+    Raises:
+        EmbeddingSchemaError: 模型或维度不一致
+    """
+    schema = validate_collection_schema(collection)
+    if any(key not in (collection.metadata or {}) for key in SCHEMA_KEYS):
+        # modify 会整体替换元数据；hnsw:* 属于索引配置，不能通过 modify 修改
+        metadata = {
+            key: value for key, value in (collection.metadata or {}).items()
+            if not key.startswith("hnsw:")
+        }
+        metadata.update(schema)
+        collection.modify(metadata=metadata)
+        logger.info(f"已在集合元数据中记录嵌入模式: {schema}")
+    return schema
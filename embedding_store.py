@@ -0,0 +1,213 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from config.settings import Config
+from embedding_providers import get_embedding_provider
+from metrics import record_cache_event
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI, OpenAI
+
+
+def text_hash(text: str) -> str:
+    """计算文本的 sha256 摘要，作为嵌入缓存键的一部分"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingStore:
+    """
+    持久化的嵌入向量缓存
+    以 (模型名, 文本sha256) 为键，将 float32 向量存储在 SQLite 中，进程重启后依然有效
+    - SQLite 使用 WAL 模式，同一主机上的多个 worker 进程共享同一份缓存（L2）
+    - 进程内另有一层有界 LRU（L1），热点查询向量不需要访问 SQLite
+    """
+
+    # SQLite 单条语句的参数数量有限制，批量查询时分块进行
+    _QUERY_CHUNK_SIZE = 500
+
+    def __init__(self, path: Optional[str] = None, memory_entries: Optional[int] = None):
+        path = path or Config.EMBEDDING_CACHE_PATH
+        self.path = path
+        self._lock = threading.Lock()
+        self._open_lock = threading.Lock()
+        self.memory_entries = Config.EMBEDDING_MEMORY_CACHE_ENTRIES if memory_entries is None else memory_entries
+        # (模型名, 文本sha256) -> 向量
+        self._memory: "OrderedDict[tuple, np.ndarray]" = OrderedDict()
+        self._connection: Optional[sqlite3.Connection] = None
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        """首次读写时才创建目录并打开 SQLite，创建实例本身不访问磁盘"""
+        if self._connection is None:
+            with self._open_lock:
+                if self._connection is None:
+                    os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                    # timeout：其他进程持有写锁时的最长等待时间
+                    conn = sqlite3.connect(self.path, check_same_thread=False, timeout=10)
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    conn.execute("PRAGMA synchronous=NORMAL")
+                    conn.execute(
+                        """CREATE TABLE IF NOT EXISTS embeddings (
+                            model TEXT NOT NULL,
+                            text_hash TEXT NOT NULL,
+                            dim INTEGER NOT NULL,
+                            vector BLOB NOT NULL,
+                            PRIMARY KEY (model, text_hash)
+                        )"""
+                    )
+                    conn.commit()
+                    self._connection = conn
+        return self._connection
+
+    def get_many(self, model: str, texts: Sequence[str]) -> List[Optional[np.ndarray]]:
+        """
+        批量读取嵌入向量
+        Returns:
+            与 texts 一一对应的列表，未缓存的位置为 None
+        """
+        hashes = [text_hash(text) for text in texts]
+        found: Dict[str, np.ndarray] = {}
+        with self._lock:
+            for hash_value in hashes:
+                vector = self._memory.get((model, hash_value))
+                if vector is not None:
+                    self._memory.move_to_end((model, hash_value))
+                    found[hash_value] = vector
+            unique_hashes = [hash_value for hash_value in dict.fromkeys(hashes) if hash_value not in found]
+            for start in range(0, len(unique_hashes), self._QUERY_CHUNK_SIZE):
+                chunk = unique_hashes[start:start + self._QUERY_CHUNK_SIZE]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings "
+                    f"WHERE model = ? AND text_hash IN ({placeholders})",
+                    [model, *chunk]
+                ).fetchall()
+                for hash_value, blob in rows:
+                    found[hash_value] = np.frombuffer(blob, dtype=np.float32)
+                    self._remember(model, hash_value, found[hash_value])
+        return [found.get(hash_value) for hash_value in hashes]
+
+    def _remember(self, model: str, hash_value: str, vector: np.ndarray):
+        # 调用方需持有锁
+        if not self.memory_entries:
+            return
+        self._memory[(model, hash_value)] = vector
+        self._memory.move_to_end((model, hash_value))
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, model: str, text: str) -> Optional[np.ndarray]:
+        return self.get_many(model, [text])[0]
+
+    def put_many(self, model: str, texts: Sequence[str], embeddings: Sequence[Sequence[float]]):
+        """批量写入嵌入向量"""
+        rows = []
+        vectors = []
+        for text, embedding in zip(texts, embeddings):
+            vector = np.asarray(embedding, dtype=np.float32)
+            rows.append((model, text_hash(text), vector.shape[0], vector.tobytes()))
+            vectors.append(vector)
+        with self._lock:
+            for row, vector in zip(rows, vectors):
+                self._remember(model, row[1], vector)
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, dim, vector) VALUES (?, ?, ?, ?)",
+                rows
+            )
+            self._conn.commit()
+
+    def put(self, model: str, text: str, embedding: Sequence[float]):
+        self.put_many(model, [text], [embedding])
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+
+_stores: Dict[str, EmbeddingStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_embedding_store(path: Optional[str] = None) -> EmbeddingStore:
+    """获取进程内共享的嵌入缓存实例（同一路径只打开一次），默认路径为 Config.EMBEDDING_CACHE_PATH"""
+    path = path or Config.EMBEDDING_CACHE_PATH
+    key = os.path.abspath(path)
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            store = EmbeddingStore(path)
+            _stores[key] = store
+        return store
+
+
+def embed_texts(client: "OpenAI",
+                texts: Sequence[str],
+                model: Optional[str] = None,
+                store: Optional[EmbeddingStore] = None,
+                dimensions: Optional[int] = None,
+                provider=None) -> List[List[float]]:
+    """
+    读穿式获取文本嵌入：先查持久化缓存，只对未命中的文本调用嵌入提供方，并写回缓存
+    Args:
+        client: OpenAI 客户端或网关，为 None 时使用共享网关（使用本地嵌入模型时忽略）
+        texts: 待嵌入的文本列表
+        model: 嵌入模型名称，默认 Config.EMBEDDING_MODEL
+        store: 嵌入缓存，默认使用进程内共享实例
+        dimensions: 降维后的向量维度，默认 Config.EMBEDDING_DIMENSIONS（None 表示原生维度）
+        provider: 嵌入提供方，默认按 Config.EMBEDDING_PROVIDER 创建
+    Returns:
+        与 texts 一一对应的嵌入向量列表
+    """
+    if store is None:
+        store = get_embedding_store()
+    if provider is None:
+        provider = get_embedding_provider(client, model, dimensions)
+    cached = store.get_many(provider.store_key, texts)
+    # 对未命中的文本去重，只请求一次
+    missing = list(dict.fromkeys(text for text, vector in zip(texts, cached) if vector is None))
+    for vector in cached:
+        record_cache_event("embedding", vector is not None)
+    if missing:
+        new_embeddings = provider.embed(missing)
+        store.put_many(provider.store_key, missing, new_embeddings)
+        fetched = dict(zip(missing, new_embeddings))
+        # 统一返回 float32 精度，保证冷/热缓存下结果一致
+        cached = [vector if vector is not None else fetched[text] for text, vector in zip(texts, cached)]
+    return [vector.tolist() for vector in cached]
+
+
+async def aembed_texts(client: "AsyncOpenAI",
+                       texts: Sequence[str],
+                       model: Optional[str] = None,
+                       store: Optional[EmbeddingStore] = None,
+                       dimensions: Optional[int] = None,
+                       provider=None) -> List[List[float]]:
+    """
+    embed_texts 的异步版本，使用 AsyncOpenAI 客户端（或本地模型线程池）获取未命中的嵌入
+    """
+    if store is None:
+        store = get_embedding_store()
+    if provider is None:
+        provider = get_embedding_provider(client, model, dimensions)
+    # 本地 SQLite 读写耗时在亚毫秒级，直接在事件循环中执行
+    cached = store.get_many(provider.store_key, texts)
+    missing = list(dict.fromkeys(text for text, vector in zip(texts, cached) if vector is None))
+    for vector in cached:
+        record_cache_event("embedding", vector is not None)
+    if missing:
+        new_embeddings = await provider.aembed(missing)
+        store.put_many(provider.store_key, missing, new_embeddings)
+        fetched = dict(zip(missing, new_embeddings))
+        cached = [vector if vector is not None else fetched[text] for text, vector in zip(texts, cached)]
+    return [vector.tolist() for vector in cached]
@@ -1,9 +1,24 @@
-import chromadb
+import hashlib
+import inspect
+import weakref
 from config.settings import Config
-from openai import OpenAI
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import closing
+from typing import TYPE_CHECKING, Optional
 import json
 import logging
-from chromadb.config import Settings
+from lazy_imports import lazy_import
+from openai_gateway import as_gateway, get_gateway
+from embedding_store import embed_texts
+from embedding_schema import current_schema, ensure_collection_schema
+from collection_version import get_collection_version
+from category_router import get_category_centroids
+
+# chromadb 在首次使用时才加载（openai 由网关延迟加载），检索进程导入本模块（注册写入回调）时不必为它们付出启动时间
+chromadb = lazy_import("chromadb")
+
+if TYPE_CHECKING:
+    from openai import OpenAI
 
 logger = logging.getLogger("aiagent_log")
 
@@ -13,7 +28,7 @@ logger = logging.getLogger("aiagent_log")
 # 这个路径表明 ChromaDB 在首次使用时会自动下载并缓存所需的嵌入模型,以便后续使用。all-MiniLM-L6-v2 是一个常用的句子转换模型,用于将文本转换为向量形式。
 # 能否调用openai生成Embedding，然后调用chromadb存储数据
 
-def generate_agent_info(categories: list, client: OpenAI) -> dict:
+def generate_agent_info(categories: list, client: "OpenAI") -> dict:
     """
     使用OpenAI生成指定类别的agent信息
     """
@@ -33,24 +48,56 @@ def generate_agent_info(categories: list, client: OpenAI) -> dict:
         "category": "agent2 category"}}
     ]}}"""
 
-    response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
+    # 经过 OpenAI 网关：gpt-4o 的限流配额与检索进程共享，限流等可重试错误按指数退避 + 抖动重试
+    response = as_gateway(client).chat({
+            "model": "gpt-4o",
+            "messages": [
                 {"role": "system", "content": "你是一个专业的智能体设计专家。"},
                 {"role": "user", "content": system_massage}
             ],
-            temperature=0.7,
-            response_format={ "type": "json_object" }
-        )
+            "temperature": 0.7,
+            "response_format": { "type": "json_object" }
+        },
+        max_retries=Config.GENERATION_MAX_RETRIES,
+        base_delay=Config.GENERATION_RETRY_BASE_DELAY)
     # 解析返回的JSON
     response_data = json.loads(response.choices[0].message.content)
     agent_info = response_data['agents']
     # print(agent_info)
     return agent_info
 
-def get_embedding(agent_info: list, client: OpenAI) -> list:
+def generate_agent_info_chunks(categories: list, client: "OpenAI",
+                               chunk_size: Optional[int] = None,
+                               max_workers: Optional[int] = None):
+    """
+    把类别列表切分成多个块，用有界线程池并发生成agent信息
+    每个块完成后立即产出，调用方可以边生成边写入
+    chunk_size / max_workers 默认取 Config.GENERATION_CHUNK_SIZE / Config.GENERATION_MAX_WORKERS
+    Yields:
+        (chunk_categories, agent_info, error)：成功时 error 为 None，失败时 agent_info 为 None
+    """
+    chunk_size = chunk_size or Config.GENERATION_CHUNK_SIZE
+    max_workers = max_workers or Config.GENERATION_MAX_WORKERS
+    chunks = [categories[i:i + chunk_size] for i in range(0, len(categories), chunk_size)]
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="agent-gen")
+    try:
+        futures = {
+            executor.submit(generate_agent_info, chunk, client): chunk
+            for chunk in chunks
+        }
+        for future in as_completed(futures):
+            chunk = futures[future]
+            try:
+                yield chunk, future.result(), None
+            except Exception as e:
+                yield chunk, None, e
+    finally:
+        # 调用方提前结束迭代（如写入失败）时取消尚未开始的生成请求，不等待剩余的 gpt-4o 调用
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def get_embedding(agent_info: list, client: "OpenAI") -> list:
     """
-    使用OpenAI生成文本的嵌入向量
+    生成文本的嵌入向量（按 Config.EMBEDDING_PROVIDER 使用 OpenAI 或本地模型）
     """
     documents = [agent["system_prompt"] for agent in agent_info]
 
@@ -61,35 +108,25 @@ def get_embedding(agent_info: list, client: OpenAI) -> list:
     #     )
     #     embeddings.append(response.data[0].embedding)
 
-    # 批量处理所有文档，而不是逐个处理 
-    response = client.embeddings.create(
-        model="text-embedding-ada-002",
-        input=documents
-    )
-
-    embeddings = [data.embedding for data in response.data]
+    # 批量处理所有文档，而不是逐个处理；已缓存的文档直接从持久化嵌入缓存读取
+    embeddings = embed_texts(client, documents)
     return embeddings
 
 class AgentInitializationError(Exception):
     """自定义异常类，用于处理agent初始化过程中的错误"""
     pass
 
-def initialize_agents(categories: list[str], client: OpenAI):
+def get_collection():
     """
-    根据给定的类别列表初始化agents
+    连接ChromaDB并获取agent集合，集合不存在时创建
     """
-
-    # 为每个类别生成agent信息
-    agent_info = generate_agent_info(categories, client)
-    
-    # 连接ChromaDB
     logger.info("连接ChromaDB...")
     try:
         db_client = chromadb.PersistentClient(path=Config.PERSIST_DIR)
     except Exception as e:
         print(f"Creating new client with custom settings: {e}")
         db_client = chromadb.PersistentClient(path=Config.PERSIST_DIR, 
-                                        settings=Settings(
+                                        settings=chromadb.config.Settings(
                     anonymized_telemetry=False,
                     allow_reset=True
                 ))
@@ -99,32 +136,170 @@ def initialize_agents(categories: list[str], client: OpenAI):
         print(f"Creating new collection: {Config.COLLECTION_NAME}")
         collection = db_client.create_collection(
             name=Config.COLLECTION_NAME,
-            metadata={"description": "AI Agents information"}
+            # 记录建库使用的嵌入模型、维度和归一化方式，检索时据此校验
+            metadata={"description": "AI Agents information", **current_schema()}
         )
     print("ChromaDB连接成功！")
+    # 写入前校验嵌入模式，避免同一集合混用不同的嵌入模型
+    ensure_collection_schema(collection)
+    return collection
 
-    # 存储数据
-    try:
-        logger.info("准备数据...")
-        documents = [agent["system_prompt"] for agent in agent_info]
-        metadatas = [{"category": agent["category"]} for agent in agent_info]
-        ids = [agent["id"] for agent in agent_info]
-        # 将system_prompt转成Embedding
-        embeddings = get_embedding(agent_info, client)
-
-        logger.info("正在存储agent数据...")
-        collection.add(
-            documents=documents, 
+# 写入完成后的回调（如检索器的 BM25 索引），参数为 (collection, ids, documents, metadatas, 写入后的集合版本号)
+# 绑定方法以 WeakMethod 保存，不会让注册它的检索器无法被回收
+_ingest_listeners = []
+
+def _listener_ref(listener):
+    return weakref.WeakMethod(listener) if inspect.ismethod(listener) else lambda: listener
+
+def register_ingest_listener(listener):
+    """注册写入回调，agent upsert 到集合后同步更新进程内的派生索引"""
+    if listener not in _live_ingest_listeners():
+        _ingest_listeners.append(_listener_ref(listener))
+
+def _live_ingest_listeners() -> list:
+    """仍然存活的写入回调，顺便移除已被回收的检索器的回调"""
+    listeners = [ref() for ref in _ingest_listeners]
+    if None in listeners:
+        _ingest_listeners[:] = [ref for ref, listener in zip(_ingest_listeners, listeners) if listener is not None]
+    return [listener for listener in listeners if listener is not None]
+
+def content_hash(text: str) -> str:
+    """计算agent system_prompt 的内容摘要，用于判断文档是否发生变化"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def ingest_agents(agent_info: list, client: "OpenAI", collection=None,
+                  batch_size: int = Config.INGEST_BATCH_SIZE) -> dict:
+    """
+    增量、幂等地写入agents：
+    - 按 system_prompt 的内容摘要判断，未变化的文档直接跳过
+    - 只对新增和变化的文档生成嵌入
+    - 按批次 upsert，重复执行不会因为 ID 重复而失败
+    Returns:
+        dict: {"added": 新增数, "updated": 更新数, "skipped": 跳过数}
+    """
+    if collection is None:
+        collection = get_collection()
+    # 同一批输入中 ID 重复时以最后一条为准
+    agents = list({agent["id"]: agent for agent in agent_info}.values())
+    report = {"added": 0, "updated": 0, "skipped": 0}
+
+    for start in range(0, len(agents), batch_size):
+        batch = agents[start:start + batch_size]
+        # 旧向量用于从类别质心中减去被覆盖的agent
+        existing = collection.get(ids=[agent["id"] for agent in batch], include=["metadatas", "embeddings"])
+        existing_metadata = {
+            agent_id: metadata or {}
+            for agent_id, metadata in zip(existing["ids"], existing["metadatas"])
+        }
+        existing_embeddings = dict(zip(existing["ids"], existing["embeddings"]))
+
+        changed = []
+        for agent in batch:
+            metadata = existing_metadata.get(agent["id"])
+            if metadata is None:
+                report["added"] += 1
+            elif (metadata.get("content_hash") == content_hash(agent["system_prompt"])
+                  and metadata.get("category") == agent["category"]):
+                report["skipped"] += 1
+                continue
+            else:
+                report["updated"] += 1
+            changed.append(agent)
+
+        if not changed:
+            continue
+        # 将system_prompt转成Embedding（只处理新增和变化的文档）
+        embeddings = get_embedding(changed, client)
+        ids = [agent["id"] for agent in changed]
+        documents = [agent["system_prompt"] for agent in changed]
+        metadatas = [
+            {"category": agent["category"], "content_hash": content_hash(agent["system_prompt"])}
+            for agent in changed
+        ]
+        collection.upsert(
+            ids=ids,
+            documents=documents,
             # 通过embeddings参数指定每条文本数据的向量
             embeddings=embeddings,
-            metadatas=metadatas,
-            ids=ids
+            metadatas=metadatas
         )
-        logger.info(f"成功初始化 {len(agent_info)} 个agents")
-        return agent_info
-    except Exception as e:
-        logger.error(f"Agent初始化过程发生错误: {str(e)}")
-        raise AgentInitializationError(f"Agent初始化失败: {str(e)}")
+        # 更新类别质心（先于版本号递增，其他进程看到新版本号时质心文件已经写好）
+        replaced = [agent_id for agent_id in ids if agent_id in existing_metadata]
+        centroids = get_category_centroids()
+        centroids.update(
+            [metadata["category"] for metadata in metadatas], embeddings,
+            [existing_metadata[agent_id].get("category") for agent_id in replaced],
+            [existing_embeddings[agent_id] for agent_id in replaced]
+        )
+        centroids.save()
+        # 递增集合版本号，所有进程的检索结果缓存随之失效
+        version = get_collection_version().bump(collection.name)
+        for listener in _live_ingest_listeners():
+            listener(collection, ids, documents, metadatas, version)
+
+    logger.info(f"agent写入完成：新增 {report['added']}，更新 {report['updated']}，跳过 {report['skipped']}")
+    return report
+
+def delete_agents(ids: list, collection=None):
+    """删除指定 ID 的agents，并递增集合版本号"""
+    if collection is None:
+        collection = get_collection()
+    existing = collection.get(ids=ids, include=["metadatas", "embeddings"])
+    collection.delete(ids=ids)
+    if len(existing["ids"]):
+        centroids = get_category_centroids()
+        centroids.update([], [], [(metadata or {}).get("category") for metadata in existing["metadatas"]],
+                         existing["embeddings"])
+        centroids.save()
+    version = get_collection_version().bump(collection.name)
+    logger.info(f"已删除 {len(ids)} 个agents，集合版本号 {version}")
+
+def initialize_agents(categories: list[str], client: "OpenAI"):
+    """
+    根据给定的类别列表初始化agents
+    """
+
+    collection = get_collection()
+
+    # 生产者/消费者：多个类别块并发生成，每完成一块就立即生成嵌入并写入ChromaDB
+    agent_info = []
+    failed_categories = []
+    # 写入失败时立即关闭生成器，取消排队中的生成请求
+    with closing(generate_agent_info_chunks(categories, client)) as results:
+        for chunk, chunk_agents, error in results:
+            if error is not None:
+                logger.error(f"类别 {chunk} 的agent生成失败: {str(error)}")
+                failed_categories.extend(chunk)
+                continue
+            # 存储数据
+            try:
+                logger.info(f"正在存储类别 {chunk} 的agent数据...")
+                ingest_agents(chunk_agents, client, collection)
+                agent_info.extend(chunk_agents)
+            except Exception as e:
+                logger.error(f"Agent初始化过程发生错误: {str(e)}")
+                raise AgentInitializationError(f"Agent初始化失败: {str(e)}")
+
+    if failed_categories:
+        raise AgentInitializationError(
+            f"Agent初始化失败，以下类别生成失败: {failed_categories}（已成功写入 {len(agent_info)} 个agents）"
+        )
+    logger.info(f"成功初始化 {len(agent_info)} 个agents")
+    return agent_info
+
+def get_or_create_category_agent(category: str, client: "OpenAI") -> dict:
+    """
+    获取指定类别的agent：集合中已存在时直接复用，否则生成并写入新的agent
+    """
+    collection = get_collection()
+    existing = collection.get(where={"category": category}, limit=1, include=["documents", "metadatas"])
+    if existing["ids"]:
+        return {
+            "id": existing["ids"][0],
+            "system_prompt": existing["documents"][0],
+            "category": category
+        }
+    return initialize_agents([category], client)[0]
 
 # 使用示例
 if __name__ == "__main__":
@@ -136,7 +311,7 @@ if __name__ == "__main__":
     #     print(f"\nCategory: {agent['category']}")
     #     print(f"ID: {agent['id']}")
     #     print(f"System Prompt: {agent['system_prompt'][:100]}...")
-    client = OpenAI(api_key=Config.OPENAI_API_KEY)
+    client = get_gateway()
     # agent_info = generate_agent_info(categories, client)
     # embeddings = get_embedding(client, agent_info)
     agent_info = initialize_agents(categories, client)
\ No newline at end of file
@@ -0,0 +1,39 @@
+import importlib.util
+import sys
+import threading
+from types import ModuleType
+
+_lock = threading.Lock()
+
+
+def lazy_import(name: str) -> ModuleType:
+    """
+    延迟导入模块：立即返回模块对象，首次访问其属性时才真正执行模块代码
+    用于 chromadb / openai / gradio 等导入耗时较长的依赖，只用到检索的进程（CLI、批处理）不必为它们付出启动时间
+    - 已经导入（或已经延迟导入）的模块直接返回
+    - 只支持顶层包；子模块通过父包的属性访问（如 chromadb.config.Settings）
+    注意：from x import y 会立即触发加载，延迟导入的模块应以 x.y 的形式使用；
+    Python 3.12 之前 LazyLoader 的首次加载不是线程安全的，应在持有锁或单线程启动阶段（如 warm_up）触发
+    """
+    with _lock:
+        module = sys.modules.get(name)
+        if module is not None:
+            return module
+        spec = importlib.util.find_spec(name)
+        if spec is None:
+            raise ModuleNotFoundError(f"No module named {name!r}", name=name)
+        loader = importlib.util.LazyLoader(spec.loader)
+        spec.loader = loader
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        loader.exec_module(module)
+        return module
+
+
+def is_loaded(name: str) -> bool:
+    """模块是否已经真正执行（未导入或仍处于延迟状态时返回 False）"""
+    module = sys.modules.get(name)
+    if module is None:
+        return False
+    # LazyLoader 在首次访问属性时把模块的 __class__ 换回 ModuleType
+    return not isinstance(module, importlib.util._LazyModule)
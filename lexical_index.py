@@ -0,0 +1,255 @@
+import logging
+import math
+import re
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from config.settings import Config
+
+logger = logging.getLogger("aiagent_log")
+
+# 连续的中日韩字符，或连续的字母数字
+_TOKEN_PATTERN = re.compile(r"[㐀-䶿一-鿿豈-﫿぀-ヿ가-힯]+|[a-zA-Z0-9]+")
+_CJK_PATTERN = re.compile(r"[㐀-䶿一-鿿豈-﫿぀-ヿ가-힯]")
+
+
+def tokenize(text: str, ngram_sizes: Sequence[int] = (1, 2)) -> List[str]:
+    """
+    分词：中日韩文本切分为字符 n-gram，其余按字母数字单词切分并转小写
+    """
+    tokens = []
+    for run in _TOKEN_PATTERN.findall(text or ""):
+        if _CJK_PATTERN.match(run):
+            for n in ngram_sizes:
+                tokens.extend(run[i:i + n] for i in range(len(run) - n + 1))
+        else:
+            tokens.append(run.lower())
+    return tokens
+
+
+def metadata_matches(metadata: Optional[Dict], where: Optional[Dict]) -> bool:
+    """判断单条元数据是否满足 Chroma 风格的 where 条件"""
+    if not where:
+        return True
+    metadata = metadata or {}
+    for key, condition in where.items():
+        if key == "$and":
+            if not all(metadata_matches(metadata, sub_where) for sub_where in condition):
+                return False
+        elif key == "$or":
+            if not any(metadata_matches(metadata, sub_where) for sub_where in condition):
+                return False
+        else:
+            conditions = condition.items() if isinstance(condition, dict) else [("$eq", condition)]
+            value = metadata.get(key)
+            for operator, expected in conditions:
+                if operator == "$eq" and value != expected:
+                    return False
+                if operator == "$ne" and value == expected:
+                    return False
+                if operator == "$in" and value not in expected:
+                    return False
+                if operator == "$nin" and value in expected:
+                    return False
+                if operator in ("$gt", "$gte", "$lt", "$lte"):
+                    if value is None:
+                        return False
+                    if ((operator == "$gt" and not value > expected)
+                            or (operator == "$gte" and not value >= expected)
+                            or (operator == "$lt" and not value < expected)
+                            or (operator == "$lte" and not value <= expected)):
+                        return False
+    return True
+
+
+class LexicalIndex:
+    """
+    基于 BM25 的本地倒排索引，索引内容为agent文档和类别
+    - 中文等 CJK 文本使用字符 n-gram
+    - 支持增量 upsert / delete
+    - 传入 collection 时从 Chroma 集合加载，集合版本号或条目数变化时重新加载（与 NumpyBackend 相同）
+    """
+
+    def __init__(self, collection=None,
+                 reload_interval: float = Config.LEXICAL_RELOAD_INTERVAL,
+                 version=None,
+                 k1: float = Config.BM25_K1,
+                 b: float = Config.BM25_B,
+                 ngram_sizes: Sequence[int] = (1, 2)):
+        self.collection = collection
+        self.reload_interval = reload_interval
+        self.version = version
+        self._loaded_version = None
+        self.k1 = k1
+        self.b = b
+        self.ngram_sizes = tuple(ngram_sizes)
+        self._lock = threading.RLock()
+        self._last_check = time.monotonic()
+        self._clear()
+        if collection is not None:
+            self.reload()
+
+    def _clear(self):
+        self._ids: List[Optional[str]] = []
+        self._slots: Dict[str, int] = {}
+        self._free_slots: List[int] = []
+        self._metadatas: List[Optional[Dict]] = []
+        self._doc_terms: List[Optional[Counter]] = []
+        self._doc_lengths: List[int] = []
+        # term -> {slot: 词频}
+        self._postings: Dict[str, Dict[int, int]] = {}
+        self._total_length = 0
+
+    def build(self, ids: Sequence[str], documents: Sequence[str], metadatas: Sequence[Optional[Dict]]):
+        """从头构建索引"""
+        with self._lock:
+            self._clear()
+            self.upsert(ids, documents, metadatas)
+
+    def reload(self):
+        """从 Chroma 集合重新加载全部文档和元数据"""
+        start = time.perf_counter()
+        loaded_version = self.version.get(self.collection.name) if self.version is not None else None
+        data = self.collection.get(include=["documents", "metadatas"])
+        with self._lock:
+            self.build(data["ids"], data["documents"], data["metadatas"])
+            self._loaded_version = loaded_version
+        self._last_check = time.monotonic()
+        logger.info(f"LexicalIndex 加载 {len(data['ids'])} 条文档，耗时 {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    def _maybe_reload(self):
+        if self.collection is None:
+            return
+        if self.version is not None and self.version.get(self.collection.name) != self._loaded_version:
+            self.reload()
+            return
+        if not self.reload_interval:
+            return
+        now = time.monotonic()
+        if now - self._last_check < self.reload_interval:
+            return
+        self._last_check = now
+        if self.collection.count() != len(self):
+            self.reload()
+
+    def upsert(self, ids: Sequence[str], documents: Sequence[str], metadatas: Sequence[Optional[Dict]],
+               version: Optional[int] = None):
+        """
+        新增或更新文档
+        version: 这次写入之后的集合版本号；紧接着已加载版本时记录下来，避免下次检索时整体重新加载
+        """
+        with self._lock:
+            if version is not None and self._loaded_version is not None and version == self._loaded_version + 1:
+                self._loaded_version = version
+            for doc_id, document, metadata in zip(ids, documents, metadatas):
+                self._remove(doc_id)
+                category = (metadata or {}).get("category", "")
+                terms = Counter(tokenize(f"{document or ''} {category}", self.ngram_sizes))
+                length = sum(terms.values())
+                if self._free_slots:
+                    slot = self._free_slots.pop()
+                    self._ids[slot] = doc_id
+                    self._metadatas[slot] = metadata
+                    self._doc_terms[slot] = terms
+                    self._doc_lengths[slot] = length
+                else:
+                    slot = len(self._ids)
+                    self._ids.append(doc_id)
+                    self._metadatas.append(metadata)
+                    self._doc_terms.append(terms)
+                    self._doc_lengths.append(length)
+                self._slots[doc_id] = slot
+                self._total_length += length
+                for term, frequency in terms.items():
+                    self._postings.setdefault(term, {})[slot] = frequency
+
+    def delete(self, ids: Sequence[str]):
+        with self._lock:
+            for doc_id in ids:
+                self._remove(doc_id)
+
+    def _remove(self, doc_id: str):
+        slot = self._slots.pop(doc_id, None)
+        if slot is None:
+            return
+        for term in self._doc_terms[slot]:
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(slot, None)
+                if not postings:
+                    del self._postings[term]
+        self._total_length -= self._doc_lengths[slot]
+        self._ids[slot] = None
+        self._metadatas[slot] = None
+        self._doc_terms[slot] = None
+        self._doc_lengths[slot] = 0
+        self._free_slots.append(slot)
+
+    def search(self, query: str, top_k: int, filters: Optional[Dict] = None) -> List[Tuple[str, float, float]]:
+        """
+        BM25 检索
+        Returns:
+            [(id, bm25分数, 归一化分数)]，归一化分数为 BM25 分数除以“查询词在平均长度文档中各出现一次”时的分数，
+            截断到 0~1，可以理解为查询词（按 idf 加权）被匹配的比例
+        """
+        self._maybe_reload()
+        terms = set(tokenize(query, self.ngram_sizes))
+        with self._lock:
+            doc_count = len(self._slots)
+            if not terms or doc_count == 0:
+                return []
+            avg_length = self._total_length / doc_count
+            lengths = np.asarray(self._doc_lengths, dtype=np.float64)
+            norm = self.k1 * (1 - self.b + self.b * lengths / max(avg_length, 1e-9))
+            scores = np.zeros(len(self._ids), dtype=np.float64)
+            max_score = 0.0
+            for term in terms:
+                postings = self._postings.get(term)
+                document_frequency = len(postings) if postings else 0
+                idf = math.log(1 + (doc_count - document_frequency + 0.5) / (document_frequency + 0.5))
+                # 索引中不存在的查询词也计入上限，未匹配的词越多归一化分数越低
+                max_score += idf
+                if not postings:
+                    continue
+                slots = np.fromiter(postings.keys(), dtype=np.int64, count=len(postings))
+                frequencies = np.fromiter(postings.values(), dtype=np.float64, count=len(postings))
+                scores[slots] += idf * frequencies * (self.k1 + 1) / (frequencies + norm[slots])
+            if max_score == 0:
+                return []
+
+            candidates = np.flatnonzero(scores > 0)
+            if filters:
+                candidates = np.asarray(
+                    [slot for slot in candidates if metadata_matches(self._metadatas[slot], filters)],
+                    dtype=np.int64
+                )
+            if len(candidates) == 0:
+                return []
+            order = candidates[np.argsort(-scores[candidates], kind="stable")][:top_k]
+            return [(self._ids[slot], float(scores[slot]), min(float(scores[slot] / max_score), 1.0)) for slot in order]
+
+    def get(self, doc_id: str) -> Optional[Dict]:
+        """返回文档的元数据，文档不存在时返回 None；索引只保存词项，不保存文档原文"""
+        with self._lock:
+            slot = self._slots.get(doc_id)
+            if slot is None:
+                return None
+            return self._metadatas[slot] or {}
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[str]], k: int = Config.HYBRID_RRF_K) -> Dict[str, float]:
+    """
+    倒数排名融合：score(d) = Σ 1 / (k + rank)，rank 从 1 开始
+    """
+    fused: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, 1):
+            fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (k + rank)
+    return fused
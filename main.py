@@ -1,19 +1,79 @@
-from retrieval import VectorRetriever
-from openai import OpenAI
+from retrieval import warm_up
+from async_retrieval import get_async_retriever
 from config.settings import Config
-import gradio as gr
-from init_data import initialize_agents
+from lazy_imports import lazy_import
+import asyncio
+import logging
+import time
+from init_data import get_or_create_category_agent
+from openai_gateway import get_gateway
+from metrics import (STAGE_SECONDS, STREAM_CHUNKS, STREAM_FIRST_TOKEN_SECONDS, profile_task_if_slow,
+                     record_usage, start_metrics_server)
 
-def get_openai_response(query, sys_prompt):
-    stream_response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
+# gradio 导入耗时数秒，构建界面时才加载（openai 由网关在首次请求时加载）
+gr = lazy_import("gradio")
+
+logger = logging.getLogger("aiagent_log")
+
+async def get_openai_response(query, sys_prompt):
+    started = time.perf_counter()
+    # 经过共享的 OpenAI 网关（连接池、gpt-4o 限流配额、建立流之前的失败重试）
+    stream_response = await get_gateway().achat({
+        "model": "gpt-4o",
+        "messages": [
             {"role": "system", "content": sys_prompt},
             {"role": "user", "content": query}
         ],
-        stream=True  # 启用流式输出
-    )
-    return stream_response
+        "stream": True,  # 启用流式输出
+        "stream_options": {"include_usage": True}  # 最后一个块返回 token 用量
+    })
+    return instrument_stream(stream_response, started, model="gpt-4o")
+
+async def instrument_stream(stream, started, model):
+    """
+    透传流式响应的内容块，同时统计首个 token 耗时、内容块数量、总耗时和 token 用量
+    """
+    first_token = True
+    try:
+        async for chunk in stream:
+            if getattr(chunk, "usage", None) is not None:
+                record_usage(model, chunk.usage)
+            # include_usage 时最后一个块只有 usage，没有 choices
+            if not chunk.choices:
+                continue
+            if first_token and chunk.choices[0].delta.content:
+                STREAM_FIRST_TOKEN_SECONDS.observe(time.perf_counter() - started)
+                first_token = False
+            STREAM_CHUNKS.inc()
+            yield chunk
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage="chat_stream")
+
+async def buffer_stream(stream, flush_interval=None):
+    """
+    把流式内容块累积到列表缓冲区，按时间间隔批量刷新到界面，而不是每个 token 刷新一次
+    首个内容块立即刷新，保证首字节时间不受影响
+    Yields:
+        截至当前的完整回答文本
+    """
+    if flush_interval is None:
+        flush_interval = Config.STREAM_FLUSH_INTERVAL_MS / 1000
+    full_response = ""
+    buffer = []
+    last_flush = None
+    async for chunk in stream:
+        content = chunk.choices[0].delta.content
+        if not content:
+            continue
+        buffer.append(content)
+        now = time.perf_counter()
+        if last_flush is None or now - last_flush >= flush_interval:
+            full_response += "".join(buffer)
+            buffer.clear()
+            last_flush = now
+            yield full_response
+    if buffer:
+        yield full_response + "".join(buffer)
 
 def process_result(results):
      # 格式化输出结果
@@ -33,30 +93,54 @@ def process_result(results):
     agent_search_results = "\n\n".join(output)
     return agent_search_results, best_match
 
-def process_query_first(query):
-    retriever = VectorRetriever()
-    results = retriever.enhanced_search(query)["search_results"]
+async def process_query_first(query):
+    # 所有请求共享同一个检索器，只记录每次请求获取检索器的耗时
+    start = time.perf_counter()
+    retriever = get_async_retriever()
+    logger.info(f"获取检索器耗时 {(time.perf_counter() - start) * 1000:.2f} ms")
+    # 采样当前请求任务的 await 位置，而不是事件循环线程（后者会把其他并发请求的耗时算进来）
+    async with profile_task_if_slow("process_query_first"):
+        results = (await retriever.enhanced_search(query))["search_results"]
+        # 检索结果不携带文档：回答只需要最佳匹配的文档，先加载它并立即发起回答请求
+        if results:
+            await retriever.load_documents(results[:1])
+        sys_prompt = results[0]['document'] if results else "你是一个AI助手"
+        stream_task = asyncio.create_task(get_openai_response(query, sys_prompt))
+        # 其余结果的文档只用于展示，与回答请求并行加载
+        if len(results) > 1:
+            try:
+                await retriever.load_documents(results[1:])
+            except BaseException:
+                # 加载失败（或请求被取消）时回答请求不会再被调用方等待，取消它并取回结果，避免任务泄漏
+                stream_task.cancel()
+                await asyncio.gather(stream_task, return_exceptions=True)
+                raise
     agent_search_results, best_match = process_result(results)
-    stream  = get_openai_response(query, best_match['document'])
-    return agent_search_results, stream 
+    return agent_search_results, stream_task
 
-def process_query_second(agent_search_results, query, new_category=None):
+async def process_query_second(agent_search_results, query, new_category=None):
     # if feedback == "满意":
     #     return agent_search_results, ai_response
     
     # elif feedback == "不满意":
 
     if new_category:
-        # 初始化新的agent类型
-        new_agents = initialize_agents([new_category], client)
-        stream = get_openai_response(query, new_agents[0]["system_prompt"])
+        # 已存在该类别的agent时直接复用，否则初始化新的agent类型
+        new_agent = await asyncio.to_thread(get_or_create_category_agent, new_category, client)
+        stream = await get_openai_response(query, new_agent["system_prompt"])
         # 重新进行检索
         return agent_search_results, stream
     else:
-        stream = get_openai_response(query, "你是一个AI助手")
+        stream = await get_openai_response(query, "你是一个AI助手")
         return agent_search_results, stream
 
 def main():
+    # 启动时预热共享检索器，避免首个请求承担初始化开销
+    warm_up()
+    if Config.METRICS_ENABLED:
+        # 在 Gradio 应用旁启动本地 /metrics 接口
+        start_metrics_server()
+
     with gr.Blocks() as demo:
         # 主要输入组件
         with gr.Row():
@@ -85,21 +169,18 @@ def main():
             return {new_agent_row: gr.update(visible=True)}
 
         # 处理首次查询
-        def handle_first_query(query):
-            agent_results_text, stream  = process_query_first(query)
-            # 初始状态
+        async def handle_first_query(query):
+            agent_results_text, stream_task = await process_query_first(query)
+            # 检索结果准备好后立即推送，此时回答请求已经在进行中
             yield agent_results_text, ""
-            # 创建生成器函数来仅更新AI响应部分
-            full_response = ""
-            for chunk in stream:
-                if chunk.choices[0].delta.content is not None:
-                    full_response += chunk.choices[0].delta.content
-                    yield  agent_results_text, full_response
+            # 仅更新AI响应部分，按时间间隔批量刷新
+            async for full_response in buffer_stream(await stream_task):
+                yield agent_results_text, full_response
             
         # 处理满意按钮
-        def handle_satisfied(agent_results_text, query):
+        async def handle_satisfied(agent_results_text, query):
             if state.value:
-                _, stream  = process_query_second(
+                _, stream  = await process_query_second(
                     agent_results_text, 
                     query, 
                     state.value, 
@@ -107,30 +188,24 @@ def main():
 
                 # 保持现有的agent_results，开始流式输出新的回答
                 yield agent_results_text, ""
-                full_response = ""
-                for chunk in stream:
-                    if chunk.choices[0].delta.content is not None:
-                        full_response += chunk.choices[0].delta.content
-                        yield agent_results_text, full_response
+                async for full_response in buffer_stream(stream):
+                    yield agent_results_text, full_response
                 
             else:
                 yield agent_results_text, "请先进行查询"
 
 
         # 处理新类型提交
-        def handle_new_category(agent_results_text, query, new_category):
-            _, stream = process_query_second(
+        async def handle_new_category(agent_results_text, query, new_category):
+            _, stream = await process_query_second(
                 agent_results_text,
                 query,
                 new_category=new_category
             )
             # 初始状态
             yield "", False
-            full_response = ""
-            for chunk in stream:
-                if chunk.choices[0].delta.content is not None:
-                    full_response += chunk.choices[0].delta.content
-                    yield full_response, False
+            async for full_response in buffer_stream(stream):
+                yield full_response, False
 
         # 设置点击事件
         search_btn.click(
@@ -176,7 +251,7 @@ if __name__ == "__main__":
     # 初始化数据（首次运行后可以注释掉）
     categories = ["finance", "law", "medical", "technology", "education", "career", "fashion", "travel", \
                   "politics", "entertainment", "mental health"]
-    client = OpenAI(api_key=Config.OPENAI_API_KEY)
+    client = get_gateway()
     # agent_info = initialize_agents(categories, client)
     main()
 
@@ -0,0 +1,372 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import Counter as _StackCounter
+from contextlib import asynccontextmanager, contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from config.settings import Config
+
+logger = logging.getLogger("aiagent_log")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(label_names: Sequence[str], label_values: Tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter:
+    """单调递增计数器"""
+
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value: float = 1, **labels):
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def value(self, **labels) -> float:
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.label_names, key)} {value}" for key, value in items]
+
+
+class Histogram:
+    """累积分桶直方图"""
+
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [各桶计数..., +Inf 计数, 总和]
+        self._values: Dict[Tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = [0] * (len(self.buckets) + 1) + [0.0]
+                self._values[key] = state
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[len(self.buckets)] += 1
+            state[-1] += value
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = [(key, list(state)) for key, state in self._values.items()]
+        lines = []
+        for key, state in items:
+            for i, bound in enumerate(self.buckets):
+                bucket_labels = _format_labels(self.label_names, key, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{bucket_labels} {state[i]}")
+            count = state[len(self.buckets)]
+            bucket_labels = _format_labels(self.label_names, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{bucket_labels} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {state[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    进程内指标注册表，导出 Prometheus 文本格式
+    除计数器和直方图外，还可以注册采集函数，在导出时读取缓存统计等即时数值（gauge）
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+        # [(指标名, 说明, 采集函数)]，采集函数返回 [(标签字典, 数值)]
+        self._collectors: List[Tuple[str, str, Callable[[], Iterable[Tuple[Dict, float]]]]] = []
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, label_names))
+
+    def histogram(self, name: str, documentation: str, label_names: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, label_names, buckets))
+
+    def register_gauge(self, name: str, documentation: str, collect: Callable[[], Iterable[Tuple[Dict, float]]]):
+        """注册一个 gauge 采集函数，collect 返回 [(标签字典, 数值)]"""
+        with self._lock:
+            self._collectors = [item for item in self._collectors if item[0] != name]
+            self._collectors.append((name, documentation, collect))
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def render(self) -> str:
+        """导出 Prometheus 文本格式"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type_name}")
+            lines.extend(metric.samples())
+        for name, documentation, collect in collectors:
+            try:
+                samples = list(collect())
+            except Exception as e:
+                logger.warning(f"指标 {name} 采集失败: {str(e)}")
+                continue
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in samples:
+                lines.append(f"{name}{_format_labels(tuple(labels), tuple(labels.values()))} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "aiagent_stage_seconds", "检索和回答各阶段耗时（秒）", ["stage"]
+)
+CACHE_EVENTS = REGISTRY.counter(
+    "aiagent_cache_events_total", "各类缓存的命中/未命中次数", ["cache", "result"]
+)
+OPENAI_TOKENS = REGISTRY.counter(
+    "aiagent_openai_tokens_total", "OpenAI 接口消耗的 token 数", ["model", "kind"]
+)
+OPENAI_REQUEST_SECONDS = REGISTRY.histogram(
+    "aiagent_openai_request_seconds", "每次 OpenAI 请求的耗时（秒，不含限流等待）", ["model", "operation", "outcome"]
+)
+OPENAI_RETRIES = REGISTRY.counter(
+    "aiagent_openai_retries_total", "OpenAI 请求因可重试错误重试的次数", ["model", "operation", "error"]
+)
+OPENAI_HEDGED_REQUESTS = REGISTRY.counter(
+    "aiagent_openai_hedged_requests_total", "嵌入请求超过对冲等待时间后发出的对冲请求数", ["model"]
+)
+STREAM_FIRST_TOKEN_SECONDS = REGISTRY.histogram(
+    "aiagent_stream_first_token_seconds", "流式回答从发起请求到首个 token 的耗时（秒）"
+)
+STREAM_CHUNKS = REGISTRY.counter(
+    "aiagent_stream_chunks_total", "流式回答收到的内容块数量"
+)
+SEARCH_PATHS = REGISTRY.counter(
+    "aiagent_search_path_total", "检索请求走的路径（vector / hybrid / lexical / lexical_fast_path）", ["path"]
+)
+COALESCED_CALLS = REGISTRY.counter(
+    "aiagent_coalesced_calls_total", "与进行中的相同调用合并、未单独请求上游的次数", ["call"]
+)
+SLOW_REQUESTS = REGISTRY.counter(
+    "aiagent_slow_requests_total", "超过采样分析阈值的慢请求数", ["stage"]
+)
+
+
+@contextmanager
+def stage_timer(stage: str):
+    """统计代码块耗时并计入 aiagent_stage_seconds"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage)
+
+
+def record_cache_event(cache: str, hit: bool):
+    CACHE_EVENTS.inc(cache=cache, result="hit" if hit else "miss")
+
+
+def record_usage(model: str, usage):
+    """记录 OpenAI 响应中的 token 用量（usage 为空时忽略）"""
+    if usage is None:
+        return
+    for kind in ("prompt_tokens", "completion_tokens"):
+        value = getattr(usage, kind, None)
+        if value:
+            OPENAI_TOKENS.inc(value, model=model, kind=kind)
+
+
+class _StackSampler(threading.Thread):
+    """周期性采样目标线程的调用栈"""
+
+    def __init__(self, thread_id: int, interval: float):
+        super().__init__(name="SlowRequestSampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: _StackCounter = _StackCounter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = tuple(
+                f"{summary.filename}:{summary.lineno} {summary.name}"
+                for summary in traceback.extract_stack(frame)[-Config.PROFILE_STACK_DEPTH:]
+            )
+            self.stacks[stack] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join(timeout=1)
+
+
+def _coroutine_stack(task: asyncio.Task) -> Tuple[str, ...]:
+    """
+    任务当前挂起位置的协程调用链（由外到内）
+    task.get_stack() 对挂起的任务只返回最外层协程的帧，这里沿 cr_await 逐层展开到正在等待的 Future
+    """
+    frames = []
+    awaitable = task.get_coro()
+    while awaitable is not None:
+        frame = getattr(awaitable, "cr_frame", None) or getattr(awaitable, "gi_frame", None)
+        if frame is None:
+            break
+        frames.append(f"{frame.f_code.co_filename}:{frame.f_lineno} {frame.f_code.co_name}")
+        awaitable = getattr(awaitable, "cr_await", None) or getattr(awaitable, "gi_yieldfrom", None)
+    return tuple(frames[-Config.PROFILE_STACK_DEPTH:])
+
+
+class _TaskSampler:
+    """
+    在事件循环中周期性采样指定任务的协程调用链
+    只记录该任务挂起（await）的位置，不会把同一事件循环上其他任务的耗时算到这个任务头上
+    """
+
+    def __init__(self, task: asyncio.Task, interval: float):
+        self.task = task
+        self.interval = interval
+        self.stacks: _StackCounter = _StackCounter()
+        self._handle = None
+
+    def start(self):
+        self._handle = asyncio.get_running_loop().call_later(self.interval, self._sample)
+
+    def _sample(self):
+        if self.task.done():
+            return
+        stack = _coroutine_stack(self.task)
+        if stack:
+            self.stacks[stack] += 1
+        self._handle = asyncio.get_running_loop().call_later(self.interval, self._sample)
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+
+
+def _report_slow(stage: str, elapsed_ms: float, threshold_ms: float, stacks: _StackCounter):
+    if elapsed_ms < threshold_ms:
+        return
+    SLOW_REQUESTS.inc(stage=stage)
+    report = [f"慢请求 {stage} 耗时 {elapsed_ms:.0f} ms，采样 {sum(stacks.values())} 次，热点调用栈："]
+    for stack, count in stacks.most_common(Config.PROFILE_TOP_STACKS):
+        report.append(f"  [{count} 次]\n    " + "\n    ".join(stack))
+    logger.warning("\n".join(report))
+
+
+@contextmanager
+def profile_if_slow(stage: str,
+                    threshold_ms: Optional[float] = None,
+                    interval_ms: Optional[float] = None):
+    """
+    可选的采样分析钩子：在后台线程中采样当前线程的调用栈，
+    代码块耗时超过阈值时把出现最多的调用栈写入日志
+    只适用于同步代码块；协程中请使用 profile_task_if_slow（线程采样会采到事件循环上的其他任务）
+    threshold_ms 默认取 Config.PROFILE_SLOW_REQUEST_MS，为 None 时不做采样
+    """
+    threshold_ms = Config.PROFILE_SLOW_REQUEST_MS if threshold_ms is None else threshold_ms
+    if not threshold_ms:
+        yield
+        return
+    sampler = _StackSampler(threading.get_ident(), (interval_ms or Config.PROFILE_SAMPLE_INTERVAL_MS) / 1000)
+    sampler.start()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        sampler.stop()
+        _report_slow(stage, (time.perf_counter() - start) * 1000, threshold_ms, sampler.stacks)
+
+
+@asynccontextmanager
+async def profile_task_if_slow(stage: str,
+                               threshold_ms: Optional[float] = None,
+                               interval_ms: Optional[float] = None):
+    """
+    profile_if_slow 的 asyncio 版本：采样当前任务挂起位置的协程调用链，
+    代码块耗时超过阈值时把出现最多的调用链写入日志（即这个请求主要在等待哪一步）
+    """
+    threshold_ms = Config.PROFILE_SLOW_REQUEST_MS if threshold_ms is None else threshold_ms
+    if not threshold_ms:
+        yield
+        return
+    sampler = _TaskSampler(asyncio.current_task(), (interval_ms or Config.PROFILE_SAMPLE_INTERVAL_MS) / 1000)
+    sampler.start()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        sampler.stop()
+        _report_slow(stage, (time.perf_counter() - start) * 1000, threshold_ms, sampler.stacks)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # 抓取请求频繁，不写访问日志
+        pass
+
+
+def start_metrics_server(port: int = None, host: str = None) -> ThreadingHTTPServer:
+    """在后台线程启动 /metrics 接口（Prometheus 文本格式）"""
+    port = Config.METRICS_PORT if port is None else port
+    host = Config.METRICS_HOST if host is None else host
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="MetricsServer", daemon=True)
+    thread.start()
+    logger.info(f"指标接口已启动: http://{host}:{server.server_address[1]}/metrics")
+    return server
@@ -0,0 +1,403 @@
+import asyncio
+import inspect
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import TYPE_CHECKING, Callable, Dict, Optional
+
+import numpy as np
+
+from config.settings import Config
+from lazy_imports import lazy_import
+from metrics import OPENAI_HEDGED_REQUESTS, OPENAI_REQUEST_SECONDS, OPENAI_RETRIES
+
+# openai / httpx 在首次创建客户端时才加载
+openai = lazy_import("openai")
+httpx = lazy_import("httpx")
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI, OpenAI
+
+logger = logging.getLogger("aiagent_log")
+
+
+class TokenBucket:
+    """
+    令牌桶限流：每秒补充 rate 个令牌，最多积累 capacity 个
+    令牌不足时先预支（余额为负），调用方按欠额等待，并发请求按到达顺序依次放行
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens: float = 1.0) -> float:
+        """预支令牌，返回需要等待的秒数"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self.tokens -= tokens
+            return max(0.0, -self.tokens / self.rate)
+
+    def acquire(self, tokens: float = 1.0):
+        delay = self.reserve(tokens)
+        if delay:
+            time.sleep(delay)
+
+    async def aacquire(self, tokens: float = 1.0):
+        delay = self.reserve(tokens)
+        if delay:
+            await asyncio.sleep(delay)
+
+
+_buckets: Dict[str, Optional[TokenBucket]] = {}
+_buckets_lock = threading.Lock()
+
+
+def get_rate_limiter(model: str) -> Optional[TokenBucket]:
+    """获取模型的令牌桶（进程内共享，同一模型的所有网关共用一个配额），配置为 None 时不限流"""
+    with _buckets_lock:
+        if model in _buckets:
+            return _buckets[model]
+        per_minute = Config.OPENAI_REQUESTS_PER_MINUTE.get(model, Config.OPENAI_DEFAULT_REQUESTS_PER_MINUTE)
+        bucket = None
+        if per_minute:
+            rate = per_minute / 60
+            bucket = TokenBucket(rate, max(1.0, rate * Config.OPENAI_RATE_LIMIT_BURST_SECONDS))
+        _buckets[model] = bucket
+        return bucket
+
+
+def _retryable_errors() -> tuple:
+    """可重试的OpenAI错误：限流、超时、连接错误和服务端错误"""
+    return (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)
+
+
+def _retry_after(error) -> Optional[float]:
+    """读取限流响应的 retry-after 头（秒），没有时返回 None"""
+    response = getattr(error, "response", None)
+    value = getattr(response, "headers", {}).get("retry-after") if response is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class _LatencyWindow:
+    """最近若干次成功请求的耗时，用于计算对冲请求的等待时间"""
+
+    def __init__(self, size: int = 200):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, q: float, min_samples: int = 20) -> Optional[float]:
+        with self._lock:
+            if len(self._samples) < min_samples:
+                return None
+            return float(np.percentile(np.fromiter(self._samples, dtype=np.float64), q))
+
+
+class OpenAIGateway:
+    """
+    所有 OpenAI 请求（对话、流式对话、嵌入）的统一入口
+    - 同步 / 异步客户端各一个，共用带连接上限和 keep-alive 的 httpx 连接池，SDK 自带重试关闭，由网关统一重试
+    - 每个模型一个令牌桶限流（gpt-4o 与嵌入模型分开计算配额）
+    - 可重试错误按指数退避 + 全抖动重试，限流响应带 retry-after 时按其等待
+    - 嵌入请求发出后超过最近耗时的 p95 仍未返回时发出一个对冲请求，取先返回的结果；同步对冲线程池已满时不对冲
+    - 每次请求的耗时按 (model, operation, outcome) 计入 aiagent_openai_request_seconds
+    Args:
+        client / async_client: 可注入的客户端（如离线测试中的替身），未注入时在首次使用时创建
+    """
+
+    def __init__(self, client: Optional["OpenAI"] = None, async_client: Optional["AsyncOpenAI"] = None,
+                 max_retries: int = Config.OPENAI_MAX_RETRIES,
+                 retry_base_delay: float = Config.OPENAI_RETRY_BASE_DELAY,
+                 hedge_embeddings: bool = Config.OPENAI_HEDGE_EMBEDDINGS):
+        self._client = client
+        self._async_client = async_client
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.hedge_embeddings = hedge_embeddings
+        self._lock = threading.Lock()
+        self._latencies: Dict[str, _LatencyWindow] = {}
+        self._hedge_executor: Optional[ThreadPoolExecutor] = None
+        # 对冲线程池的空闲线程数：提交前先占用，保证任务不会在线程池中排队
+        self._hedge_slots = threading.Semaphore(Config.OPENAI_HEDGE_WORKERS)
+
+    @staticmethod
+    def _timeout():
+        return httpx.Timeout(Config.OPENAI_TIMEOUT, connect=Config.OPENAI_CONNECT_TIMEOUT)
+
+    @staticmethod
+    def _limits():
+        return httpx.Limits(max_connections=Config.OPENAI_MAX_CONNECTIONS,
+                            max_keepalive_connections=Config.OPENAI_MAX_KEEPALIVE_CONNECTIONS)
+
+    @property
+    def client(self) -> "OpenAI":
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = openai.OpenAI(
+                        api_key=Config.OPENAI_API_KEY,
+                        max_retries=0,
+                        timeout=self._timeout(),
+                        http_client=openai.DefaultHttpxClient(limits=self._limits(), timeout=self._timeout())
+                    )
+        return self._client
+
+    @property
+    def async_client(self) -> "AsyncOpenAI":
+        if self._async_client is None:
+            with self._lock:
+                if self._async_client is None:
+                    self._async_client = openai.AsyncOpenAI(
+                        api_key=Config.OPENAI_API_KEY,
+                        max_retries=0,
+                        timeout=self._timeout(),
+                        http_client=openai.DefaultAsyncHttpxClient(limits=self._limits(), timeout=self._timeout())
+                    )
+        return self._async_client
+
+    def _retry_delay(self, attempt: int, error, base_delay: float) -> float:
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            return retry_after + random.uniform(0, base_delay)
+        return random.uniform(0, base_delay * (2 ** attempt))
+
+    def _on_error(self, operation: str, model: str, error, attempt: int, max_retries: int,
+                  base_delay: Optional[float]) -> Optional[float]:
+        """记录失败；可以重试时返回等待秒数，否则返回 None（调用方重新抛出）"""
+        if not isinstance(error, _retryable_errors()) or attempt >= max_retries:
+            return None
+        delay = self._retry_delay(attempt, error, self.retry_base_delay if base_delay is None else base_delay)
+        OPENAI_RETRIES.inc(model=model, operation=operation, error=type(error).__name__)
+        logger.warning(f"OpenAI {operation} 请求失败（{type(error).__name__}），{delay:.1f} 秒后第 {attempt + 1} 次重试")
+        return delay
+
+    def _call(self, operation: str, request: Dict, func: Callable,
+              max_retries: Optional[int] = None, base_delay: Optional[float] = None,
+              started: Optional[threading.Event] = None):
+        """started：限流放行、真正发出请求时置位（对冲计时从这里开始）"""
+        model = request.get("model", "default")
+        max_retries = self.max_retries if max_retries is None else max_retries
+        bucket = get_rate_limiter(model)
+        attempt = 0
+        while True:
+            if bucket is not None:
+                bucket.acquire()
+            if started is not None:
+                started.set()
+            start = time.perf_counter()
+            try:
+                result = func(**request)
+            except Exception as e:
+                OPENAI_REQUEST_SECONDS.observe(time.perf_counter() - start, model=model, operation=operation,
+                                               outcome="error")
+                delay = self._on_error(operation, model, e, attempt, max_retries, base_delay)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self._observe(operation, model, time.perf_counter() - start)
+            return result
+
+    async def _acall(self, operation: str, request: Dict, func: Callable,
+                     max_retries: Optional[int] = None, base_delay: Optional[float] = None,
+                     started: Optional[asyncio.Event] = None):
+        model = request.get("model", "default")
+        max_retries = self.max_retries if max_retries is None else max_retries
+        bucket = get_rate_limiter(model)
+        attempt = 0
+        while True:
+            if bucket is not None:
+                await bucket.aacquire()
+            if started is not None:
+                started.set()
+            start = time.perf_counter()
+            try:
+                result = await func(**request)
+            except Exception as e:
+                OPENAI_REQUEST_SECONDS.observe(time.perf_counter() - start, model=model, operation=operation,
+                                               outcome="error")
+                delay = self._on_error(operation, model, e, attempt, max_retries, base_delay)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            self._observe(operation, model, time.perf_counter() - start)
+            return result
+
+    def _observe(self, operation: str, model: str, seconds: float):
+        OPENAI_REQUEST_SECONDS.observe(seconds, model=model, operation=operation, outcome="ok")
+        if operation == "embeddings":
+            self._latency_window(model).add(seconds)
+
+    def _latency_window(self, model: str) -> _LatencyWindow:
+        window = self._latencies.get(model)
+        if window is None:
+            with self._lock:
+                window = self._latencies.setdefault(model, _LatencyWindow())
+        return window
+
+    def _hedge_delay(self, model: str) -> float:
+        """对冲等待时间：最近嵌入耗时的分位数（不低于下限），样本不足时使用默认值"""
+        latency = self._latency_window(model).percentile(Config.OPENAI_HEDGE_PERCENTILE)
+        if latency is None:
+            return Config.OPENAI_HEDGE_DELAY_MS / 1000
+        return max(latency, Config.OPENAI_HEDGE_MIN_DELAY_MS / 1000)
+
+    def chat(self, request: Dict, max_retries: Optional[int] = None, base_delay: Optional[float] = None):
+        """同步对话请求（request 为 chat.completions.create 的参数）"""
+        return self._call("chat", request, self.client.chat.completions.create, max_retries, base_delay)
+
+    async def achat(self, request: Dict, max_retries: Optional[int] = None, base_delay: Optional[float] = None):
+        """
+        异步对话请求；stream=True 时返回流对象，只有建立流之前的失败会重试（已经输出的内容无法重放）
+        """
+        operation = "chat_stream" if request.get("stream") else "chat"
+        return await self._acall(operation, request, self.async_client.chat.completions.create,
+                                 max_retries, base_delay)
+
+    def _submit_embed(self, request: Dict, create: Callable, started: Optional[threading.Event] = None):
+        """在对冲线程池中执行嵌入请求，调用方需已占用一个空闲线程（_hedge_slots）"""
+        if self._hedge_executor is None:
+            with self._lock:
+                if self._hedge_executor is None:
+                    self._hedge_executor = ThreadPoolExecutor(max_workers=Config.OPENAI_HEDGE_WORKERS,
+                                                              thread_name_prefix="openai-hedge")
+
+        def run():
+            try:
+                return self._call("embeddings", request, create, started=started)
+            finally:
+                if started is not None:
+                    started.set()
+                self._hedge_slots.release()
+
+        return self._hedge_executor.submit(run)
+
+    def embed(self, request: Dict):
+        """
+        同步嵌入请求：主请求发出后超过对冲等待时间仍未返回时，再发一个相同请求，取先返回的结果
+        - 对冲计时从主请求真正发出时开始，线程池排队和限流等待都不计入
+        - 对冲线程池没有空闲线程时（并发很高）不做对冲，直接在调用方线程中请求
+        """
+        create = self.client.embeddings.create
+        if not self.hedge_embeddings or not self._hedge_slots.acquire(blocking=False):
+            return self._call("embeddings", request, create)
+        model = request.get("model", "default")
+        started = threading.Event()
+        primary = self._submit_embed(request, create, started)
+        started.wait()
+        done, _ = wait([primary], timeout=self._hedge_delay(model))
+        if done:
+            return primary.result()
+        if not self._hedge_slots.acquire(blocking=False):
+            # 线程池已满，说明上游整体变慢或并发很高，此时对冲只会增加压力
+            return primary.result()
+        OPENAI_HEDGED_REQUESTS.inc(model=model)
+        pending = {primary, self._submit_embed(request, create)}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    # 另一个请求已经发出，无法中止，结果直接丢弃
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    async def aembed(self, request: Dict):
+        """异步嵌入请求，对冲逻辑与 embed 相同，先返回的结果胜出后取消另一个请求"""
+        create = self.async_client.embeddings.create
+        if not self.hedge_embeddings:
+            return await self._acall("embeddings", request, create)
+        model = request.get("model", "default")
+        started = asyncio.Event()
+        pending = {asyncio.ensure_future(self._acall("embeddings", request, create, started=started))}
+        try:
+            # 与 embed 相同，对冲计时从主请求通过限流、真正发出时开始
+            started_waiter = asyncio.ensure_future(started.wait())
+            await asyncio.wait(pending | {started_waiter}, return_when=asyncio.FIRST_COMPLETED)
+            started_waiter.cancel()
+            done, _ = await asyncio.wait(pending, timeout=self._hedge_delay(model))
+            if done:
+                return done.pop().result()
+            OPENAI_HEDGED_REQUESTS.inc(model=model)
+            pending.add(asyncio.ensure_future(self._acall("embeddings", request, create)))
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def close(self):
+        """关闭同步客户端的连接池和对冲线程池（异步客户端需在事件循环中调用 aclose）"""
+        if self._hedge_executor is not None:
+            self._hedge_executor.shutdown(wait=False)
+        if self._client is not None and hasattr(self._client, "close"):
+            self._client.close()
+
+    async def aclose(self):
+        if self._async_client is not None and hasattr(self._async_client, "close"):
+            await self._async_client.close()
+
+
+_gateway: Optional[OpenAIGateway] = None
+_gateway_lock = threading.Lock()
+
+
+def get_gateway() -> OpenAIGateway:
+    """获取进程内共享的 OpenAI 网关（共用连接池、限流配额和耗时统计）"""
+    global _gateway
+    if _gateway is None:
+        with _gateway_lock:
+            if _gateway is None:
+                _gateway = OpenAIGateway()
+    return _gateway
+
+
+def as_gateway(client=None) -> OpenAIGateway:
+    """
+    把调用方传入的客户端统一成网关：
+    - None 返回共享网关
+    - 已经是网关时原样返回
+    - OpenAI / AsyncOpenAI（或测试替身）包装成使用该客户端的网关，限流配额仍按模型共享；
+      按客户端类型只注入对应的同步或异步位置，另一种客户端在首次使用时创建
+    """
+    if client is None:
+        return get_gateway()
+    if isinstance(client, OpenAIGateway):
+        return client
+    if _is_async_client(client):
+        return OpenAIGateway(async_client=client)
+    return OpenAIGateway(client=client)
+
+
+def _is_async_client(client) -> bool:
+    """AsyncOpenAI（或异步替身）的接口方法是协程函数；不导入 openai，只检查 embeddings / chat 接口"""
+    for create in (getattr(getattr(client, "embeddings", None), "create", None),
+                   getattr(getattr(getattr(client, "chat", None), "completions", None), "create", None)):
+        if create is not None:
+            return inspect.iscoroutinefunction(create)
+    return False
@@ -0,0 +1,144 @@
+import logging
+import os
+import time
+from typing import Optional
+
+import numpy as np
+
+from config.settings import Config
+
+logger = logging.getLogger("aiagent_log")
+
+METHODS = ("int8", "binary")
+
+
+def quantize_int8(matrix: np.ndarray):
+    """
+    按维度对称的标量量化：codes = round(x / scale)，scale = 该维最大绝对值 / 127
+    Returns:
+        (int8 编码矩阵, 每维 float32 缩放系数)
+    """
+    scale = np.abs(matrix).max(axis=0) / 127 if len(matrix) else np.ones(matrix.shape[1])
+    scale = np.maximum(scale, 1e-12).astype(np.float32)
+    codes = np.clip(np.rint(matrix / scale), -127, 127).astype(np.int8)
+    return codes, scale
+
+
+def quantize_binary(matrix: np.ndarray):
+    """
+    二值量化：每维只保留符号位，按行打包为 uint8（每 8 维 1 字节）
+    Returns:
+        (打包后的编码矩阵, 每维 float32 缩放系数，取该维的平均绝对值，使 scale * ±1 的点积与原向量同量级)
+    """
+    scale = np.abs(matrix).mean(axis=0) if len(matrix) else np.ones(matrix.shape[1])
+    return np.packbits(matrix > 0, axis=1), np.maximum(scale, 1e-12).astype(np.float32)
+
+
+def int8_dots(codes: np.ndarray, scale: np.ndarray, queries: np.ndarray,
+              chunk_size: int = Config.QUANTIZED_SCAN_CHUNK) -> np.ndarray:
+    """
+    查询向量与 int8 编码的近似点积 (q * scale) · codes，(m, n)
+    编码分块转换为 float32 参与矩阵乘法，临时内存不超过 chunk_size 行
+    """
+    scaled = (queries * scale).astype(np.float32)
+    dots = np.empty((len(queries), len(codes)), dtype=np.float32)
+    for start in range(0, len(codes), chunk_size):
+        block = np.asarray(codes[start:start + chunk_size], dtype=np.float32)
+        dots[:, start:start + len(block)] = scaled @ block.T
+    return dots
+
+
+def binary_dots(codes: np.ndarray, scale: np.ndarray, queries: np.ndarray, dimensions: int,
+                chunk_size: int = Config.QUANTIZED_SCAN_CHUNK) -> np.ndarray:
+    """
+    查询向量（保持浮点，非对称打分）与二值编码的近似点积 (q * scale) · sign(x)，(m, n)
+    sign(x) = 2 * bit - 1，编码分块解包为 0/1 后做矩阵乘法
+    """
+    scaled = (queries * scale).astype(np.float32)
+    offsets = scaled.sum(axis=1)[:, None]
+    dots = np.empty((len(queries), len(codes)), dtype=np.float32)
+    for start in range(0, len(codes), chunk_size):
+        bits = np.unpackbits(np.asarray(codes[start:start + chunk_size]), axis=1, count=dimensions)
+        dots[:, start:start + len(bits)] = 2 * (scaled @ bits.T.astype(np.float32)) - offsets
+    return dots
+
+
+class QuantizedIndex:
+    """
+    保存在磁盘上的量化索引，按 NumPy .npy 格式写入，以内存映射方式读取：
+    - {name}.codes.npy：int8 编码（每维 1 字节）或二值编码（每 8 维 1 字节），检索时全量扫描
+    - {name}.vectors.npy：行归一化的 float32 向量，只有重打分的少量候选行会被读入内存
+    - {name}.meta.npz：id、向量模长、每维缩放系数和构建时的集合版本号
+    写入时先写临时文件再替换，已打开的内存映射不受影响
+    """
+
+    def __init__(self, name: str, method: str = Config.QUANTIZED_METHOD, directory: Optional[str] = None):
+        if method not in METHODS:
+            raise ValueError(f"未知的量化方式: {method}")
+        self.method = method
+        self.directory = directory or os.path.join(Config.PERSIST_DIR, "quantized")
+        self.prefix = os.path.join(self.directory, f"{name}.{method}")
+        self.ids: list = []
+        self.norms = np.zeros(0, dtype=np.float32)
+        self.scale: Optional[np.ndarray] = None
+        self.codes: Optional[np.ndarray] = None
+        self.vectors: Optional[np.ndarray] = None
+        self.version = None
+
+    def _path(self, suffix: str) -> str:
+        return f"{self.prefix}.{suffix}"
+
+    def build(self, ids: list, vectors: np.ndarray, version=None):
+        """由集合中的全部嵌入（即写入时 init_data.get_embedding 生成的向量）构建索引并写入磁盘"""
+        start = time.perf_counter()
+        os.makedirs(self.directory, exist_ok=True)
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(ids), -1)
+        norms = np.linalg.norm(vectors, axis=1).astype(np.float32)
+        matrix = vectors / np.maximum(norms, 1e-12)[:, None]
+        codes, scale = quantize_int8(matrix) if self.method == "int8" else quantize_binary(matrix)
+        tmp = f".{os.getpid()}.tmp"
+        for suffix, array in (("codes.npy", codes), ("vectors.npy", matrix)):
+            # 用 open_memmap 写入，不在内存中额外保留一份
+            out = np.lib.format.open_memmap(self._path(suffix) + tmp, mode="w+", dtype=array.dtype, shape=array.shape)
+            out[:] = array
+            out.flush()
+            del out
+        np.savez(self._path("meta.npz") + tmp + ".npz", ids=np.asarray(ids, dtype=str), norms=norms, scale=scale,
+                 version=np.asarray(-1 if version is None else version))
+        # 元数据最后替换，读取方以它为准判断索引是否完整
+        os.replace(self._path("codes.npy") + tmp, self._path("codes.npy"))
+        os.replace(self._path("vectors.npy") + tmp, self._path("vectors.npy"))
+        os.replace(self._path("meta.npz") + tmp + ".npz", self._path("meta.npz"))
+        logger.info(f"量化索引（{self.method}）构建完成：{len(ids)} 条，"
+                    f"编码 {codes.nbytes / 1024 / 1024:.1f} MB，耗时 {(time.perf_counter() - start) * 1000:.1f} ms")
+        return self.load()
+
+    def load(self) -> bool:
+        """以内存映射方式打开磁盘上的索引，文件不存在或不完整时返回 False"""
+        try:
+            with np.load(self._path("meta.npz"), allow_pickle=False) as meta:
+                ids = [str(i) for i in meta["ids"]]
+                norms = meta["norms"]
+                scale = meta["scale"]
+                version = int(meta["version"])
+            codes = np.load(self._path("codes.npy"), mmap_mode="r")
+            vectors = np.load(self._path("vectors.npy"), mmap_mode="r")
+        except (OSError, KeyError, ValueError):
+            return False
+        if len(codes) != len(ids) or len(vectors) != len(ids):
+            return False
+        self.ids, self.norms, self.scale, self.codes, self.vectors = ids, norms, scale, codes, vectors
+        self.version = None if version < 0 else version
+        return True
+
+    def dots(self, queries: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """查询向量与（部分行的）量化编码的近似点积，rows 为 None 时扫描全部行"""
+        codes = self.codes if rows is None else self.codes[rows]
+        if self.method == "int8":
+            return int8_dots(codes, self.scale, queries)
+        return binary_dots(codes, self.scale, queries, self.vectors.shape[1])
+
+    @property
+    def nbytes(self) -> int:
+        """检索时需要常驻内存的字节数（量化编码 + 模长）"""
+        return (self.codes.nbytes if self.codes is not None else 0) + self.norms.nbytes
@@ -0,0 +1,145 @@
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from config.settings import Config
+
+
+def _as_number(value) -> float:
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return 0.0
+    return float(value)
+
+
+class PriorityBoost:
+    """
+    业务规则加权：排序分数 = 相似度 + weight * metadata[field]
+    元数据中没有该字段（或不是数值）时按 0 处理；只影响排序，不修改结果中的 score
+    """
+
+    name = "priority"
+    needs_embeddings = False
+
+    def __init__(self, field: str = Config.RERANK_PRIORITY_FIELD, weight: float = Config.RERANK_PRIORITY_WEIGHT):
+        self.field = field
+        self.weight = weight
+
+    def __call__(self, hits: Sequence, scores: np.ndarray, embeddings: Optional[np.ndarray],
+                 top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        boosts = np.fromiter(
+            (_as_number((hit["metadata"] or {}).get(self.field)) for hit in hits), dtype=np.float64, count=len(hits)
+        )
+        scores = scores + self.weight * boosts
+        return np.argsort(-scores, kind="stable"), scores
+
+
+class MaximalMarginalRelevance:
+    """
+    最大边际相关性：每次选出 lambda * 相关性 - (1 - lambda) * 与已选结果的最大余弦相似度 最高的候选
+    候选向量与检索结果一起返回；没有向量的候选（如 hybrid 中只被 BM25 命中的结果）不参与相似度惩罚
+    """
+
+    name = "mmr"
+    needs_embeddings = True
+
+    def __init__(self, lambda_: float = Config.RERANK_MMR_LAMBDA):
+        self.lambda_ = lambda_
+
+    def __call__(self, hits: Sequence, scores: np.ndarray, embeddings: Optional[np.ndarray],
+                 top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        count = len(hits)
+        if embeddings is None or count < 2:
+            return np.arange(count), scores
+        vectors = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1), 1e-12)[:, None]
+        similarity = vectors @ vectors.T
+        max_similarity = np.zeros(count, dtype=np.float64)
+        remaining = np.ones(count, dtype=bool)
+        relevance = self.lambda_ * scores
+        order = []
+        # 只需要贪心选出前 top_k 个，其余候选保持原有顺序排在后面
+        for _ in range(min(top_k, count)):
+            marginal = np.where(remaining, relevance - (1 - self.lambda_) * max_similarity, -np.inf)
+            best = int(np.argmax(marginal))
+            order.append(best)
+            remaining[best] = False
+            np.maximum(max_similarity, similarity[best], out=max_similarity)
+        order.extend(np.flatnonzero(remaining).tolist())
+        return np.asarray(order, dtype=np.int64), scores
+
+
+class CategoryDedup:
+    """同一类别最多保留 max_per_category 个结果（按当前顺序），没有类别字段的结果不受限制"""
+
+    name = "category_dedup"
+    needs_embeddings = False
+
+    def __init__(self, field: str = Config.RERANK_CATEGORY_FIELD,
+                 max_per_category: int = Config.RERANK_MAX_PER_CATEGORY):
+        self.field = field
+        self.max_per_category = max_per_category
+
+    def __call__(self, hits: Sequence, scores: np.ndarray, embeddings: Optional[np.ndarray],
+                 top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        counts = {}
+        order = []
+        for i, hit in enumerate(hits):
+            category = (hit["metadata"] or {}).get(self.field)
+            if category is not None:
+                if counts.get(category, 0) >= self.max_per_category:
+                    continue
+                counts[category] = counts.get(category, 0) + 1
+            order.append(i)
+        return np.asarray(order, dtype=np.int64), scores
+
+
+class Reranker:
+    """
+    检索结果的重排序流水线：候选先按 score 降序，再依次经过各个阶段，最后截取 top_k
+    每个阶段接收 (hits, 排序分数, 候选向量, top_k)，返回新的顺序（可以丢弃候选）和排序分数
+    """
+
+    STAGES = {
+        PriorityBoost.name: PriorityBoost,
+        MaximalMarginalRelevance.name: MaximalMarginalRelevance,
+        CategoryDedup.name: CategoryDedup
+    }
+
+    def __init__(self, stages: Sequence = ()):
+        self.stages = list(stages)
+
+    @property
+    def needs_embeddings(self) -> bool:
+        """是否需要在检索时一并返回候选向量"""
+        return any(stage.needs_embeddings for stage in self.stages)
+
+    def rerank(self, hits: Sequence, embeddings: Optional[np.ndarray] = None,
+               top_k: Optional[int] = None) -> List:
+        """
+        Args:
+            hits: 检索结果（SearchHit 或 dict）
+            embeddings: 与 hits 一一对应的向量矩阵，可为 None
+            top_k: 返回结果数量，None 表示全部返回
+        """
+        hits = list(hits)
+        if not hits:
+            return hits
+        top_k = len(hits) if top_k is None else top_k
+        scores = np.fromiter((hit["score"] for hit in hits), dtype=np.float64, count=len(hits))
+        order = np.argsort(-scores, kind="stable")
+        for stage in [None] + self.stages:
+            if stage is not None:
+                order, scores = stage(hits, scores, embeddings, top_k)
+            hits = [hits[i] for i in order]
+            scores = scores[order]
+            if embeddings is not None:
+                embeddings = embeddings[order]
+        return hits[:top_k]
+
+
+def create_reranker(stages: Optional[Sequence[str]] = None) -> Reranker:
+    """按阶段名称创建重排序流水线，如 ("priority", "mmr", "category_dedup")，默认为 Config.RERANK_STAGES"""
+    stages = Config.RERANK_STAGES if stages is None else stages
+    unknown = [name for name in stages if name not in Reranker.STAGES]
+    if unknown:
+        raise ValueError(f"未知的重排序阶段: {unknown}")
+    return Reranker([Reranker.STAGES[name]() for name in stages])
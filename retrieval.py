@@ -1,56 +1,217 @@
-from openai import OpenAI
-import chromadb
 from config.settings import Config
-from typing import List, Dict, Optional
+from typing import TYPE_CHECKING, List, Dict, Optional
 import numpy as np
-from functools import lru_cache
 import hashlib
 import json
+import logging
+import threading
 import time
+from cache import RecommendationCache, create_result_cache
+from embedding_store import embed_texts, get_embedding_store
+from embedding_providers import get_embedding_provider
+from embedding_schema import validate_collection_schema
+from vector_backends import create_backend
+from collection_version import get_collection_version
+from lexical_index import LexicalIndex, reciprocal_rank_fusion
+from init_data import register_ingest_listener
+from search_results import DocumentStore, SearchHit, decode_hits, encode_hits
+from reranking import create_reranker
+from category_router import CategoryRouter
+from single_flight import SingleFlight
+from metrics import REGISTRY, SEARCH_PATHS, profile_if_slow, record_cache_event, record_usage, stage_timer
+from lazy_imports import lazy_import
+from openai_gateway import OpenAIGateway, as_gateway
+
+# chromadb 导入较慢，首次使用时才加载（openai 由网关延迟加载）；只导入本模块不会加载它们（也不会加载 gradio）
+chromadb = lazy_import("chromadb")
+
+if TYPE_CHECKING:
+    from openai import OpenAI
+
+logger = logging.getLogger("aiagent_log")
+
+def build_enhanced_query(user_prompt: str, recommendation: str) -> str:
+    """将用户需求与agent推荐拼接成增强查询文本"""
+    return f"""
+            用户需求: {user_prompt}
+            推荐Agent类型和描述: {recommendation}
+            """
+
+class _OpenedAttribute:
+    """VectorRetriever 中依赖 Chroma 集合的属性：首次访问时才打开集合并创建"""
+
+    def __set_name__(self, owner, name):
+        self.attribute = "_" + name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        instance._open()
+        return getattr(instance, self.attribute)
+
 
 class VectorRetriever:
-    def __init__(self, cache_ttl: int = 3600):
-        self.client = OpenAI(api_key=Config.OPENAI_API_KEY)
-        self.chroma_client = chromadb.PersistentClient(path=Config.PERSIST_DIR)
-        self.collection = self.chroma_client.get_collection(Config.COLLECTION_NAME)
+    # 依赖 Chroma 集合的句柄在首次使用时由 _open 一次性创建
+    chroma_client = _OpenedAttribute()
+    collection = _OpenedAttribute()
+    embedding_schema = _OpenedAttribute()
+    backend = _OpenedAttribute()
+    document_store = _OpenedAttribute()
+    category_router = _OpenedAttribute()
+
+    def __init__(self,
+                 cache_ttl: int = Config.CACHE_TTL,
+                 cache_max_entries: int = Config.CACHE_MAX_ENTRIES,
+                 cache_max_bytes: int = Config.CACHE_MAX_BYTES,
+                 client: Optional["OpenAI"] = None):
+        # 允许注入客户端或网关（如离线基准测试中的 OpenAI 替身）；未注入时使用共享的 OpenAI 网关
+        self._client = client
+        self._gateway = None
+        self._embedding_provider = None
+        # OpenAI 客户端和 Chroma 集合都延迟到首次使用时创建，构造检索器本身不访问网络和磁盘上的向量库
+        self._open_lock = threading.RLock()
+        self._chroma_client = None
+        self.collection_name = Config.COLLECTION_NAME
+        # 集合版本号：写入时递增，并入结果缓存键，数据变化后缓存立即失效
+        self.collection_version = get_collection_version()
+        # 首次检索时才读取（版本号本身并入缓存键，首次读取不需要清空缓存）
+        self._cache_version = None
         self.cache_ttl = cache_ttl  # 缓存过期时间（秒）
-        self.cache = {}  # 简单的内存缓存
+        # 有界的 LRU + TTL 缓存，后台定期清理过期条目；
+        # 配置了共享缓存时作为一级缓存，二级缓存由同一主机上的所有 worker 共享
+        self.cache = create_result_cache(
+            backend=Config.SHARED_CACHE_BACKEND,
+            ttl=cache_ttl,
+            max_entries=cache_max_entries,
+            max_bytes=cache_max_bytes,
+            sweep_interval=Config.CACHE_SWEEP_INTERVAL,
+            shared_path=Config.SHARED_CACHE_PATH,
+            shared_url=Config.SHARED_CACHE_URL,
+            shared_max_entries=Config.SHARED_CACHE_MAX_ENTRIES,
+            encode=encode_hits,
+            decode=lambda data: decode_hits(data, self.document_store)
+        )
+        # agent推荐缓存（精确 + 语义近似匹配）
+        self.recommendation_cache = RecommendationCache(
+            ttl=Config.RECOMMEND_CACHE_TTL,
+            max_entries=Config.RECOMMEND_CACHE_MAX_ENTRIES,
+            semantic_distance=Config.RECOMMEND_CACHE_SEMANTIC_DISTANCE
+        )
+        # 持久化嵌入缓存，进程重启后无需重新调用嵌入接口
+        self.embedding_store = get_embedding_store()
+        # 重排序流水线（优先级加权 / MMR 多样性 / 类别去重，由 Config.RERANK_STAGES 决定）
+        self.reranker = create_reranker()
+        # 合并并发的相同 search / get_embedding / recommend_agent 调用，热门问题同时到达时只请求一次上游
+        self.single_flight = SingleFlight()
+        # 本地 BM25 索引：默认模式需要时在加载阶段构建，否则在首次 hybrid/lexical 检索时构建
+        self.lexical_index: Optional[LexicalIndex] = None
+        self._lexical_lock = threading.Lock()
+        if Config.SEARCH_MODE != "vector":
+            self._get_lexical_index()
+
+    def _open(self):
+        """打开 Chroma 集合，并创建依赖集合的校验、检索后端、文档缓存和类别路由"""
+        if self._chroma_client is not None:
+            return
+        with self._open_lock:
+            if self._chroma_client is not None:
+                return
+            start = time.perf_counter()
+            chroma_client = chromadb.PersistentClient(path=Config.PERSIST_DIR)
+            collection = chroma_client.get_collection(self.collection_name)
+            # 校验集合记录的嵌入模型/维度与当前配置一致，避免索引和查询混用不同模型
+            self._embedding_schema = validate_collection_schema(collection)
+            self._collection = collection
+            # 检索后端：Chroma HNSW 或内存 NumPy 精确检索（由 Config.VECTOR_BACKEND 决定）
+            self._backend = create_backend(collection, version=self.collection_version)
+            # 检索结果只保存 id / 分数 / 元数据，agent文档在调用方需要时才从集合读取
+            self._document_store = DocumentStore(collection, version=self.collection_version)
+            # 类别路由：先选出与查询最相近的几个类别，向量检索只在这些类别中进行
+            self._category_router = CategoryRouter(
+                collection,
+                version=self.collection_version,
+                top_n=Config.CATEGORY_ROUTING_TOP_N if self._backend.name in Config.CATEGORY_ROUTING_BACKENDS else 0
+            )
+            self._chroma_client = chroma_client
+            logger.info(f"已打开集合 {self.collection_name}，耗时 {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    @property
+    def gateway(self) -> OpenAIGateway:
+        """OpenAI 网关：未注入客户端时使用进程内共享的网关（连接池、限流、重试）"""
+        if self._gateway is None:
+            with self._open_lock:
+                if self._gateway is None:
+                    self._gateway = as_gateway(self._client)
+        return self._gateway
+
+    @property
+    def client(self) -> "OpenAI":
+        return self.gateway.client
+
+    @property
+    def embedding_provider(self):
+        """嵌入提供方（OpenAI 或本地模型），与集合记录的嵌入模式一致"""
+        if self._embedding_provider is None:
+            with self._open_lock:
+                if self._embedding_provider is None:
+                    self._embedding_provider = get_embedding_provider(self.gateway)
+        return self._embedding_provider
 
-    def _generate_cache_key(self, query: str, top_k: int, filters: Optional[Dict], min_score: float) -> str:
-        """生成缓存键"""
+    def _get_lexical_index(self) -> LexicalIndex:
+        """获取本地 BM25 索引（懒加载），并注册写入回调使其随 ingest_agents 增量更新"""
+        if self.lexical_index is None:
+            with self._lexical_lock:
+                if self.lexical_index is None:
+                    self.lexical_index = LexicalIndex(self.collection, version=self.collection_version)
+                    register_ingest_listener(self._on_ingest)
+        return self.lexical_index
+
+    def _on_ingest(self, collection, ids: List[str], documents: List[str], metadatas: List[Dict], version: int):
+        if collection.id == self.collection.id and self.lexical_index is not None:
+            self.lexical_index.upsert(ids, documents, metadatas, version=version)
+
+    def _generate_cache_key(self, query: str, top_k: int, filters: Optional[Dict], min_score: float,
+                            mode: str = "vector") -> str:
+        """生成缓存键（包含集合版本号）"""
         cache_dict = {
+            'version': self._current_version(),
             'query': query,
             'top_k': top_k,
             'filters': filters,
-            'min_score': min_score
+            'min_score': min_score,
+            'mode': mode
         }
         cache_str = json.dumps(cache_dict, sort_keys=True)
         return hashlib.md5(cache_str.encode()).hexdigest()
 
-    def _get_from_cache(self, cache_key: str) -> Optional[List[Dict]]:
+    def _current_version(self) -> int:
+        """读取集合版本号；版本变化时清空结果缓存，旧版本的条目不会再被命中"""
+        version = self.collection_version.get(self.collection_name)
+        if self._cache_version is None:
+            self._cache_version = version
+        elif version != self._cache_version:
+            self._cache_version = version
+            self.cache.clear()
+            logger.info(f"集合 {self.collection_name} 版本号变为 {version}，已清空检索结果缓存")
+        return version
+
+    def _get_from_cache(self, cache_key: str) -> Optional[List[SearchHit]]:
         """从缓存中获取结果"""
-        if cache_key in self.cache:
-            cached_result, timestamp = self.cache[cache_key]
-            if time.time() - timestamp < self.cache_ttl:
-                return cached_result
-            else:
-                # 删除过期缓存
-                del self.cache[cache_key]
-        return None
+        cached_results = self.cache.get(cache_key)
+        record_cache_event("search_result", cached_results is not None)
+        return cached_results
     
-    def _save_to_cache(self, cache_key: str, results: List[Dict]):
+    def _save_to_cache(self, cache_key: str, results: List[SearchHit]):
         """保存结果到缓存"""
-        self.cache[cache_key] = (results, time.time())
+        self.cache.set(cache_key, results)
+
+    def cache_stats(self) -> Dict:
+        """返回检索结果缓存的命中/未命中/淘汰统计"""
+        return self.cache.stats()
 
     # 在VectorRetriever类中添加新方法
-    def recommend_agent(self, user_prompt: str) -> Dict:
-        """
-        根据用户的Prompt推荐合适的agent类型
-        Args:
-            user_prompt: 用户的输入prompt
-        Returns:
-            Dict: 包含推荐的agent类型和描述的字典
-        """
+    def _build_recommend_request(self, user_prompt: str) -> Dict:
+        """构造agent推荐的chat请求参数（同步和异步检索器共用）"""
         system_prompt = """你是一个AI助手专家，你的任务是根据用户的需求推荐最合适的agent类型（从行业领域角度划分的类型）。
         分析用户的需求，并推荐一个或多个最适合的agent类型。在描述的时候尽可能减少AI词汇的属性，因为在数据库中每个agent描述都自带AI字眼。
         返回格式应包含：
@@ -60,17 +221,57 @@ class VectorRetriever:
 
         user_message = f"基于以下用户需求，请推荐合适的AI agent类型：{user_prompt}"
 
-        response = self.client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
+        request = {
+            "model": "gpt-4o",
+            "messages": [
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": user_message}
             ],
-            temperature=0.7,
-            max_tokens=500
-        )
+            "temperature": Config.RECOMMEND_TEMPERATURE,
+            "max_tokens": 500
+        }
+        if Config.RECOMMEND_DETERMINISTIC:
+            # 推荐结果会被缓存复用，使用确定性生成参数
+            request["temperature"] = 0
+            request["seed"] = Config.RECOMMEND_SEED
+        return request
+
+    def recommendation_cache_stats(self) -> Dict:
+        """返回agent推荐缓存的精确/语义命中率统计"""
+        return self.recommendation_cache.stats()
+
+    def recommend_agent(self, user_prompt: str) -> Dict:
+        """
+        根据用户的Prompt推荐合适的agent类型
+        Args:
+            user_prompt: 用户的输入prompt
+        Returns:
+            Dict: 包含推荐的agent类型和描述的字典
+        """
+        return self.single_flight.do(("recommend_agent", user_prompt), self._recommend_agent, user_prompt)
+
+    def _recommend_agent(self, user_prompt: str) -> Dict:
+        # 先查推荐缓存：精确匹配，再按嵌入做语义近似匹配
+        recommendation = self.recommendation_cache.get(user_prompt)
+        prompt_embedding = None
+        if recommendation is None and self.recommendation_cache.semantic_distance is not None:
+            prompt_embedding = self.get_embedding(user_prompt)
+            recommendation = self.recommendation_cache.get_similar(prompt_embedding)
+        record_cache_event("recommendation", recommendation is not None)
+        if recommendation is not None:
+            return {
+                "user_prompt": user_prompt,
+                "agent_recommendation": recommendation
+            }
+        self.recommendation_cache.record_miss()
+
+        request = self._build_recommend_request(user_prompt)
+        with stage_timer("recommend_agent"):
+            response = self.gateway.chat(request)
+        record_usage(request["model"], getattr(response, "usage", None))
 
         recommendation = response.choices[0].message.content
+        self.recommendation_cache.set(user_prompt, recommendation, prompt_embedding)
 
         # 将返回结果构造成字典格式
         return {
@@ -78,81 +279,276 @@ class VectorRetriever:
             "agent_recommendation": recommendation
         }
 
-    @lru_cache(maxsize=1000)
     def get_embedding(self, text: str) -> list:
-        response = self.client.embeddings.create(
-            input=text,
-            model="text-embedding-ada-002"
-        )
-        return response.data[0].embedding
+        return self.single_flight.do(("get_embedding", text), self._get_embedding, text)
+
+    def _get_embedding(self, text: str) -> list:
+        with stage_timer("get_embedding"):
+            return embed_texts(
+                self.gateway,
+                [text],
+                store=self.embedding_store,
+                provider=self.embedding_provider
+            )[0]
 
     def search(self,
                query: str,
                top_k: int = 3,
                filters: Optional[Dict] = None,
-               min_score: float = 0.4) -> List[Dict]:
+               min_score: float = 0.4,
+               mode: Optional[str] = None) -> List[SearchHit]:
         """
         混合检索方法 -> 带缓存的混合检索方法
         Args:
             query: 查询文本
             top_k: 返回结果数量
             filters: 元数据过滤条件, 如 {"category": "finance"}
-            min_score: 最小相似度阈值
+            min_score: 最小相似度阈值（lexical 结果按归一化 BM25 分数过滤）
+            mode: "vector" / "hybrid" / "lexical"，默认取 Config.SEARCH_MODE
+        Returns:
+            SearchHit 列表，支持 hit["id"] / hit["document"] 等字典式访问，document 首次访问时才加载
         """
+        mode = mode or Config.SEARCH_MODE
 
         # 生成缓存键
-        cache_key = self._generate_cache_key(query, top_k, filters, min_score)
+        cache_key = self._generate_cache_key(query, top_k, filters, min_score, mode)
         
         # 尝试从缓存获取结果
         cached_results = self._get_from_cache(cache_key)
         if cached_results is not None:
             return cached_results
-        
-        # 如果缓存未命中，执行检索, 生成查询向量
-        query_embedding = self.get_embedding(query)
-        # 构建查询参数
-        query_params = {
-            "query_embeddings": [query_embedding],
-            "n_results": top_k * 2
-        }
-        
-        # 只有在有过滤条件时才添加 where 参数
-        if filters:
-            query_params["where"] = filters
-            
-        results = self.collection.query(
-            **query_params
+        # 缓存未命中：相同的检索正在进行时等待其结果
+        return self.single_flight.do(
+            ("search", cache_key), self._search, query, top_k, filters, min_score, mode, cache_key
         )
-        # 整理检索结果
-        search_results = []
-        for i in range(len(results["ids"][0])):
-            # 计算归一化相似度分数 (1 - distance)
-            similarity_score = 1 - results["distances"][0][i]
-            # 应用相似度阈值过滤
-            if similarity_score < min_score:
-                continue
-            # 获取元数据
-            metadata = results["metadatas"][0][i] if "metadatas" in results else {}
-            result = {
-            "id": results["ids"][0][i],
-                "score": similarity_score,
-                "document": results["documents"][0][i],
-                "metadata": metadata
-            }
-           
-            search_results.append(result)
-        # 结果排序（综合考虑相似度分数和业务规则）
-        search_results = self._rank_results(search_results)
-        final_results = search_results[:top_k]
+
+    def _search(self, query: str, top_k: int, filters: Optional[Dict], min_score: float, mode: str,
+                cache_key: str) -> List[SearchHit]:
+        # 关键词检索：lexical 模式或高置信度的关键词查询直接返回，不调用嵌入接口
+        lexical_hits, final_results = self._lexical_first(query, top_k, filters, min_score, mode)
+        if final_results is None:
+            # 如果缓存未命中，执行检索, 生成查询向量
+            query_embedding = self.get_embedding(query)
+            with stage_timer("collection_query"):
+                results = self.backend.query(
+                    **self._build_query_params([query_embedding], top_k, filters)
+                )
+            final_results = self._finish_vector_results(results, lexical_hits, top_k, min_score, mode)
         # 保存到缓存
         self._save_to_cache(cache_key, final_results)
         return final_results
+
+    def search_many(self,
+                    queries: List[str],
+                    top_k: int = 3,
+                    filters: Optional[Dict] = None,
+                    min_score: float = 0.4,
+                    mode: Optional[str] = None) -> List[List[SearchHit]]:
+        """
+        批量检索：去重后先查缓存，未命中的查询合并为一次（分块的）嵌入请求；
+        每个查询按各自的类别路由结果检索，路由结果相同的查询合并为一次 Chroma 查询
+        Args:
+            queries: 查询文本列表
+            top_k: 每个查询返回结果数量
+            filters: 元数据过滤条件，对所有查询生效
+            min_score: 最小相似度阈值
+            mode: 检索模式，同 search
+        Returns:
+            与 queries 一一对应的检索结果列表
+        """
+        mode = mode or Config.SEARCH_MODE
+        results_by_query = {}
+        missed_queries = []
+        missed_keys = []
+        missed_lexical_hits = []
+        for query in dict.fromkeys(queries):
+            cache_key = self._generate_cache_key(query, top_k, filters, min_score, mode)
+            cached_results = self._get_from_cache(cache_key)
+            if cached_results is not None:
+                results_by_query[query] = cached_results
+                continue
+            lexical_hits, final_results = self._lexical_first(query, top_k, filters, min_score, mode)
+            if final_results is not None:
+                self._save_to_cache(cache_key, final_results)
+                results_by_query[query] = final_results
+            else:
+                missed_queries.append(query)
+                missed_keys.append(cache_key)
+                missed_lexical_hits.append(lexical_hits)
+
+        if missed_queries:
+            with stage_timer("get_embedding_batch"):
+                query_embeddings = embed_texts(
+                    self.gateway,
+                    missed_queries,
+                    store=self.embedding_store,
+                    provider=self.embedding_provider
+                )
+            # 按 where 分组：用整个批次类别的并集检索会让每个查询的候选集都变大，结果也与单条 search 不一致
+            with stage_timer("category_routing"):
+                wheres = self.category_router.apply_each(query_embeddings, filters)
+            groups = {}
+            for row, where in enumerate(wheres):
+                groups.setdefault(json.dumps(where, sort_keys=True, ensure_ascii=False), (where, []))[1].append(row)
+            for where, rows in groups.values():
+                with stage_timer("collection_query_batch"):
+                    results = self.backend.query(
+                        **self._query_params([query_embeddings[row] for row in rows], top_k, where)
+                    )
+                for i, row in enumerate(rows):
+                    final_results = self._finish_vector_results(
+                        results, missed_lexical_hits[row], top_k, min_score, mode, row=i
+                    )
+                    self._save_to_cache(missed_keys[row], final_results)
+                    results_by_query[missed_queries[row]] = final_results
+
+        return [results_by_query[query] for query in queries]
+
+    def _lexical_first(self, query: str, top_k: int, filters: Optional[Dict], min_score: float, mode: str):
+        """
+        向量检索之前的关键词检索阶段
+        Returns:
+            (lexical_hits, final_results)：final_results 不为 None 时说明无需再做向量检索
+        """
+        if mode == "vector":
+            SEARCH_PATHS.inc(path="vector")
+            return None, None
+        if mode not in ("hybrid", "lexical"):
+            raise ValueError(f"未知的检索模式: {mode}")
+        with stage_timer("lexical_search"):
+            lexical_hits = self._get_lexical_index().search(query, top_k * 2, filters)
+        if mode == "lexical" or self._is_confident_lexical(lexical_hits):
+            SEARCH_PATHS.inc(path="lexical" if mode == "lexical" else "lexical_fast_path")
+            return lexical_hits, self._lexical_results(lexical_hits, top_k, min_score)
+        SEARCH_PATHS.inc(path="hybrid")
+        return lexical_hits, None
+
+    def _is_confident_lexical(self, lexical_hits) -> bool:
+        """最佳关键词结果的归一化分数足够高，且明显领先第二名"""
+        if Config.LEXICAL_FAST_PATH_MIN_SCORE is None or not lexical_hits:
+            return False
+        if lexical_hits[0][2] < Config.LEXICAL_FAST_PATH_MIN_SCORE:
+            return False
+        return len(lexical_hits) == 1 or lexical_hits[0][1] >= Config.LEXICAL_FAST_PATH_MARGIN * lexical_hits[1][1]
+
+    def _lexical_results(self, lexical_hits, top_k: int, min_score: float) -> List[SearchHit]:
+        """把 BM25 命中转换为检索结果，score 为归一化 BM25 分数"""
+        search_results = []
+        for doc_id, _, normalized_score in lexical_hits:
+            metadata = self.lexical_index.get(doc_id)
+            if normalized_score < min_score or metadata is None:
+                continue
+            search_results.append(SearchHit(doc_id, normalized_score, metadata, store=self.document_store))
+        with stage_timer("rank_results"):
+            return self._rank_results(search_results, top_k)
+
+    def _finish_vector_results(self, results: Dict, lexical_hits, top_k: int, min_score: float,
+                               mode: str, row: int = 0) -> List[SearchHit]:
+        """整理向量检索结果；hybrid 模式下与 BM25 结果做倒数排名融合"""
+        if mode != "hybrid":
+            return self._process_query_results(results, top_k, min_score, row=row)
+        vector_results, embeddings = self._candidate_hits(results, min_score, row=row)
+        return self._fuse_results(vector_results, lexical_hits, top_k, embeddings, min_score=min_score)
+
+    def _fuse_results(self, vector_results: List[SearchHit], lexical_hits, top_k: int,
+                      embeddings: Optional[np.ndarray] = None, min_score: float = 0.0) -> List[SearchHit]:
+        """
+        倒数排名融合：score 为 RRF 分数除以两路都排第一时的最大值，取值 0~1
+        结果中保留 vector_score / lexical_score 便于排查
+        embeddings: 与 vector_results 对应的候选向量，只被 BM25 命中的结果没有向量（按零向量处理）
+        min_score: 向量结果已按相似度过滤；只被 BM25 命中的结果按归一化 BM25 分数过滤（与 lexical 模式一致）
+        """
+        vector_ids = {result.id for result in vector_results}
+        lexical_hits = [hit for hit in lexical_hits if hit[0] in vector_ids or hit[2] >= min_score]
+        fused = reciprocal_rank_fusion(
+            [[result["id"] for result in vector_results], [doc_id for doc_id, _, _ in lexical_hits]],
+            k=Config.HYBRID_RRF_K
+        )
+        max_fused = 2.0 / (Config.HYBRID_RRF_K + 1)
+        by_id = {}
+        for result in vector_results:
+            by_id[result.id] = SearchHit(result.id, 0.0, result.metadata, store=self.document_store,
+                                         vector_score=result.score, lexical_score=0.0)
+        for doc_id, _, normalized_score in lexical_hits:
+            if doc_id in by_id:
+                by_id[doc_id].lexical_score = normalized_score
+                continue
+            metadata = self.lexical_index.get(doc_id)
+            if metadata is None:
+                continue
+            by_id[doc_id] = SearchHit(doc_id, 0.0, metadata, store=self.document_store,
+                                      lexical_score=normalized_score)
+        for doc_id, result in by_id.items():
+            result.score = fused[doc_id] / max_fused
+        if embeddings is not None:
+            # by_id 中向量结果在前，补上 BM25 结果对应的零向量行
+            embeddings = np.vstack([embeddings, np.zeros((len(by_id) - len(embeddings), embeddings.shape[1]))])
+        with stage_timer("rank_results"):
+            return self._rank_results(list(by_id.values()), top_k, embeddings)
+
+    def _build_query_params(self, query_embeddings: List[list], top_k: int, filters: Optional[Dict]) -> Dict:
+        """构建 Chroma 查询参数，query_embeddings 可包含多个查询向量（按所有查询路由结果的并集过滤）"""
+        # 类别路由与调用方的过滤条件合并
+        with stage_timer("category_routing"):
+            where = self.category_router.apply(query_embeddings, filters)
+        return self._query_params(query_embeddings, top_k, where)
+
+    def _query_params(self, query_embeddings: List[list], top_k: int, where: Optional[Dict]) -> Dict:
+        query_params = {
+            "query_embeddings": query_embeddings,
+            "n_results": top_k * 2,
+            # MMR 重排序需要候选向量，与检索结果一起返回
+            "include_embeddings": self.reranker.needs_embeddings
+        }
+        # 只有在有过滤条件时才添加 where 参数
+        if where:
+            query_params["where"] = where
+        return query_params
+
+    def _process_query_results(self, results: Dict, top_k: int, min_score: float, row: int = 0) -> List[SearchHit]:
+        """
+        整理 Chroma 查询结果：计算相似度、阈值过滤、重排序并截取 top_k
+        Args:
+            results: collection.query 的返回值
+            row: 批量查询时对应第几个查询向量
+        """
+        search_results, embeddings = self._candidate_hits(results, min_score, row=row)
+        # 结果排序（综合考虑相似度分数和业务规则）
+        with stage_timer("rank_results"):
+            return self._rank_results(search_results, top_k, embeddings)
+
+    def _candidate_hits(self, results: Dict, min_score: float, row: int = 0):
+        """
+        把查询结果转换为候选 SearchHit（按相似度阈值过滤）
+        Returns:
+            (hits, embeddings)：查询未返回向量时 embeddings 为 None
+        """
+        # 计算归一化相似度分数 (1 - distance)，并向量化地应用相似度阈值过滤
+        similarity_scores = 1 - np.asarray(results["distances"][row], dtype=np.float64)
+        kept = np.flatnonzero(similarity_scores >= min_score)
+        ids = results["ids"][row]
+        metadatas = results["metadatas"][row] if results.get("metadatas") is not None else None
+        # 只保留 id / 分数 / 元数据，document 在首次访问时从 document_store 加载
+        search_results = [
+            SearchHit(
+                ids[i],
+                float(similarity_scores[i]),
+                metadatas[i] if metadatas is not None else None,
+                store=self.document_store
+            )
+            for i in kept
+        ]
+        embeddings = None
+        if results.get("embeddings") is not None and len(ids):
+            embeddings = np.asarray(results["embeddings"][row], dtype=np.float64).reshape(len(ids), -1)[kept]
+        return search_results, embeddings
     
     def enhanced_search(self,
                         user_prompt: str,
                         top_k: int = 3,
                         filters: Optional[Dict] = None,
-                        min_score: float = 0.4) -> Dict:
+                        min_score: float = 0.4,
+                        mode: Optional[str] = None) -> Dict:
             """
             增强版检索方法，结合agent推荐和向量检索
             Args:
@@ -160,50 +556,98 @@ class VectorRetriever:
                 top_k: 返回结果数量
                 filters: 元数据过滤条件
                 min_score: 最小相似度阈值
+                mode: 检索模式，同 search
             Returns:
                 Dict: 包含agent推荐和检索结果的字典
             """
-            # 1. 首先获取agent推荐
-            agent_recommendation = self.recommend_agent(user_prompt)
+            with stage_timer("enhanced_search"), profile_if_slow("enhanced_search"):
+                # 1. 首先获取agent推荐
+                agent_recommendation = self.recommend_agent(user_prompt)
             
-            # 2. 构建增强查询文本
-            enhanced_query = f"""
-            用户需求: {user_prompt}
-            推荐Agent类型和描述: {agent_recommendation['agent_recommendation']}
-            """
+                # 2. 构建增强查询文本
+                enhanced_query = build_enhanced_query(user_prompt, agent_recommendation['agent_recommendation'])
             
-            # 3. 使用增强查询进行向量检索
-            search_results = self.search(
-                query=enhanced_query,
-                top_k=top_k,
-                filters=filters,
-                min_score=min_score
-            )
+                # 3. 使用增强查询进行向量检索
+                search_results = self.search(
+                    query=enhanced_query,
+                    top_k=top_k,
+                    filters=filters,
+                    min_score=min_score,
+                    mode=mode
+                )
             
-            # 4. 返回完整结果
-            return {
-                "original_prompt": user_prompt,
-                "agent_recommendation": agent_recommendation['agent_recommendation'],
-                "search_results": search_results
-            }
+                # 4. 返回完整结果
+                return {
+                    "original_prompt": user_prompt,
+                    "agent_recommendation": agent_recommendation['agent_recommendation'],
+                    "search_results": search_results
+                }
     
-    def _rank_results(self, results: List[Dict]) -> List[Dict]:
+    def _rank_results(self, results: List[SearchHit], top_k: Optional[int] = None,
+                      embeddings: Optional[np.ndarray] = None) -> List[SearchHit]:
         """
-        对检索结果进行排序
-        排序规则：
-        1. 优先级 priority (如果存在)
-        2. 相似度分数 score
+        对检索结果进行重排序并截取 top_k
+        排序规则见 reranking.Reranker：先按相似度分数排序，再依次应用 Config.RERANK_STAGES
         """
-        # def get_sort_key(item):
-        #     priority = item.get("metadata", {})
-        #     score = item["score"]
-        #     return (priority, score)
-        # return sorted(results, key=get_sort_key, reverse=True)
-        return sorted(results, key=lambda x: x["score"], reverse=True)
+        return self.reranker.rerank(results, embeddings, top_k)
+
+# 进程内共享的检索器实例：复用 OpenAI 客户端、Chroma 客户端和结果缓存
+_shared_retriever: Optional[VectorRetriever] = None
+_shared_retriever_lock = threading.Lock()
+
+def _register_cache_gauges(retriever: VectorRetriever):
+    """把共享检索器的缓存统计导出为指标"""
+    def collect():
+        result_stats = retriever.cache_stats()
+        recommendation_stats = retriever.recommendation_cache_stats()
+        return [
+            ({"cache": "search_result", "stat": "entries"}, result_stats["entries"]),
+            ({"cache": "search_result", "stat": "bytes"}, result_stats["bytes"]),
+            ({"cache": "search_result", "stat": "evictions"}, result_stats["evictions"]),
+            ({"cache": "search_result", "stat": "expirations"}, result_stats["expirations"]),
+            ({"cache": "recommendation", "stat": "entries"}, recommendation_stats["entries"]),
+            ({"cache": "recommendation", "stat": "semantic_hits"}, recommendation_stats["semantic_hits"]),
+            ({"cache": "recommendation", "stat": "evictions"}, recommendation_stats["evictions"])
+        ] + [
+            # 配置了共享缓存时额外导出共享层的命中统计
+            ({"cache": "search_result", "stat": stat}, result_stats[stat])
+            for stat in ("shared_hits", "shared_misses", "shared_errors") if stat in result_stats
+        ]
+    REGISTRY.register_gauge("aiagent_cache_state", "共享检索器缓存的当前状态", collect)
+
+def get_retriever() -> VectorRetriever:
+    """
+    获取进程内共享的检索器（线程安全的懒初始化）
+    """
+    global _shared_retriever
+    if _shared_retriever is None:
+        with _shared_retriever_lock:
+            if _shared_retriever is None:
+                start = time.perf_counter()
+                _shared_retriever = VectorRetriever()
+                logger.info(f"VectorRetriever 初始化耗时 {(time.perf_counter() - start) * 1000:.1f} ms")
+                _register_cache_gauges(_shared_retriever)
+    return _shared_retriever
+
+def warm_up() -> VectorRetriever:
+    """
+    启动时预热：创建共享检索器，并用库中已有的向量执行一次查询，
+    让检索后端提前加载 SQLite 元数据和索引（不调用 OpenAI 接口）
+    """
+    start = time.perf_counter()
+    retriever = get_retriever()
+    sample = retriever.collection.get(limit=1, include=["embeddings"])
+    if len(sample["ids"]) > 0:
+        retriever.backend.query(
+            query_embeddings=[sample["embeddings"][0]],
+            n_results=1
+        )
+    logger.info(f"检索器预热完成，耗时 {(time.perf_counter() - start) * 1000:.1f} ms")
+    return retriever
 
 if __name__ == "__main__":
     """测试基本检索功能"""
-    retriever = VectorRetriever()
+    retriever = get_retriever()
     
     # 测试增强版检索功能
     test_prompt = "我要找工作，帮我写简历，要找金融科技工作。"
@@ -0,0 +1,142 @@
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence
+
+from cache import decode_results, encode_results
+from config.settings import Config
+
+
+class DocumentStore:
+    """
+    按需加载agent文档（system prompt）的进程内缓存
+    检索结果只保存 id / score / metadata，调用方真正需要完整 prompt 时才从 Chroma 读取
+    - 有界 LRU，集合版本号变化时清空
+    """
+
+    def __init__(self, collection, version=None, max_entries: int = Config.DOCUMENT_CACHE_MAX_ENTRIES):
+        self.collection = collection
+        # 集合版本号（collection_version.CollectionVersion），为 None 时不做失效检查
+        self.version = version
+        self.max_entries = max_entries
+        self._documents: "OrderedDict[str, str]" = OrderedDict()
+        self._loaded_version = version.get(collection.name) if version is not None else None
+        self._lock = threading.Lock()
+
+    def _check_version(self):
+        # 调用方需持有锁
+        if self.version is None:
+            return
+        current = self.version.get(self.collection.name)
+        if current != self._loaded_version:
+            self._documents.clear()
+            self._loaded_version = current
+
+    def get_many(self, ids: Sequence[str]) -> List[Optional[str]]:
+        """批量获取文档，未缓存的 id 合并为一次 collection.get"""
+        with self._lock:
+            self._check_version()
+            missing = [doc_id for doc_id in dict.fromkeys(ids) if doc_id not in self._documents]
+        if missing:
+            data = self.collection.get(ids=missing, include=["documents"])
+            with self._lock:
+                for doc_id, document in zip(data["ids"], data["documents"]):
+                    self._documents[doc_id] = document
+                while len(self._documents) > self.max_entries:
+                    self._documents.popitem(last=False)
+        with self._lock:
+            documents = []
+            for doc_id in ids:
+                document = self._documents.get(doc_id)
+                if document is not None:
+                    self._documents.move_to_end(doc_id)
+                documents.append(document)
+            return documents
+
+    def get(self, doc_id: str) -> Optional[str]:
+        return self.get_many([doc_id])[0]
+
+    def put_many(self, ids: Sequence[str], documents: Sequence[str]):
+        """写入已知的文档（如 BM25 索引加载时读到的文档），避免之后再查询 Chroma"""
+        with self._lock:
+            self._check_version()
+            for doc_id, document in zip(ids, documents):
+                self._documents[doc_id] = document
+                self._documents.move_to_end(doc_id)
+            while len(self._documents) > self.max_entries:
+                self._documents.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._documents)
+
+
+class SearchHit:
+    """
+    精简的检索结果：只保存 id、分数和元数据引用，document 在首次访问时从 DocumentStore 加载
+    支持 hit["id"] / hit["document"] 等字典式访问，兼容原来的 dict 结果
+    """
+
+    __slots__ = ("id", "score", "metadata", "vector_score", "lexical_score", "_store")
+
+    _KEYS = ("id", "score", "document", "metadata", "vector_score", "lexical_score")
+
+    def __init__(self, id: str, score: float, metadata: Optional[Dict] = None,
+                 store: Optional[DocumentStore] = None,
+                 vector_score: Optional[float] = None, lexical_score: Optional[float] = None):
+        self.id = id
+        self.score = score
+        self.metadata = metadata if metadata is not None else {}
+        self.vector_score = vector_score
+        self.lexical_score = lexical_score
+        self._store = store
+
+    @property
+    def document(self) -> str:
+        if self._store is None:
+            return ""
+        return self._store.get(self.id) or ""
+
+    def keys(self) -> List[str]:
+        keys = ["id", "score", "document", "metadata"]
+        # hybrid 结果才有 vector_score / lexical_score
+        if self.vector_score is not None or self.lexical_score is not None:
+            keys += ["vector_score", "lexical_score"]
+        return keys
+
+    def __getitem__(self, key: str):
+        if key not in self._KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.keys()
+
+    def to_dict(self, include_document: bool = True) -> Dict:
+        return {key: self[key] for key in self.keys() if include_document or key != "document"}
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, SearchHit):
+            return NotImplemented
+        return (self.id, self.score, self.metadata, self.vector_score, self.lexical_score) == \
+            (other.id, other.score, other.metadata, other.vector_score, other.lexical_score)
+
+    def __repr__(self) -> str:
+        return f"SearchHit(id={self.id!r}, score={self.score:.4f}, metadata={self.metadata!r})"
+
+
+def encode_hits(hits: Sequence[SearchHit]) -> bytes:
+    """序列化检索结果（不包含文档），用于共享缓存"""
+    return encode_results([hit.to_dict(include_document=False) for hit in hits])
+
+
+def decode_hits(data: bytes, store: Optional[DocumentStore] = None) -> List[SearchHit]:
+    hits = []
+    for result in decode_results(data):
+        result.pop("document", None)
+        hits.append(SearchHit(store=store, **result))
+    return hits
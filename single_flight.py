@@ -0,0 +1,84 @@
+import asyncio
+import threading
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+from metrics import COALESCED_CALLS
+
+
+class _Call:
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    合并并发的相同调用（线程版）：同一个 key 同时只执行一次 fn，其余线程等待并共享结果或异常
+    key 为 (调用名, ...) 形式的元组，调用名用作 aiagent_coalesced_calls_total 的标签
+    只合并进行中的调用，不缓存结果；结果缓存仍由各自的缓存负责
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+        self.shared = 0
+
+    def do(self, key: Tuple, fn: Callable, *args, **kwargs) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+            else:
+                self.shared += 1
+        if not leader:
+            COALESCED_CALLS.inc(call=key[0])
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+        return call.result
+
+
+class AsyncSingleFlight:
+    """
+    合并并发的相同调用（asyncio 版）：同一个 key 只创建一个任务，所有调用方 await 同一个任务
+    调用方被取消时不会取消共享的任务，其他等待者仍能拿到结果
+    """
+
+    def __init__(self):
+        self._tasks: Dict[Hashable, asyncio.Task] = {}
+        self.shared = 0
+
+    async def do(self, key: Tuple, fn: Callable, *args, **kwargs) -> Any:
+        loop = asyncio.get_running_loop()
+        task = self._tasks.get(key)
+        if task is not None and not task.done() and task.get_loop() is loop:
+            self.shared += 1
+            COALESCED_CALLS.inc(call=key[0])
+        else:
+            task = loop.create_task(fn(*args, **kwargs))
+            self._tasks[key] = task
+            task.add_done_callback(lambda done, key=key: self._finish(key, done))
+        return await asyncio.shield(task)
+
+    def _finish(self, key: Hashable, task: asyncio.Task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        if not task.cancelled():
+            # 所有调用方都已取消时，避免 "Task exception was never retrieved" 警告
+            task.exception()
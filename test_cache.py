@@ -1,5 +1,37 @@
+import asyncio
+import json
+import logging
+import os
+import threading
 import time
-from retrieval import VectorRetriever
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+import numpy as np
+import pytest
+import chromadb
+from async_retrieval import AsyncVectorRetriever, _merge_results
+from cache import (RecommendationCache, ResultCache, SQLiteSharedCache, TieredCache, decode_results,
+                   encode_results)
+import openai_gateway
+import batch_route
+from benchmarks.fake_openai import FakeAsyncOpenAI, FakeOpenAI, fake_embedding
+from category_router import CategoryCentroids, CategoryRouter
+from collection_version import CollectionVersion, get_collection_version
+from config.settings import Config
+from embedding_providers import OpenAIEmbeddingProvider, get_embedding_provider
+from embedding_schema import EmbeddingSchemaError, current_schema, validate_collection_schema
+from embedding_store import EmbeddingStore, embed_texts
+import init_data
+from init_data import AgentInitializationError, get_collection, ingest_agents, initialize_agents
+from lexical_index import LexicalIndex, reciprocal_rank_fusion, tokenize
+from metrics import profile_task_if_slow
+from openai_gateway import OpenAIGateway
+from quantized_index import QuantizedIndex
+from search_results import DocumentStore, SearchHit
+from single_flight import AsyncSingleFlight, SingleFlight
+from reranking import create_reranker
+from retrieval import VectorRetriever, build_enhanced_query
+from vector_backends import ChromaBackend, NumpyBackend, QuantizedBackend
 
 def test_cache_effectiveness():
     # 初始化检索器，设置较短的缓存时间以便测试
@@ -44,6 +76,7 @@ def test_cache_effectiveness():
     # 打印缓存状态
     print("\n当前缓存状态:")
     print(f"缓存条目数量: {len(retriever.cache)}")
+    print(f"缓存统计: {retriever.cache_stats()}")
 
 def test_different_queries():
     retriever = VectorRetriever(cache_ttl=300)  # 5分钟缓存
@@ -72,6 +105,1063 @@ def test_different_queries():
         print(f"缓存查询时间: {second_time:.2f} 秒")
         print(f"加速比: {((first_time-second_time)/first_time):.2f}x")
 
+def test_result_cache_lru_eviction():
+    cache = ResultCache(ttl=60, max_entries=2, sweep_interval=None)
+    cache.set("a", [1])
+    cache.set("b", [2])
+    # 访问 a 后，b 成为最久未使用的条目
+    assert cache.get("a") == [1]
+    cache.set("c", [3])
+    assert cache.get("b") is None
+    assert cache.get("a") == [1]
+    assert cache.get("c") == [3]
+    stats = cache.stats()
+    assert stats["evictions"] == 1
+    assert stats["hits"] == 3
+    assert stats["misses"] == 1
+
+def test_result_cache_byte_limit():
+    cache = ResultCache(ttl=60, max_entries=100, max_bytes=2048, sweep_interval=None)
+    for i in range(20):
+        cache.set(i, "x" * 200)
+    assert cache.stats()["bytes"] <= 2048
+    assert len(cache) < 20
+    assert cache.get(19) is not None
+
+def test_result_cache_background_sweep():
+    cache = ResultCache(ttl=0.05, sweep_interval=0.02)
+    try:
+        cache.set("a", [1])
+        time.sleep(0.2)
+        # 后台线程已清理过期条目，无需再次读取
+        assert len(cache) == 0
+        assert cache.stats()["expirations"] == 1
+    finally:
+        cache.close()
+
+def test_recommendation_cache_exact_and_semantic():
+    cache = RecommendationCache(ttl=60, max_entries=2, semantic_distance=0.1)
+    cache.set("  金融 投资 ", "finance", embedding=[1.0, 0.0])
+    # 规范化后精确命中
+    assert cache.get("金融  投资") == "finance"
+    # 余弦距离在阈值内时语义命中，超出阈值时未命中
+    assert cache.get_similar([0.99, 0.05]) == "finance"
+    assert cache.get_similar([0.0, 1.0]) is None
+    cache.set("a", "A", embedding=[0.0, 1.0])
+    cache.set("b", "B", embedding=[0.0, 1.0])
+    # 超出条目上限后最久未使用的条目被淘汰，其向量也不再参与语义匹配
+    assert cache.get("金融 投资") is None
+    assert cache.get_similar([1.0, 0.0]) is None
+    stats = cache.stats()
+    assert stats["exact_hits"] == 1
+    assert stats["semantic_hits"] == 1
+    assert stats["evictions"] == 1
+
+def test_recommendation_cache_zero_entries():
+    # max_entries=0 表示不缓存，写入直接忽略
+    cache = RecommendationCache(ttl=60, max_entries=0)
+    cache.set("金融", "finance", embedding=[1.0, 0.0])
+    assert cache.get("金融") is None
+    assert cache.get_similar([1.0, 0.0]) is None
+    assert cache.stats()["entries"] == 0
+
+def test_results_binary_roundtrip():
+    results = [
+        {"id": "law_001", "score": 0.8125, "document": "法律咨询助手", "metadata": {"category": "law"}},
+        {"id": "finance_001", "score": 0.5, "document": "", "metadata": {}, "vector_score": None}
+    ]
+    assert decode_results(encode_results(results)) == results
+
+def test_tiered_cache_shared_between_workers(tmp_path):
+    path = str(tmp_path / "shared.sqlite3")
+    # 两个 worker 各自有进程内缓存，共享同一个 SQLite 文件
+    worker_a = TieredCache(ResultCache(sweep_interval=None), SQLiteSharedCache(path, ttl=60))
+    worker_b = TieredCache(ResultCache(sweep_interval=None), SQLiteSharedCache(path, ttl=60))
+    try:
+        results = [{"id": "a1", "score": 0.9, "document": "doc", "metadata": {"category": "law"}}]
+        worker_a.set("key", results)
+        assert worker_b.get("key") == results
+        assert worker_b.stats()["shared_hits"] == 1
+        # 回填进程内缓存后不再读取共享层
+        assert worker_b.get("key") == results
+        assert worker_b.stats()["shared_hits"] == 1
+        assert worker_b.get("missing") is None
+        assert worker_b.stats()["shared_misses"] == 1
+    finally:
+        worker_a.close()
+        worker_b.close()
+
+def _hit(id, score, category, priority=0):
+    return {"id": id, "score": score, "document": "", "metadata": {"category": category, "priority": priority}}
+
+def test_rerank_stage_order():
+    hits = [_hit("a", 0.9, "law"), _hit("b", 0.85, "law", priority=1), _hit("c", 0.5, "finance")]
+    # 先加权再去重：b 的优先级使其排在 a 前面，同类别只保留 b
+    assert [h["id"] for h in create_reranker(("priority", "category_dedup")).rerank(hits, top_k=2)] == ["b", "c"]
+    # 先去重再加权：去重时 a 的相似度更高，b 被丢弃
+    assert [h["id"] for h in create_reranker(("category_dedup", "priority")).rerank(hits, top_k=2)] == ["a", "c"]
+    assert not create_reranker(("priority",)).needs_embeddings
+    with pytest.raises(ValueError):
+        create_reranker(("unknown",))
+
+def test_rerank_mmr_diversity():
+    hits = [_hit("a", 0.9, "law"), _hit("b", 0.89, "law"), _hit("c", 0.8, "finance")]
+    # a 与 b 几乎相同，c 与两者正交
+    embeddings = np.array([[1.0, 0.0], [0.999, 0.01], [0.0, 1.0]])
+    assert [h["id"] for h in create_reranker(("priority",)).rerank(hits, embeddings, top_k=2)] == ["a", "b"]
+    reranker = create_reranker(("priority", "mmr"))
+    assert reranker.needs_embeddings
+    assert [h["id"] for h in reranker.rerank(hits, embeddings, top_k=2)] == ["a", "c"]
+    # 没有候选向量时 MMR 不改变顺序
+    assert [h["id"] for h in reranker.rerank(hits, None, top_k=2)] == ["a", "b"]
+
+def _collection(tmp_path, ids, embeddings, metadatas, name="agents"):
+    """临时目录下的 Chroma 集合（余弦距离，与 init_data 创建的集合一致）"""
+    client = chromadb.PersistentClient(path=str(tmp_path / "chroma"))
+    collection = client.create_collection(name=name, metadata={"hnsw:space": "cosine"})
+    collection.add(ids=ids, embeddings=embeddings, metadatas=metadatas)
+    return collection
+
+def _category_agents():
+    # 4 个类别各两个agent，向量分别靠近 4 个坐标轴；另有一个没有类别的agent
+    axes = np.eye(4)
+    ids, embeddings, metadatas = [], [], []
+    for i, category in enumerate(["finance", "law", "medical", "travel"]):
+        for j, offset in enumerate((0.1, -0.1)):
+            ids.append(f"{category}_{j}")
+            embeddings.append((axes[i] + offset * axes[(i + 1) % 4]).tolist())
+            metadatas.append({"category": category})
+    ids.append("general_0")
+    embeddings.append([0.5, 0.5, 0.5, 0.5])
+    metadatas.append({"priority": 1})
+    return ids, embeddings, metadatas
+
+def test_category_router_top_n(tmp_path):
+    ids, embeddings, metadatas = _category_agents()
+    collection = _collection(tmp_path, ids, embeddings, metadatas)
+    centroids = CategoryCentroids(str(tmp_path / "centroids.npz"))
+    router = CategoryRouter(collection, centroids, top_n=2, min_categories=2)
+    # 每个查询分别选出最相近的 2 个类别，多个查询时 route 返回并集
+    assert router.route_each([[1.0, 0.8, 0.0, 0.0], [0.0, 0.0, 0.3, 1.0]]) == [["finance", "law"], ["medical", "travel"]]
+    assert sorted(router.route([[1.0, 0.8, 0.0, 0.0], [0.0, 0.0, 0.3, 1.0]])) == ["finance", "law", "medical", "travel"]
+    # 集合中有没有类别的agent，路由条件同时保留这些agent
+    uncategorized = {"category": {"$nin": ["finance", "law", "medical", "travel"]}}
+    assert router.apply([[1.0, 0.8, 0.0, 0.0]], {"priority": 1}) == {
+        "$and": [{"priority": 1}, {"$or": [{"category": {"$in": ["finance", "law"]}}, uncategorized]}]
+    }
+    assert router.apply_each([[1.0, 0.8, 0.0, 0.0], [0.0, 0.0, 0.3, 1.0]], None) == [
+        {"$or": [{"category": {"$in": ["finance", "law"]}}, uncategorized]},
+        {"$or": [{"category": {"$in": ["medical", "travel"]}}, uncategorized]}
+    ]
+    # 调用方已经按类别过滤时不做路由
+    assert router.apply([[1.0, 0.0, 0.0, 0.0]], {"category": "law"}) == {"category": "law"}
+
+def test_category_router_fallback(tmp_path, monkeypatch):
+    ids, embeddings, metadatas = _category_agents()
+    collection = _collection(tmp_path, ids, embeddings, metadatas)
+    path = str(tmp_path / "centroids.npz")
+    # 质心文件缺失时从集合重新构建，没有类别的agent不计入
+    centroids = CategoryCentroids(path)
+    router = CategoryRouter(collection, centroids, version=CollectionVersion(str(tmp_path / "v.sqlite3")),
+                            top_n=2, min_categories=2)
+    assert centroids.total() == 8 and len(centroids) == 4 and centroids.uncategorized == 1
+    assert CategoryCentroids(path).total() == 8
+    # 版本号变化但质心与集合一致时不重新构建（集合中有没有类别的agent）
+    rebuilds = []
+    monkeypatch.setattr(centroids, "rebuild", rebuilds.append)
+    router.version.bump(collection.name)
+    router.route([[1.0, 0.0, 0.0, 0.0]])
+    assert rebuilds == []
+    # 类别数不超过 min_categories 时不做路由
+    small = CategoryRouter(collection, centroids, top_n=2, min_categories=4)
+    assert small.route([[1.0, 0.0, 0.0, 0.0]]) is None
+    assert small.apply([[1.0, 0.0, 0.0, 0.0]], {"priority": 1}) == {"priority": 1}
+    assert CategoryRouter(collection, centroids, top_n=0).apply([[1.0, 0.0, 0.0, 0.0]], None) is None
+
+def test_category_router_keeps_uncategorized_agents(tmp_path, monkeypatch):
+    ids, embeddings, metadatas = _category_agents()
+    collection = _collection(tmp_path, ids, embeddings, metadatas)
+    centroids = CategoryCentroids(str(tmp_path / "centroids.npz"))
+    router = CategoryRouter(collection, centroids, version=CollectionVersion(str(tmp_path / "v.sqlite3")),
+                            top_n=1, min_categories=2)
+    query = [[0.5, 0.5, 0.5, 0.45]]
+    where = router.apply(query, None)
+    # 最相近的是没有类别的 general_0，只按 top_n 类别过滤时会被排除
+    for backend in (ChromaBackend(collection), NumpyBackend(collection, reload_interval=0)):
+        assert backend.query(query, 3, where=where)["ids"][0][0] == "general_0"
+        assert "general_0" not in backend.query(query, 3, where=where["$or"][0])["ids"][0]
+    # 删除后增量更新质心（同 init_data.delete_agents），版本号变化时只比较条目数，不重新扫描集合
+    scans, rebuilds = [], []
+    get = collection.get
+    monkeypatch.setattr(collection, "get", lambda **kwargs: scans.append(kwargs) or get(**kwargs))
+    monkeypatch.setattr(centroids, "rebuild", rebuilds.append)
+    collection.delete(ids=["general_0"])
+    centroids.update([], [], old_categories=[None], old_embeddings=[embeddings[-1]])
+    centroids.save()
+    router.version.bump(collection.name)
+    assert router.apply(query, None) == {"category": {"$in": router.route(query)}}
+    assert scans == [] and rebuilds == [] and centroids.uncategorized == 0
+
+def test_category_centroids_incremental(tmp_path):
+    ids, embeddings, metadatas = _category_agents()
+    categories = [metadata.get("category") for metadata in metadatas]
+    centroids = CategoryCentroids(str(tmp_path / "centroids.npz"))
+    centroids.update(categories[:4], embeddings[:4])
+    centroids.update(categories[4:], embeddings[4:])
+    # 一个agent从 finance 改到 law，另一个被删除
+    centroids.update(["law"], [[0.0, 1.0, 0.0, 0.0]], old_categories=["finance"], old_embeddings=[embeddings[0]])
+    centroids.update([], [], old_categories=["travel"], old_embeddings=[embeddings[6]])
+    centroids.save()
+    # 增量维护的结果与从最终集合重新构建的结果一致
+    final_ids = ids[:6] + ids[7:]
+    final_embeddings = [[0.0, 1.0, 0.0, 0.0]] + embeddings[1:6] + embeddings[7:]
+    collection = _collection(tmp_path, final_ids, final_embeddings, [{"category": "law"}] + metadatas[1:6] + metadatas[7:])
+    rebuilt = CategoryCentroids(str(tmp_path / "rebuilt.npz"))
+    rebuilt.rebuild(collection)
+    loaded = CategoryCentroids(str(tmp_path / "centroids.npz"))
+    for current in (centroids, loaded):
+        names, matrix = current.centroids()
+        expected_names, expected = rebuilt.centroids()
+        order = [names.index(name) for name in expected_names]
+        assert sorted(names) == sorted(expected_names)
+        assert np.allclose(matrix[order], expected, atol=1e-6)
+        assert current.total() == rebuilt.total() == 7
+
+@pytest.fixture
+def offline(tmp_path, monkeypatch):
+    """离线环境：向量库和缓存放在临时目录，OpenAI 使用 benchmarks.fake_openai 的替身，关闭网关限流"""
+    monkeypatch.setattr(Config, "PERSIST_DIR", str(tmp_path / "chroma"))
+    monkeypatch.setattr(Config, "EMBEDDING_CACHE_PATH", str(tmp_path / "chroma" / "embedding_cache.sqlite3"))
+    monkeypatch.setattr(Config, "EMBEDDING_DIMENSIONS", 16)
+    monkeypatch.setattr(Config, "OPENAI_REQUESTS_PER_MINUTE", {})
+    monkeypatch.setattr(Config, "OPENAI_DEFAULT_REQUESTS_PER_MINUTE", None)
+    monkeypatch.setattr(openai_gateway, "_buckets", {})
+    return FakeOpenAI(dimensions=16)
+
+def _agents(categories=("finance", "law", "medical"), count=2, suffix=""):
+    return [
+        {"id": f"{category}_{i:03d}", "system_prompt": f"你是一名{category}领域的专业AI助手{i}{suffix}", "category": category}
+        for category in categories for i in range(count)
+    ]
+
+def test_lexical_tokenize_cjk_ngrams():
+    # 中文切分为字符 1-gram 和 2-gram，英文数字按单词切分并转小写
+    assert tokenize("法律咨询 GPT4") == ["法", "律", "咨", "询", "法律", "律咨", "咨询", "gpt4"]
+    assert tokenize("法律", ngram_sizes=(2,)) == ["法律"]
+
+def test_lexical_index_upsert_delete_filters():
+    index = LexicalIndex()
+    index.build(["law", "finance", "medical"], ["合同纠纷与法律咨询", "股票投资与理财", "常见疾病咨询"],
+                [{"category": "law", "priority": 2}, {"category": "finance", "priority": 1}, {"category": "medical"}])
+    hits = index.search("法律咨询", top_k=3)
+    assert hits[0][0] == "law" and all(0 < normalized <= 1 for _, _, normalized in hits)
+    assert [doc_id for doc_id, _, _ in index.search("咨询", 3, {"category": {"$in": ["medical", "finance"]}})] == ["medical"]
+    assert index.search("法律咨询", 3, {"$and": [{"category": "law"}, {"priority": {"$gte": 3}}]}) == []
+    # 更新后旧词项不再命中，删除后文档和元数据都被移除
+    index.upsert(["law"], ["保险理赔"], [{"category": "insurance"}])
+    assert "law" not in [doc_id for doc_id, _, _ in index.search("法律", 3)]
+    assert index.search("保险", 3)[0][0] == "law" and index.get("law") == {"category": "insurance"}
+    index.delete(["law"])
+    assert index.search("保险", 3) == [] and index.get("law") is None and len(index) == 2
+
+def test_reciprocal_rank_fusion_order():
+    fused = reciprocal_rank_fusion([["a", "b", "c"], ["c", "a"]], k=60)
+    # 两路都靠前的结果排在前面，只出现在一路的结果排在后面
+    assert sorted(fused, key=fused.get, reverse=True) == ["a", "c", "b"]
+    assert fused["a"] == pytest.approx(1 / 61 + 1 / 62)
+
+def test_lexical_fast_path_rule(offline, monkeypatch):
+    monkeypatch.setattr(Config, "LEXICAL_FAST_PATH_MIN_SCORE", 0.6)
+    monkeypatch.setattr(Config, "LEXICAL_FAST_PATH_MARGIN", 1.5)
+    retriever = VectorRetriever(client=offline)
+    assert retriever._is_confident_lexical([("a", 3.0, 0.8), ("b", 1.0, 0.3)])
+    assert retriever._is_confident_lexical([("a", 3.0, 0.7)])
+    # 归一化分数不够高，或没有明显领先第二名时走混合检索
+    assert not retriever._is_confident_lexical([("a", 3.0, 0.5)])
+    assert not retriever._is_confident_lexical([("a", 3.0, 0.8), ("b", 2.5, 0.7)])
+    assert not retriever._is_confident_lexical([])
+    monkeypatch.setattr(Config, "LEXICAL_FAST_PATH_MIN_SCORE", None)
+    assert not retriever._is_confident_lexical([("a", 3.0, 1.0)])
+
+def test_hybrid_min_score_applies_to_lexical_hits(offline):
+    ingest_agents(_agents(), offline, get_collection())
+    retriever = VectorRetriever(client=offline)
+    retriever._get_lexical_index()
+    lexical_hits = [("law_000", 3.0, 0.9), ("law_001", 1.0, 0.2)]
+    # 只被 BM25 命中且归一化分数低于 min_score 的结果被过滤
+    assert [hit.id for hit in retriever._fuse_results([], lexical_hits, 3, min_score=0.4)] == ["law_000"]
+    # 向量结果已经通过相似度阈值，BM25 分数低也保留
+    vector_results = [SearchHit("law_001", 0.5, {"category": "law"})]
+    fused = retriever._fuse_results(vector_results, lexical_hits, 3, min_score=0.4)
+    assert {hit.id for hit in fused} == {"law_000", "law_001"}
+    assert next(hit for hit in fused if hit.id == "law_001")["lexical_score"] == 0.2
+
+def _wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.001)
+    assert condition()
+
+def test_single_flight_threads():
+    flight = SingleFlight()
+    calls = []
+    release = threading.Event()
+
+    def fetch(value):
+        calls.append(value)
+        release.wait(5)
+        return value * 2
+
+    with ThreadPoolExecutor(8) as pool:
+        futures = [pool.submit(flight.do, ("fetch", 1), fetch, 1) for _ in range(8)]
+        # 所有线程都在等待同一个调用后再放行，保证调用确实是并发的
+        _wait_until(lambda: flight.shared == 7)
+        release.set()
+        assert [future.result() for future in futures] == [2] * 8
+    assert calls == [1]
+    # 调用完成后 key 被释放，下一次调用重新执行
+    assert flight._calls == {}
+    assert flight.do(("fetch", 1), fetch, 2) == 4 and calls == [1, 2]
+
+def test_single_flight_threads_share_exception():
+    flight = SingleFlight()
+    release = threading.Event()
+
+    def fail():
+        release.wait(5)
+        raise ValueError("upstream")
+
+    with ThreadPoolExecutor(4) as pool:
+        futures = [pool.submit(flight.do, ("fail",), fail) for _ in range(4)]
+        _wait_until(lambda: flight.shared == 3)
+        release.set()
+        errors = [future.exception() for future in futures]
+    # 领头调用的异常原样传给每个等待者
+    assert all(isinstance(error, ValueError) for error in errors)
+    assert len({id(error) for error in errors}) == 1
+    assert flight._calls == {}
+
+def test_async_single_flight():
+    async def scenario():
+        flight = AsyncSingleFlight()
+        calls = []
+        release = asyncio.Event()
+
+        async def fetch():
+            calls.append(1)
+            await release.wait()
+            return "ok"
+
+        callers = [asyncio.create_task(flight.do(("fetch",), fetch)) for _ in range(5)]
+        await asyncio.sleep(0)
+        # 取消发起调用的协程和一个等待者，共享的任务继续执行
+        callers[0].cancel()
+        callers[1].cancel()
+        await asyncio.sleep(0)
+        release.set()
+        assert await asyncio.gather(*callers[2:]) == ["ok"] * 3
+        assert callers[0].cancelled() and callers[1].cancelled()
+        assert calls == [1] and flight.shared == 4
+        await asyncio.sleep(0)
+        assert flight._tasks == {}
+
+        async def fail():
+            await asyncio.sleep(0)
+            raise ValueError("upstream")
+
+        errors = await asyncio.gather(*[flight.do(("fail",), fail) for _ in range(3)], return_exceptions=True)
+        assert all(isinstance(error, ValueError) for error in errors)
+        assert len({id(error) for error in errors}) == 1
+        await asyncio.sleep(0)
+        assert flight._tasks == {}
+
+    asyncio.run(scenario())
+
+def test_initialize_agents_cancels_pending_generation(offline, monkeypatch):
+    generated, finished, futures = [], [], []
+    second_started, release = threading.Event(), threading.Event()
+
+    class RecordingExecutor(ThreadPoolExecutor):
+        def submit(self, *args, **kwargs):
+            future = super().submit(*args, **kwargs)
+            futures.append(future)
+            return future
+
+    def generate(categories, client):
+        generated.append(categories)
+        if len(generated) == 2:
+            # 第二个块在第一个块写入期间开始生成，直到测试结束前都不返回
+            second_started.set()
+            release.wait(timeout=5)
+        finished.append(categories)
+        return _agents(categories, count=1)
+
+    def failing_ingest(*args, **kwargs):
+        second_started.wait(timeout=5)
+        raise RuntimeError("写入失败")
+
+    monkeypatch.setattr(init_data, "ThreadPoolExecutor", RecordingExecutor)
+    monkeypatch.setattr(init_data, "generate_agent_info", generate)
+    monkeypatch.setattr(init_data, "ingest_agents", failing_ingest)
+    monkeypatch.setattr(Config, "GENERATION_CHUNK_SIZE", 1)
+    monkeypatch.setattr(Config, "GENERATION_MAX_WORKERS", 1)
+    try:
+        with pytest.raises(AgentInitializationError):
+            initialize_agents(["finance", "law", "medical", "travel", "career"], offline)
+        # 第一个块写入失败后立即返回，不等待正在进行的生成请求
+        assert finished == [["finance"]]
+    finally:
+        release.set()
+    # 排队中的生成请求被取消，从未调用 generate_agent_info
+    assert [future.cancelled() for future in futures] == [False, False, True, True, True]
+    futures[1].result(timeout=5)
+    assert generated == [["finance"], ["law"]]
+
+def test_profile_task_if_slow_samples_own_task(caplog):
+    async def slow_stage():
+        await asyncio.sleep(0.05)
+
+    async def handler():
+        async with profile_task_if_slow("handler", threshold_ms=10, interval_ms=2):
+            await slow_stage()
+
+    async def busy_neighbour():
+        # 同一事件循环上的其他任务，反复占用事件循环线程
+        end = time.perf_counter() + 0.05
+        while time.perf_counter() < end:
+            sum(range(1000))
+            await asyncio.sleep(0)
+
+    async def scenario():
+        await asyncio.gather(handler(), busy_neighbour())
+
+    with caplog.at_level(logging.WARNING, logger="aiagent_log"):
+        asyncio.run(scenario())
+    # 日志中是当前任务挂起的位置，而不是其他任务
+    assert "慢请求 handler" in caplog.text
+    assert "slow_stage" in caplog.text and "busy_neighbour" not in caplog.text
+
+def test_process_query_first_starts_answer_before_loading_all_documents(monkeypatch):
+    import main
+    events = []
+
+    class FakeAsyncRetriever:
+        async def enhanced_search(self, query):
+            return {"search_results": [{"id": doc_id, "score": 0.9} for doc_id in ("a", "b", "c")]}
+
+        async def load_documents(self, results):
+            await asyncio.sleep(0)
+            events.append(("load", [result["id"] for result in results]))
+            for result in results:
+                result["document"] = f"文档 {result['id']}"
+
+    async def fake_response(query, sys_prompt):
+        events.append(("answer", sys_prompt))
+        return None
+
+    monkeypatch.setattr(main, "get_async_retriever", FakeAsyncRetriever)
+    monkeypatch.setattr(main, "get_openai_response", fake_response)
+
+    async def scenario():
+        text, stream_task = await main.process_query_first("问题")
+        await stream_task
+        return text
+
+    text = asyncio.run(scenario())
+    # 只加载最佳匹配的文档就发起回答请求，其余文档随后加载用于展示
+    assert events == [("load", ["a"]), ("answer", "文档 a"), ("load", ["b", "c"])]
+    assert "文档 c" in text
+
+def test_gateway_uniform_latency_no_hedges(offline, monkeypatch):
+    # 上游耗时稳定在 20ms，并发数是对冲线程池的 6 倍：排队时间不计入对冲等待，不应出现对冲请求
+    monkeypatch.setattr(Config, "OPENAI_HEDGE_DELAY_MS", 60)
+    monkeypatch.setattr(Config, "OPENAI_HEDGE_MIN_DELAY_MS", 60)
+    client = FakeOpenAI(dimensions=8, embedding_latency=0.02)
+    gateway = OpenAIGateway(client=client, hedge_embeddings=True)
+    requests = [{"model": Config.EMBEDDING_MODEL, "input": [f"文本 {i}"]} for i in range(480)]
+    with ThreadPoolExecutor(Config.OPENAI_HEDGE_WORKERS * 6) as pool:
+        responses = list(pool.map(gateway.embed, requests))
+    gateway.close()
+    assert len(responses) == 480
+    assert client.stats.embedding_calls == 480
+
+def test_gateway_hedges_slow_embedding(offline, monkeypatch):
+    monkeypatch.setattr(Config, "OPENAI_HEDGE_DELAY_MS", 50)
+    client = FakeOpenAI(dimensions=8)
+    calls = []
+    release = threading.Event()
+
+    def create(**request):
+        calls.append(request)
+        if len(calls) == 1:
+            # 第一个请求一直卡住，只有对冲请求能返回
+            release.wait()
+            return SimpleNamespace(data=[], primary=True)
+        return client.embeddings.create(**request)
+
+    gateway = OpenAIGateway(client=SimpleNamespace(embeddings=SimpleNamespace(create=create)), hedge_embeddings=True)
+    try:
+        response = gateway.embed({"model": Config.EMBEDDING_MODEL, "input": ["文本"]})
+        assert not hasattr(response, "primary") and len(response.data) == 1
+        assert len(calls) == 2
+    finally:
+        # 断言之后才放行卡住的请求，让网关线程退出
+        release.set()
+        gateway.close()
+
+class _RouteRetriever:
+    """批量路由用的检索器替身，记录请求过 agent 推荐的提示词"""
+
+    def __init__(self):
+        self.recommended = []
+
+    def recommend_agent(self, prompt):
+        self.recommended.append(prompt)
+        return {"agent_recommendation": f"推荐 {prompt}"}
+
+    def search_many(self, queries, top_k, filters, min_score):
+        return [[SearchHit("finance_000", 0.5, {"category": "finance"})] for _ in queries]
+
+class _CrashingRouter(batch_route.BatchRouter):
+    """处理完 crash_after 批后模拟进程中断"""
+
+    def __init__(self, crash_after, **kwargs):
+        super().__init__(**kwargs)
+        self.crash_after = crash_after
+        self.batches = 0
+
+    def route_batch(self, batch):
+        if self.batches == self.crash_after:
+            raise KeyboardInterrupt
+        self.batches += 1
+        return super().route_batch(batch)
+
+def _write_prompts(path, lines):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+
+def test_batch_route_crash_truncate_resume(tmp_path):
+    prompts = [json.dumps({"prompt": prompt}, ensure_ascii=False) for prompt in ("q0", "q1", "q0")]
+    prompts += ["", "不是 JSON"]
+    prompts += [json.dumps({"prompt": prompt}) for prompt in ("q2", "q1", "q3", "q0", "q4")]
+    input_path = str(tmp_path / "prompts.jsonl")
+    _write_prompts(input_path, prompts)
+
+    full = _RouteRetriever()
+    router = batch_route.BatchRouter(retriever=full, concurrency=2)
+    stats = batch_route.run(input_path, str(tmp_path / "full.jsonl"), batch_size=3, router=router)
+    router.close()
+    assert stats["skipped"] == 2 and stats["unique"] == 5 and sorted(full.recommended) == ["q0", "q1", "q2", "q3", "q4"]
+
+    # 处理完两批后中断，输出末尾留下写到一半的行
+    output = str(tmp_path / "routed.jsonl")
+    first = _RouteRetriever()
+    router = _CrashingRouter(2, retriever=first, concurrency=2)
+    with pytest.raises(KeyboardInterrupt):
+        batch_route.run(input_path, output, batch_size=3, router=router)
+    router.close()
+    with open(output, "ab") as f:
+        f.write(b'{"line": 6, "pro')
+
+    second = _RouteRetriever()
+    router = batch_route.BatchRouter(retriever=second, concurrency=2)
+    stats = batch_route.run(input_path, output, batch_size=3, resume=True, router=router)
+    router.close()
+    # 截掉不完整的行后从检查点继续，结果与一次跑完相同
+    with open(output, encoding="utf-8") as f, open(tmp_path / "full.jsonl", encoding="utf-8") as expected:
+        assert f.read() == expected.read()
+    assert stats["lines_done"] == len(prompts)
+    # 中断前已路由的 q0 / q1 在恢复后再次出现时直接复用，不再请求上游
+    assert sorted(first.recommended) == ["q0", "q1", "q2"]
+    assert sorted(second.recommended) == ["q3", "q4"]
+
+def test_batch_route_dedup_survives_redone_batch(tmp_path):
+    input_path = str(tmp_path / "prompts.jsonl")
+    _write_prompts(input_path, [json.dumps({"prompt": f"q{i}"}) for i in range(4)])
+    output = str(tmp_path / "routed.jsonl")
+    first = _RouteRetriever()
+    router = batch_route.BatchRouter(retriever=first)
+    batch_route.run(input_path, output, batch_size=2, router=router)
+    router.close()
+    # 模拟最后一批结果已提交、检查点尚未推进时中断：恢复时重做的批次从 SQLite 读取结果
+    checkpoint = batch_route.Checkpoint(output + ".checkpoint.json")
+    state = checkpoint.load()
+    with open(output, "rb") as f:
+        state.update(lines=2, writer={"bytes": len(b"".join(f.readlines()[:2]))})
+    checkpoint.save(state)
+    second = _RouteRetriever()
+    router = batch_route.BatchRouter(retriever=second)
+    stats = batch_route.run(input_path, output, batch_size=2, resume=True, router=router)
+    router.close()
+    assert second.recommended == [] and stats["reused"] == 2
+    with open(output, encoding="utf-8") as f:
+        assert [json.loads(line)["prompt"] for line in f] == ["q0", "q1", "q2", "q3"]
+    # 不使用 --resume 时从头开始，丢弃上次的结果
+    third = _RouteRetriever()
+    router = batch_route.BatchRouter(retriever=third)
+    batch_route.run(input_path, output, batch_size=2, router=router)
+    router.close()
+    assert sorted(third.recommended) == ["q0", "q1", "q2", "q3"]
+
+def test_batch_route_part_number():
+    assert batch_route._part_number("part-00012.parquet") == 12
+    assert batch_route._part_number("part-00003.parquet.tmp") == 3
+    assert batch_route._part_number("part-123456.parquet") == 123456
+    # 目录中的其他文件不是分片
+    for name in ("part-abc.parquet", "part-.parquet", "_SUCCESS", "part-00001.csv", "notes.txt"):
+        assert batch_route._part_number(name) is None
+
+def _random_agents(tmp_path, count=60, dimensions=16, seed=0):
+    """随机向量的临时集合，元数据包含类别和优先级"""
+    rng = np.random.default_rng(seed)
+    categories = ["finance", "law", "medical"]
+    metadatas = [{"category": categories[i % 3], "priority": i % 4} for i in range(count)]
+    embeddings = rng.standard_normal((count, dimensions)).astype(np.float32)
+    collection = _collection(tmp_path, [f"agent_{i:03d}" for i in range(count)], embeddings.tolist(), metadatas)
+    return collection, rng.standard_normal((3, dimensions)).astype(np.float32).tolist()
+
+def test_numpy_backend_matches_chroma(tmp_path):
+    collection, queries = _random_agents(tmp_path)
+    chroma, numpy_backend = ChromaBackend(collection), NumpyBackend(collection, reload_interval=0)
+    for where in (None,
+                  {"category": "law"},
+                  {"category": {"$in": ["law", "medical"]}},
+                  {"category": {"$ne": "law"}},
+                  {"$and": [{"category": {"$in": ["finance", "law"]}}, {"priority": {"$gte": 2}}]},
+                  {"$or": [{"category": "medical"}, {"priority": {"$lt": 1}}]}):
+        expected = chroma.query(queries, n_results=5, where=where)
+        actual = numpy_backend.query(queries, n_results=5, where=where)
+        # 小集合上 HNSW 等价于精确检索，两种后端的 id、距离和元数据一致
+        assert actual["ids"] == expected["ids"], where
+        assert np.allclose(actual["distances"], expected["distances"], atol=1e-4), where
+        assert actual["metadatas"] == expected["metadatas"], where
+
+def test_numpy_backend_where_masks(tmp_path):
+    collection, queries = _random_agents(tmp_path, count=12)
+    backend = NumpyBackend(collection, reload_interval=0)
+    snapshot = backend._snapshot
+    priorities = [metadata["priority"] for metadata in snapshot.metadatas]
+    categories = [metadata["category"] for metadata in snapshot.metadatas]
+    mask = backend._where_mask(snapshot, {"$and": [{"category": {"$nin": ["law"]}}, {"priority": {"$gt": 1}}]})
+    assert mask.tolist() == [c != "law" and p > 1 for c, p in zip(categories, priorities)]
+    # 掩码按条件缓存，不存在的字段只有 $ne / $nin 能匹配
+    assert backend._where_mask(snapshot, {"priority": 1, "category": "law"}) is \
+        backend._where_mask(snapshot, {"category": "law", "priority": 1})
+    assert not backend._where_mask(snapshot, {"missing": "x"}).any()
+    assert backend._where_mask(snapshot, {"missing": {"$ne": "x"}}).all()
+    # 取值索引直接得到候选行，与布尔掩码结果一致
+    rows = backend._where_rows(snapshot, {"$and": [{"category": "law"}, {"priority": {"$lte": 1}}]})
+    assert rows.tolist() == [i for i, (c, p) in enumerate(zip(categories, priorities)) if c == "law" and p <= 1]
+    assert backend.query(queries, n_results=3, where={"category": "unknown"})["ids"] == [[], [], []]
+    with pytest.raises(ValueError):
+        backend._where_mask(snapshot, {"priority": {"$regex": "1"}})
+
+def test_search_many_dedup_and_order(offline, monkeypatch):
+    # 每个查询只路由到一个类别，不同查询分组后各自检索
+    monkeypatch.setattr(Config, "VECTOR_BACKEND", "numpy")
+    monkeypatch.setattr(Config, "CATEGORY_ROUTING_TOP_N", 1)
+    ingest_agents(_agents(count=3), offline, get_collection())
+    retriever = VectorRetriever(client=offline)
+    retriever.category_router.min_categories = 1
+    backend_query = retriever.backend.query
+    wheres = []
+    monkeypatch.setattr(retriever.backend, "query",
+                        lambda **params: wheres.append(params.get("where")) or backend_query(**params))
+    queries = ["理财规划", "合同纠纷", "理财规划", "感冒发烧", "合同纠纷"]
+    before = offline.stats.as_dict()
+    results = retriever.search_many(queries, top_k=2, min_score=-1.0)
+    after = offline.stats.as_dict()
+    # 每种路由结果只查询一次后端
+    assert len(wheres) > 1 and all(where is not None for where in wheres)
+    assert len({json.dumps(where, sort_keys=True) for where in wheres}) == len(wheres)
+    # 重复的查询只嵌入一次，并且合并为一次嵌入请求
+    assert after["embedding_calls"] - before["embedding_calls"] == 1
+    assert after["embedding_inputs"] - before["embedding_inputs"] == 3
+    assert len(results) == len(queries)
+    assert results[0] is results[2] and results[1] is results[4]
+    # 与逐条 search 的结果一致（清空结果缓存，嵌入走嵌入缓存）
+    retriever.cache.clear()
+    for query, hits in zip(queries, results):
+        expected = retriever.search(query, top_k=2, min_score=-1.0)
+        assert [(hit.id, round(hit.score, 6)) for hit in hits] == [(hit.id, round(hit.score, 6)) for hit in expected]
+    assert offline.stats.as_dict()["embedding_inputs"] == after["embedding_inputs"]
+
+def test_embedding_schema_mismatch(offline, tmp_path, monkeypatch):
+    collection = get_collection()
+    ingest_agents(_agents(), offline, collection)
+    # 写入时记录嵌入模式，配置一致时校验通过
+    assert collection.metadata["embedding_dimensions"] == 16
+    assert validate_collection_schema(collection)["embedding_model"] == Config.EMBEDDING_MODEL
+    monkeypatch.setattr(Config, "EMBEDDING_DIMENSIONS", 32)
+    with pytest.raises(EmbeddingSchemaError):
+        validate_collection_schema(collection)
+    with pytest.raises(EmbeddingSchemaError):
+        VectorRetriever(client=offline).search("理财规划")
+    with pytest.raises(EmbeddingSchemaError):
+        get_collection()
+    monkeypatch.setattr(Config, "EMBEDDING_DIMENSIONS", 16)
+    monkeypatch.setattr(Config, "EMBEDDING_MODEL", "text-embedding-3-large")
+    with pytest.raises(EmbeddingSchemaError):
+        validate_collection_schema(collection)
+    # 未记录模式的非空旧集合按 ada-002 处理，空集合按当前配置处理
+    legacy = _collection(tmp_path / "legacy", ["a"], [[0.1] * 4], [{"category": "law"}])
+    with pytest.raises(EmbeddingSchemaError):
+        validate_collection_schema(legacy)
+    empty = chromadb.PersistentClient(path=str(tmp_path / "empty")).create_collection("agents")
+    assert validate_collection_schema(empty) == current_schema()
+
+def test_ingest_agents_idempotent(offline):
+    collection = get_collection()
+    versions = get_collection_version()
+    agents = _agents()
+    assert ingest_agents(agents, offline, collection, batch_size=2) == {"added": 6, "updated": 0, "skipped": 0}
+    version = versions.get(collection.name)
+    inputs = offline.stats.as_dict()["embedding_inputs"]
+    # 重复写入全部跳过：不生成嵌入，版本号不变（结果缓存不失效）
+    assert ingest_agents(agents, offline, collection, batch_size=2) == {"added": 0, "updated": 0, "skipped": 6}
+    assert versions.get(collection.name) == version
+    assert offline.stats.as_dict()["embedding_inputs"] == inputs
+    # 内容或类别变化的agent重新写入，只有有变化的批次递增版本号
+    agents[0] = dict(agents[0], system_prompt=agents[0]["system_prompt"] + "（已更新）")
+    agents[1] = dict(agents[1], category="law")
+    report = ingest_agents(agents + [agents[0]] + _agents(("travel",), count=1), offline, collection, batch_size=2)
+    assert report == {"added": 1, "updated": 2, "skipped": 4}
+    assert versions.get(collection.name) == version + 2
+    # 只改类别的agent文本未变，嵌入来自嵌入缓存
+    assert offline.stats.as_dict()["embedding_inputs"] == inputs + 2
+    stored = collection.get(ids=["finance_000", "finance_001"], include=["documents", "metadatas"])
+    assert stored["documents"][stored["ids"].index("finance_000")].endswith("（已更新）")
+    assert stored["metadatas"][stored["ids"].index("finance_001")]["category"] == "law"
+    assert collection.count() == 7
+
+def test_openai_embedding_provider_batches(offline, tmp_path, monkeypatch):
+    monkeypatch.setattr(Config, "EMBEDDING_BATCH_SIZE", 3)
+    provider = get_embedding_provider(offline)
+    assert isinstance(provider, OpenAIEmbeddingProvider) and provider.store_key == f"{Config.EMBEDDING_MODEL}@16"
+    assert OpenAIEmbeddingProvider(offline, "text-embedding-ada-002", 0).store_key == "text-embedding-ada-002"
+    texts = [f"查询{i}" for i in range(7)]
+    # 按 EMBEDDING_BATCH_SIZE 分批请求，结果与输入一一对应
+    vectors = provider.embed(texts)
+    assert offline.stats.as_dict()["embedding_calls"] == 3
+    assert np.allclose(vectors, [fake_embedding(text, 16) for text in texts])
+    async_client = FakeAsyncOpenAI(dimensions=16)
+    vectors = asyncio.run(OpenAIEmbeddingProvider(async_client).aembed(texts))
+    assert async_client.stats.as_dict()["embedding_calls"] == 3 and len(vectors) == 7
+    # 嵌入缓存按 store_key 区分模型和降维维度，同一文本不同维度不会互相命中
+    store = EmbeddingStore(str(tmp_path / "embeddings.sqlite3"))
+    assert len(embed_texts(offline, texts[:2], store=store)[0]) == 16
+    assert len(embed_texts(offline, texts[:2], store=store, dimensions=8)[0]) == 8
+    calls = offline.stats.as_dict()["embedding_calls"]
+    embed_texts(offline, texts[:2], store=store, dimensions=8)
+    assert offline.stats.as_dict()["embedding_calls"] == calls
+    store.close()
+
+class _CountingCollection:
+    """记录 collection.get 调用的集合包装"""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.name = collection.name
+        self.gets = []
+
+    def get(self, **kwargs):
+        self.gets.append(kwargs)
+        return self.collection.get(**kwargs)
+
+def test_document_store_lazy_loading(offline):
+    collection = get_collection()
+    ingest_agents(_agents(), offline, collection)
+    versions = get_collection_version()
+    counting = _CountingCollection(collection)
+    store = DocumentStore(counting, version=versions, max_entries=3)
+    hits = [SearchHit(agent_id, 0.9, store=store) for agent_id in ("law_000", "law_001", "finance_000")]
+    # 检索结果创建时不读取文档，首次访问 document 时才读取
+    assert counting.gets == [] and len(store) == 0
+    assert hits[0].document == "你是一名law领域的专业AI助手0"
+    assert counting.gets == [{"ids": ["law_000"], "include": ["documents"]}]
+    # 批量读取只请求未缓存的 id，已缓存的不再查询集合
+    assert store.get_many(["law_000", "law_001", "finance_000", "law_001"])[1:3] == \
+        ["你是一名law领域的专业AI助手1", "你是一名finance领域的专业AI助手0"]
+    assert counting.gets[-1]["ids"] == ["law_001", "finance_000"] and hits[1]["document"]
+    assert len(counting.gets) == 2
+    # 有界 LRU：超出 max_entries 时淘汰最久未使用的文档
+    store.get("medical_000")
+    assert len(store) == 3 and store.get_many(["law_000"]) and counting.gets[-1]["ids"] == ["law_000"]
+    # 集合版本号变化后清空缓存，读取到更新后的文档
+    ingest_agents(_agents(("law",), count=1, suffix="（新）"), offline, collection)
+    assert hits[0].document == "你是一名law领域的专业AI助手0（新）"
+    assert SearchHit("unknown", 0.5, store=store).document == "" and SearchHit("law_000", 0.5).document == ""
+    assert "document" not in hits[0].to_dict(include_document=False)
+
+def test_cache_paths_under_persist_dir():
+    assert os.path.dirname(Config.EMBEDDING_CACHE_PATH) == Config.PERSIST_DIR
+    assert os.path.dirname(Config.SHARED_CACHE_PATH) == Config.PERSIST_DIR
+
+def test_retriever_cache_invalidated_by_collection_version(offline, monkeypatch):
+    # 创建检索器不访问磁盘，首次检索时才打开集合和版本号文件
+    retriever = VectorRetriever(client=offline)
+    assert not os.path.exists(Config.PERSIST_DIR)
+    ingest_agents(_agents(), offline, get_collection())
+    backend_query = retriever.backend.query
+    queries = []
+    monkeypatch.setattr(retriever.backend, "query", lambda **params: queries.append(params) or backend_query(**params))
+    first = retriever.search("理财规划", top_k=2, min_score=-1.0)
+    assert retriever.search("理财规划", top_k=2, min_score=-1.0) == first and len(queries) == 1
+    # 本进程写入后版本号递增，结果缓存失效
+    ingest_agents(_agents(("travel",), count=1), offline, get_collection())
+    retriever.search("理财规划", top_k=2, min_score=-1.0)
+    assert len(queries) == 2
+    # 其他进程递增版本号（共享同一个 SQLite 文件），超过检查间隔后同样失效
+    retriever.collection_version.check_interval = 0
+    CollectionVersion(retriever.collection_version.path).bump(Config.COLLECTION_NAME)
+    retriever.search("理财规划", top_k=2, min_score=-1.0)
+    assert len(queries) == 3
+    # 没有写入时继续命中缓存
+    retriever.search("理财规划", top_k=2, min_score=-1.0)
+    assert len(queries) == 3
+
+def test_quantized_index_roundtrip(tmp_path):
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((20, 16)).astype(np.float32)
+    ids = [f"agent_{i:03d}" for i in range(20)]
+    for method in ("int8", "binary"):
+        QuantizedIndex("agents", method, str(tmp_path)).build(ids, vectors, version=3)
+        index = QuantizedIndex("agents", method, str(tmp_path))
+        assert index.load() and index.ids == ids and index.version == 3
+        assert np.allclose(index.norms, np.linalg.norm(vectors, axis=1))
+        assert np.allclose(index.vectors, vectors / np.linalg.norm(vectors, axis=1, keepdims=True), atol=1e-6)
+        # 近似点积与精确点积的排序基本一致
+        exact = vectors[:1] @ np.asarray(index.vectors).T
+        assert np.corrcoef(index.dots(vectors[:1])[0], exact[0])[0, 1] > 0.8
+        assert index.dots(vectors[:1], np.array([2, 5])).shape == (1, 2)
+    assert QuantizedIndex("agents", "int8", str(tmp_path)).nbytes == 0
+    assert not QuantizedIndex("missing", "int8", str(tmp_path)).load()
+    with pytest.raises(ValueError):
+        QuantizedIndex("agents", "pq", str(tmp_path))
+
+def test_quantized_backend_reuse_and_recall(tmp_path, monkeypatch):
+    collection, _ = _random_agents(tmp_path, count=300)
+    queries = np.random.default_rng(1).standard_normal((20, 16)).astype(np.float32).tolist()
+    versions = CollectionVersion(str(tmp_path / "versions.sqlite3"), check_interval=0)
+    versions.bump(collection.name)
+    builds = []
+    build = QuantizedIndex.build
+    monkeypatch.setattr(QuantizedIndex, "build", lambda self, *args, **kwargs: builds.append(self.method) or
+                        build(self, *args, **kwargs))
+    directory = str(tmp_path / "quantized")
+    exact_backend = NumpyBackend(collection, reload_interval=0)
+    expected = exact_backend.query(queries, n_results=10)
+    everything = exact_backend.query(queries, n_results=collection.count())
+    for method, factor in (("int8", 4), ("binary", 10)):
+        backend = QuantizedBackend(collection, method=method, rescore_factor=factor, directory=directory,
+                                   reload_interval=0, version=versions)
+        actual = backend.query(queries, n_results=10)
+        recall = np.mean([len(set(e) & set(a)) / 10 for e, a in zip(expected["ids"], actual["ids"])])
+        assert recall >= 0.9, (method, recall)
+        # 重打分后的距离与精确检索完全一致
+        for row, (ids, distances) in enumerate(zip(actual["ids"], actual["distances"])):
+            exact = dict(zip(everything["ids"][row], everything["distances"][row]))
+            assert np.allclose(distances, [exact[id_] for id_ in ids], atol=1e-5)
+        # 过滤条件与 NumpyBackend 一致
+        where = {"category": {"$in": ["law"]}}
+        assert all(m["category"] == "law" for m in backend.query(queries, 5, where=where)["metadatas"][0])
+    assert builds == ["int8", "binary"]
+    # 版本号未变化时重启直接打开已有索引，版本号变化后重新构建
+    QuantizedBackend(collection, method="int8", directory=directory, reload_interval=0, version=versions)
+    assert builds == ["int8", "binary"]
+    versions.bump(collection.name)
+    backend = QuantizedBackend(collection, method="int8", directory=directory, reload_interval=0, version=versions)
+    assert builds == ["int8", "binary", "int8"] and backend._snapshot.index.version == versions.get(collection.name)
+
+def test_merge_results_fills_from_speculative():
+    primary = [{"id": "a"}, {"id": "b"}]
+    secondary = [{"id": "b"}, {"id": "c"}, {"id": "d"}]
+    # 以增强查询结果为主，按 id 去重后用推测性检索结果补足 top_k
+    assert [result["id"] for result in _merge_results(primary, secondary, 3)] == ["a", "b", "c"]
+    assert [result["id"] for result in _merge_results(primary, secondary, 1)] == ["a"]
+    assert [result["id"] for result in _merge_results([], secondary, 2)] == ["b", "c"]
+
+def _async_retriever(offline, chat):
+    """基于临时集合的异步检索器，chat 替换异步客户端的对话接口"""
+    ingest_agents(_agents(count=3), offline, get_collection())
+    async_client = FakeAsyncOpenAI(dimensions=16)
+    async_client.chat = SimpleNamespace(completions=SimpleNamespace(create=chat))
+    return AsyncVectorRetriever(VectorRetriever(client=offline), client=async_client)
+
+def test_async_enhanced_search_overlaps_recommendation(offline, monkeypatch):
+    queried = []
+    overlapped = []
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        speculative_queried = asyncio.Event()
+
+        async def chat(**request):
+            # 推荐请求返回之前，推测性检索已经完成了向量查询
+            try:
+                await asyncio.wait_for(speculative_queried.wait(), timeout=5)
+                overlapped.append(True)
+            except asyncio.TimeoutError:
+                overlapped.append(False)
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="推荐Agent类型：法律顾问"))])
+
+        retriever = _async_retriever(offline, chat)
+        backend_query = retriever.retriever.backend.query
+
+        def query(**params):
+            queried.append(params["query_embeddings"][0])
+            loop.call_soon_threadsafe(speculative_queried.set)
+            return backend_query(**params)
+
+        monkeypatch.setattr(retriever.retriever.backend, "query", query)
+        try:
+            result = await retriever.enhanced_search("合同纠纷怎么处理", top_k=3, min_score=-1.0)
+            # 两次检索的结果都已缓存，再次检索不会查询后端
+            enhanced_query = build_enhanced_query("合同纠纷怎么处理", "推荐Agent类型：法律顾问")
+            enhanced = await retriever.search(enhanced_query, top_k=3, min_score=-1.0)
+            speculative = await retriever.search("合同纠纷怎么处理", top_k=3, min_score=-1.0)
+            return result, enhanced, speculative
+        finally:
+            retriever.close()
+
+    result, enhanced, speculative = asyncio.run(main())
+    assert overlapped == [True]
+    # 先用原始问题检索，推荐返回后用增强查询重新检索
+    assert queried == [fake_embedding("合同纠纷怎么处理", 16), fake_embedding(
+        build_enhanced_query("合同纠纷怎么处理", "推荐Agent类型：法律顾问"), 16)]
+    assert result["agent_recommendation"] == "推荐Agent类型：法律顾问"
+    assert result["search_results"] == _merge_results(enhanced, speculative, 3)
+    assert [hit.id for hit in result["search_results"]] == [hit.id for hit in enhanced]
+
+def test_async_enhanced_search_falls_back_on_recommendation_failure(offline):
+    async def chat(**request):
+        raise RuntimeError("推荐服务不可用")
+
+    async def main():
+        retriever = _async_retriever(offline, chat)
+        try:
+            result = await retriever.enhanced_search("合同纠纷怎么处理", top_k=3, min_score=-1.0)
+            return result, await retriever.search("合同纠纷怎么处理", top_k=3, min_score=-1.0)
+        finally:
+            retriever.close()
+
+    result, speculative = asyncio.run(main())
+    # 推荐失败时直接返回推测性检索结果
+    assert result["agent_recommendation"] == "" and result["original_prompt"] == "合同纠纷怎么处理"
+    assert result["search_results"] == speculative and len(speculative) == 3
+
+def test_async_search_runs_blocking_steps_in_executor(offline, monkeypatch):
+    monkeypatch.setattr(Config, "LEXICAL_FAST_PATH_MIN_SCORE", None)
+    threads = {}
+
+    def record(name, func):
+        def wrapper(*args, **kwargs):
+            threads[name] = threading.current_thread()
+            return func(*args, **kwargs)
+        return wrapper
+
+    async def main():
+        retriever = _async_retriever(offline, None)
+        # 冷启动的检索器：BM25 索引、检索后端和类别路由都在首次检索时加载
+        for name in ("_lexical_first", "_build_query_params", "_finish_vector_results"):
+            monkeypatch.setattr(retriever.retriever, name, record(name, getattr(retriever.retriever, name)))
+        try:
+            return await retriever.search("合同纠纷怎么处理", top_k=3, min_score=-1.0, mode="hybrid")
+        finally:
+            retriever.close()
+
+    assert len(asyncio.run(main())) == 3
+    assert set(threads) == {"_lexical_first", "_build_query_params", "_finish_vector_results"}
+    assert all(thread is not threading.main_thread() for thread in threads.values())
+
+def test_process_query_first_cancels_answer_when_loading_fails(monkeypatch):
+    import main
+    started = []
+    cancelled = []
+
+    class FakeAsyncRetriever:
+        async def enhanced_search(self, query):
+            return {"search_results": [{"id": doc_id, "score": 0.9} for doc_id in ("a", "b")]}
+
+        async def load_documents(self, results):
+            if results[0]["id"] != "a":
+                # 让回答请求先开始执行
+                await asyncio.sleep(0)
+                raise RuntimeError("集合不可用")
+            results[0]["document"] = "文档 a"
+
+    async def fake_response(query, sys_prompt):
+        started.append(sys_prompt)
+        try:
+            await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            cancelled.append(sys_prompt)
+            raise
+
+    monkeypatch.setattr(main, "get_async_retriever", FakeAsyncRetriever)
+    monkeypatch.setattr(main, "get_openai_response", fake_response)
+
+    async def scenario():
+        with pytest.raises(RuntimeError):
+            await main.process_query_first("问题")
+        # 回答请求已被取消，事件循环中没有遗留的任务
+        return [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+
+    assert asyncio.run(scenario()) == []
+    assert started == ["文档 a"] and cancelled == ["文档 a"]
+
+def test_as_gateway_injects_matching_client_only(offline):
+    sync_client, async_client = FakeOpenAI(dimensions=8), FakeAsyncOpenAI(dimensions=8)
+    # 同步客户端只用于同步接口，异步客户端只用于异步接口，另一种在首次使用时才创建
+    sync_gateway = openai_gateway.as_gateway(sync_client)
+    assert sync_gateway.client is sync_client and sync_gateway._async_client is None
+    async_gateway = openai_gateway.as_gateway(async_client)
+    assert async_gateway.async_client is async_client and async_gateway._client is None
+    assert openai_gateway.as_gateway(sync_gateway) is sync_gateway
+    request = {"model": Config.EMBEDDING_MODEL, "input": ["文本"]}
+    assert len(sync_gateway.embed(request).data) == 1
+    assert len(asyncio.run(async_gateway.aembed(request)).data) == 1
+    assert sync_client.stats.as_dict()["embedding_calls"] == 1 and async_client.stats.as_dict()["embedding_calls"] == 1
+
+def test_ingest_listener_does_not_keep_retriever_alive(offline):
+    import gc
+    import weakref
+    ingest_agents(_agents(), offline, get_collection())
+    gc.collect()
+    registered = len(init_data._live_ingest_listeners())
+    retriever = VectorRetriever(client=offline)
+    retriever._get_lexical_index()
+    # 注册的回调仍然生效：写入后 BM25 索引增量更新
+    ingest_agents(_agents(("travel",), count=1), offline, get_collection())
+    assert retriever.lexical_index.get("travel_000") == {"category": "travel", "content_hash": init_data.content_hash(
+        "你是一名travel领域的专业AI助手0")}
+    assert retriever._on_ingest in init_data._live_ingest_listeners()
+    # 不再使用的检索器可以被回收，之后的写入不再回调它
+    ref = weakref.ref(retriever)
+    del retriever
+    gc.collect()
+    assert ref() is None
+    ingest_agents(_agents(("career",), count=1), offline, get_collection())
+    assert len(init_data._ingest_listeners) == registered
+
+def test_get_retriever_singleton_and_warm_up(offline, monkeypatch):
+    import retrieval
+    monkeypatch.setattr(Config, "VECTOR_BACKEND", "numpy")
+    monkeypatch.setattr(retrieval, "_shared_retriever", None)
+    ingest_agents(_agents(), offline, get_collection())
+    # 并发获取时只创建一个共享检索器，创建时不打开集合
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        retrievers = list(executor.map(lambda _: retrieval.get_retriever(), range(16)))
+    retriever = retrievers[0]
+    assert all(current is retriever for current in retrievers) and retrieval.get_retriever() is retriever
+    assert retriever._chroma_client is None
+    # 预热打开集合并加载检索后端，不调用 OpenAI 接口
+    assert retrieval.warm_up() is retriever
+    assert retriever._chroma_client is not None and retriever._backend.name == "numpy"
+    assert len(retriever._backend._snapshot.ids) == 6
+    assert retriever._gateway is None
+    assert retrieval.get_retriever() is retriever
+
 if __name__ == "__main__":
     print("=== 测试缓存有效性 ===")
     test_cache_effectiveness()
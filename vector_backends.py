@@ -0,0 +1,402 @@
+import json
+import logging
+import threading
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from config.settings import Config
+from quantized_index import QuantizedIndex
+
+logger = logging.getLogger("aiagent_log")
+
+
+class ChromaBackend:
+    """直接使用 Chroma 的 HNSW 索引进行检索（只返回 id / 距离 / 元数据，文档按需另行加载）"""
+
+    name = "chroma"
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def query(self, query_embeddings: List[list], n_results: int, where: Optional[Dict] = None,
+              include_embeddings: bool = False) -> Dict:
+        query_params = {
+            "query_embeddings": query_embeddings,
+            "n_results": n_results,
+            "include": ["metadatas", "distances"] + (["embeddings"] if include_embeddings else [])
+        }
+        if where:
+            query_params["where"] = where
+        return self.collection.query(**query_params)
+
+
+def _collection_space(collection) -> str:
+    """读取集合的距离定义；modify 元数据后 hnsw:space 只保留在索引配置中"""
+    configuration = getattr(collection, "configuration", None) or {}
+    hnsw = configuration.get("hnsw") if isinstance(configuration, dict) else None
+    if hnsw and hnsw.get("space"):
+        return hnsw["space"]
+    return (collection.metadata or {}).get("hnsw:space", "l2")
+
+
+class _Snapshot:
+    """NumpyBackend 某一时刻加载的全部数据，重新加载时整体替换"""
+
+    def __init__(self, ids, metadatas, matrix, norms, index: Optional[QuantizedIndex] = None):
+        self.ids = ids
+        self.metadatas = metadatas
+        # 行归一化后的 float32 矩阵（量化后端中为内存映射文件），以及原始向量的模长（用于还原 l2 / ip 距离）
+        self.matrix = matrix
+        self.norms = norms
+        # 量化后端的编码索引
+        self.index = index
+        # 列式元数据：字段名 -> object 数组，缺失值为 None
+        self.columns: Dict[str, np.ndarray] = {}
+        for key in {key for metadata in metadatas for key in (metadata or {})}:
+            self.columns[key] = np.array(
+                [(metadata or {}).get(key) for metadata in metadatas], dtype=object
+            )
+        self.mask_cache: Dict[str, np.ndarray] = {}
+        self.mask_lock = threading.Lock()
+        # 字段名 -> {取值: 行号数组}，按需构建，$eq / $in 条件直接查表而不是逐行比较
+        self.value_rows: Dict[str, Dict] = {}
+
+    def rows_for(self, key: str, values) -> Optional[np.ndarray]:
+        """返回字段取值属于 values 的行号；字段不存在时返回 None"""
+        column = self.columns.get(key)
+        if column is None:
+            return None
+        index = self.value_rows.get(key)
+        if index is None:
+            groups: Dict = {}
+            for row, value in enumerate(column):
+                try:
+                    groups.setdefault(value, []).append(row)
+                except TypeError:
+                    # 不可哈希的取值（如列表）不进入索引
+                    continue
+            index = {value: np.asarray(rows, dtype=np.int64) for value, rows in groups.items()}
+            with self.mask_lock:
+                self.value_rows[key] = index
+        matched = [index[value] for value in values if value in index]
+        return np.sort(np.concatenate(matched)) if matched else np.zeros(0, dtype=np.int64)
+
+
+class NumpyBackend:
+    """
+    内存中的精确检索后端，适合小规模集合（几十到几千个agent）
+    - 一次性把所有向量加载为连续的归一化 float32 矩阵
+    - 检索是一次矩阵乘法 + argpartition
+    - where 过滤条件预先计算为布尔掩码并缓存
+    - 集合版本号变化时重新加载；另外定期检查集合条目数，兜底未更新版本号的写入
+    返回结果与 collection.query(include=["metadatas", "distances"]) 的格式和距离定义保持一致，
+    include_embeddings 时另外返回候选向量
+    """
+
+    name = "numpy"
+
+    def __init__(self, collection, reload_interval: float = Config.NUMPY_BACKEND_RELOAD_INTERVAL,
+                 version=None):
+        self.collection = collection
+        self.reload_interval = reload_interval
+        # 集合版本号（collection_version.CollectionVersion），为 None 时只按条目数检查
+        self.version = version
+        self._loaded_version = None
+        # 与 Chroma 集合使用相同的距离定义（默认 l2）
+        self.space = _collection_space(collection)
+        self._lock = threading.Lock()
+        self._snapshot: Optional[_Snapshot] = None
+        self._loaded_count = -1
+        self._last_check = 0.0
+        self.reload()
+
+    def reload(self):
+        """从 Chroma 集合重新加载全部向量和元数据"""
+        start = time.perf_counter()
+        # 先读版本号再加载数据，加载期间发生的写入会在下次检查时触发重新加载
+        loaded_version = self.version.get(self.collection.name) if self.version is not None else None
+        data = self.collection.get(include=["embeddings", "metadatas"])
+        ids = list(data["ids"])
+        if ids:
+            vectors = np.asarray(data["embeddings"], dtype=np.float32)
+        else:
+            vectors = np.zeros((0, 0), dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1) if ids else np.zeros(0, dtype=np.float32)
+        matrix = np.ascontiguousarray(vectors / np.maximum(norms, 1e-12)[:, None]) if ids else vectors
+        snapshot = _Snapshot(ids, list(data["metadatas"]), matrix, norms)
+        with self._lock:
+            self._snapshot = snapshot
+            self._loaded_count = len(ids)
+            self._loaded_version = loaded_version
+            self._last_check = time.monotonic()
+        logger.info(f"NumpyBackend 加载 {len(ids)} 条向量，耗时 {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    def _maybe_reload(self):
+        if self.version is not None and self.version.get(self.collection.name) != self._loaded_version:
+            self.reload()
+            return
+        if not self.reload_interval:
+            return
+        now = time.monotonic()
+        if now - self._last_check < self.reload_interval:
+            return
+        self._last_check = now
+        if self.collection.count() != self._loaded_count:
+            self.reload()
+
+    def query(self, query_embeddings: List[list], n_results: int, where: Optional[Dict] = None,
+              include_embeddings: bool = False) -> Dict:
+        self._maybe_reload()
+        snapshot = self._snapshot
+        result = {"ids": [], "distances": [], "metadatas": []}
+        if include_embeddings:
+            # 返回行归一化后的向量，重排序只用到余弦相似度
+            result["embeddings"] = []
+        if not snapshot.ids:
+            for key in result:
+                result[key] = [[] for _ in query_embeddings]
+            return result
+
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        query_norms = np.linalg.norm(queries, axis=1)
+        if where:
+            # 先按过滤条件确定候选行，只对候选行计算距离（如类别路由后的少数类别）
+            candidates = self._where_rows(snapshot, where)
+        else:
+            candidates = None
+        count = len(snapshot.ids) if candidates is None else len(candidates)
+        k = min(n_results, count)
+        if k == 0:
+            for key in result:
+                result[key] = [[] for _ in query_embeddings]
+            return result
+
+        rows, distances = self._score(snapshot, queries, query_norms, candidates, k)
+        if k < distances.shape[1]:
+            top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        else:
+            top = np.tile(np.arange(distances.shape[1]), (len(queries), 1))
+        top_distances = np.take_along_axis(distances, top, axis=1)
+        order = np.argsort(top_distances, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        top_distances = np.take_along_axis(top_distances, order, axis=1)
+        top_rows = np.take_along_axis(rows, top, axis=1)
+
+        for row in range(len(queries)):
+            indices = top_rows[row]
+            result["ids"].append([snapshot.ids[i] for i in indices])
+            result["distances"].append(top_distances[row].tolist())
+            result["metadatas"].append([snapshot.metadatas[i] for i in indices])
+            if include_embeddings:
+                result["embeddings"].append(np.asarray(snapshot.matrix[indices]))
+        return result
+
+    def _score(self, snapshot: _Snapshot, queries: np.ndarray, query_norms: np.ndarray,
+               candidates: Optional[np.ndarray], k: int):
+        """
+        计算查询与候选行的距离
+        Returns:
+            (行号矩阵, 距离矩阵)，形状均为 (查询数, 候选数)；candidates 为 None 时候选为全部行
+        """
+        if candidates is None:
+            dots = queries @ snapshot.matrix.T  # (m, n)，等于 q·x / |x|
+            distances = self._to_distances(dots, query_norms, snapshot.norms)
+            candidates = np.arange(len(snapshot.ids))
+        else:
+            dots = queries @ snapshot.matrix[candidates].T
+            distances = self._to_distances(dots, query_norms, snapshot.norms[candidates])
+        return np.broadcast_to(candidates, distances.shape), distances
+
+    def _to_distances(self, dots: np.ndarray, query_norms: np.ndarray, doc_norms: np.ndarray) -> np.ndarray:
+        """把点积换算成与 Chroma 相同定义的距离；doc_norms 为一维（各查询共用）或与 dots 同形状"""
+        if self.space == "cosine":
+            return 1 - dots / np.maximum(query_norms, 1e-12)[:, None]
+        if doc_norms.ndim == 1:
+            doc_norms = doc_norms[None, :]
+        inner = dots * doc_norms
+        if self.space == "ip":
+            return 1 - inner
+        # l2：Chroma 返回的是平方欧氏距离
+        return query_norms[:, None] ** 2 + doc_norms ** 2 - 2 * inner
+
+    def _where_rows(self, snapshot: _Snapshot, where: Dict) -> np.ndarray:
+        """
+        满足 where 条件的行号；形如 {"field": {"$in": [...]}}（可与其他条件 $and 组合）的条件
+        通过取值索引直接得到候选行，其余条件再用布尔掩码过滤；$or 的各分支分别求行号后取并集
+        """
+        if len(where) == 1 and "$or" in where:
+            return np.unique(np.concatenate([self._where_rows(snapshot, sub_where) for sub_where in where["$or"]]))
+        indexed, rest = _split_indexed(where)
+        if indexed is None:
+            return np.flatnonzero(self._where_mask(snapshot, where))
+        key, values = indexed
+        rows = snapshot.rows_for(key, values)
+        if rows is None:
+            return np.zeros(0, dtype=np.int64)
+        if rest:
+            rows = rows[self._where_mask(snapshot, rest)[rows]]
+        return rows
+
+    def _where_mask(self, snapshot: _Snapshot, where: Dict) -> np.ndarray:
+        key = json.dumps(where, sort_keys=True, ensure_ascii=False)
+        mask = snapshot.mask_cache.get(key)
+        if mask is None:
+            mask = _build_mask(snapshot, where)
+            with snapshot.mask_lock:
+                snapshot.mask_cache[key] = mask
+        return mask
+
+
+class QuantizedBackend(NumpyBackend):
+    """
+    量化检索后端，用于内存受限的大规模集合
+    - 常驻内存的只有 int8（每维 1 字节）或二值（每维 1 位）编码，全精度向量保存在内存映射文件中
+    - 先用量化编码对全部（或过滤后的）候选行近似打分，保留 n_results * rescore_factor 个，
+      再从内存映射文件读取这些行做全精度重打分，返回的距离与 NumpyBackend 完全一致
+    - 索引由集合中的嵌入构建，记录构建时的集合版本号；版本号未变化时重启直接打开已有索引文件
+    """
+
+    name = "quantized"
+
+    def __init__(self, collection, method: str = Config.QUANTIZED_METHOD,
+                 rescore_factor: int = Config.QUANTIZED_RESCORE_FACTOR, directory: Optional[str] = None,
+                 reload_interval: float = Config.NUMPY_BACKEND_RELOAD_INTERVAL, version=None):
+        self.method = method
+        self.rescore_factor = rescore_factor
+        self.directory = directory
+        super().__init__(collection, reload_interval=reload_interval, version=version)
+
+    def reload(self):
+        """打开与集合版本号一致的索引文件，不存在或已过期时从集合重新构建"""
+        start = time.perf_counter()
+        loaded_version = self.version.get(self.collection.name) if self.version is not None else None
+        index = QuantizedIndex(self.collection.name, self.method, self.directory)
+        count = self.collection.count()
+        metadatas = None
+        if (loaded_version is not None and index.load()
+                and index.version == loaded_version and len(index.ids) == count):
+            # 索引仍然有效，只读取元数据（不读取向量）
+            data = self.collection.get(include=["metadatas"])
+            positions = {id_: i for i, id_ in enumerate(data["ids"])}
+            if all(id_ in positions for id_ in index.ids):
+                metadatas = [data["metadatas"][positions[id_]] for id_ in index.ids]
+        if metadatas is None:
+            data = self.collection.get(include=["embeddings", "metadatas"])
+            metadatas = list(data["metadatas"])
+            if len(data["ids"]):
+                index.build(list(data["ids"]), data["embeddings"], version=loaded_version)
+            else:
+                index = None
+        if index is None:
+            snapshot = _Snapshot([], [], np.zeros((0, 0), dtype=np.float32), np.zeros(0, dtype=np.float32))
+        else:
+            snapshot = _Snapshot(index.ids, metadatas, index.vectors, index.norms, index=index)
+        with self._lock:
+            self._snapshot = snapshot
+            self._loaded_count = len(snapshot.ids)
+            self._loaded_version = loaded_version
+            self._last_check = time.monotonic()
+        resident = index.nbytes / 1024 / 1024 if index is not None else 0.0
+        logger.info(f"QuantizedBackend（{self.method}）加载 {len(snapshot.ids)} 条向量，常驻编码 {resident:.1f} MB，"
+                    f"耗时 {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    def _score(self, snapshot: _Snapshot, queries: np.ndarray, query_norms: np.ndarray,
+               candidates: Optional[np.ndarray], k: int):
+        norms = snapshot.norms if candidates is None else snapshot.norms[candidates]
+        approx = self._to_distances(snapshot.index.dots(queries, candidates), query_norms, norms)
+        pool = min(approx.shape[1], k * self.rescore_factor)
+        if pool < approx.shape[1]:
+            shortlist = np.argpartition(approx, pool - 1, axis=1)[:, :pool]
+        else:
+            shortlist = np.tile(np.arange(approx.shape[1]), (len(queries), 1))
+        rows = shortlist if candidates is None else candidates[shortlist]
+        # 全精度重打分：各查询的候选行去重后按行号顺序从内存映射文件读取
+        unique_rows, inverse = np.unique(rows, return_inverse=True)
+        dots = queries @ np.asarray(snapshot.matrix[unique_rows]).T
+        dots = np.take_along_axis(dots, inverse.reshape(rows.shape), axis=1)
+        return rows, self._to_distances(dots, query_norms, snapshot.norms[rows])
+
+
+def _split_indexed(where: Dict):
+    """
+    从 where 中拆出一个可以查取值索引的 $eq / $in 条件
+    Returns:
+        ((字段名, 取值列表), 剩余条件) ，没有可拆出的条件时为 (None, where)
+    """
+    if len(where) != 1:
+        return None, where
+    key, condition = next(iter(where.items()))
+    if key == "$and":
+        for i, sub_where in enumerate(condition):
+            indexed, rest = _split_indexed(sub_where)
+            if indexed is not None and not rest:
+                others = condition[:i] + condition[i + 1:]
+                return indexed, {"$and": others} if others else None
+        return None, where
+    if key.startswith("$"):
+        return None, where
+    if not isinstance(condition, dict):
+        return (key, [condition]), None
+    if len(condition) == 1 and ("$in" in condition or "$eq" in condition):
+        values = condition["$in"] if "$in" in condition else [condition["$eq"]]
+        return (key, list(values)), None
+    return None, where
+
+
+def _column_mask(column: Optional[np.ndarray], size: int, operator: str, value) -> np.ndarray:
+    if column is None:
+        # 字段不存在时只有 $ne / $nin 能匹配
+        return np.full(size, operator in ("$ne", "$nin"))
+    if operator == "$eq":
+        return np.fromiter((v == value for v in column), dtype=bool, count=size)
+    if operator == "$ne":
+        return np.fromiter((v != value for v in column), dtype=bool, count=size)
+    if operator in ("$in", "$nin"):
+        values = set(value)
+        mask = np.fromiter((v in values for v in column), dtype=bool, count=size)
+        return mask if operator == "$in" else ~mask
+    comparators = {
+        "$gt": lambda v: v > value,
+        "$gte": lambda v: v >= value,
+        "$lt": lambda v: v < value,
+        "$lte": lambda v: v <= value
+    }
+    if operator in comparators:
+        compare = comparators[operator]
+        return np.fromiter((v is not None and compare(v) for v in column), dtype=bool, count=size)
+    raise ValueError(f"不支持的过滤操作符: {operator}")
+
+
+def _build_mask(snapshot: _Snapshot, where: Dict) -> np.ndarray:
+    """把 Chroma 风格的 where 条件转换为布尔掩码"""
+    size = len(snapshot.ids)
+    mask = np.ones(size, dtype=bool)
+    for key, condition in where.items():
+        if key == "$and":
+            for sub_where in condition:
+                mask &= _build_mask(snapshot, sub_where)
+        elif key == "$or":
+            any_mask = np.zeros(size, dtype=bool)
+            for sub_where in condition:
+                any_mask |= _build_mask(snapshot, sub_where)
+            mask &= any_mask
+        elif isinstance(condition, dict):
+            for operator, value in condition.items():
+                mask &= _column_mask(snapshot.columns.get(key), size, operator, value)
+        else:
+            mask &= _column_mask(snapshot.columns.get(key), size, "$eq", condition)
+    return mask
+
+
+def create_backend(collection, backend: Optional[str] = None, version=None):
+    """根据配置创建检索后端：chroma、numpy 或 quantized；version 为集合版本号，内存后端据此重新加载"""
+    backend = backend or Config.VECTOR_BACKEND
+    if backend == "chroma":
+        return ChromaBackend(collection)
+    if backend == "numpy":
+        return NumpyBackend(collection, version=version)
+    if backend == "quantized":
+        return QuantizedBackend(collection, version=version)
+    raise ValueError(f"未知的检索后端: {backend}")